@@ -0,0 +1,68 @@
+"""
+Benchmark raw writes to a device, or a file standing in for one, for each
+block size & number of writes in flight, against plain buffered writes
+synced at the end as cp or dd do. Then show what calibration picks.
+
+    python bench/blockwrite.py --target /dev/sdb --size 256
+    python bench/blockwrite.py --dir /mnt/usb --blocksizes 256 1024 4096 --depths 1 4
+
+Everything on --target from --offset on is overwritten.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).parent.parent))
+from blockwrite import BLOCK_SIZES,DEPTHS,measure,calibrate
+
+
+def buffered(path, blocksize, size):
+    """Rate of plain writes of blocksize, one fsync at the end"""
+    data=os.urandom(blocksize)
+    start=time.perf_counter()
+    with open(path,'r+b') as out:
+        written=0
+        while written<size:
+            written+=out.write(data[:size-written])
+        out.flush()
+        os.fsync(out.fileno())
+    return(written/(time.perf_counter()-start))
+
+
+def benchmark(target, args):
+    size=args.size*pow(2,20)
+    blocksizes=[b*pow(2,10) for b in args.blocksizes]
+    print(f'Writing {args.size}[MiB] to {target} {args.repeat} times, best rate of each')
+    rows=[('buffered',b,1,lambda b=b:buffered(target,b,size)) for b in blocksizes]
+    rows+=[(None,b,d,lambda b=b,d=d:measure(target,b,d,size,offset=args.offset)) for b in blocksizes for d in args.depths]
+    for kind,blocksize,depth,run in rows:
+        results=[run() for _ in range(args.repeat)]
+        if kind is None:
+            rate=max(r for r,direct in results)
+            kind='direct' if results[0][1] else 'buffered+sync'
+        else:
+            rate=max(results)
+        print(f'{kind: <14} {blocksize//pow(2,10): >7}[KiB] x{depth: <3} {rate/pow(2,20): >9.1f}[MiB/s]')
+    blocksize,depth=calibrate(target,args.offset,blocksizes=blocksizes,depths=args.depths)
+    print(f'Calibration picks {blocksize//pow(2,10)}[KiB] x{depth}')
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target',type=Path,help='Device or file to write. A scratch file in --dir by default')
+    parser.add_argument('--dir',help='Scratch directory, on the filesystem to test')
+    parser.add_argument('--offset',type=int,default=0,help='Byte offset in --target to write at')
+    parser.add_argument('--size',type=int,default=128,help='MiB written per run')
+    parser.add_argument('--blocksizes',type=int,nargs='+',default=[b//pow(2,10) for b in BLOCK_SIZES],help='KiB')
+    parser.add_argument('--depths',type=int,nargs='+',default=list(DEPTHS))
+    parser.add_argument('--repeat',type=int,default=3)
+    args=parser.parse_args()
+    if args.target is not None:
+        benchmark(args.target,args)
+    else:
+        with tempfile.NamedTemporaryFile(dir=args.dir) as scratch:
+            benchmark(Path(scratch.name),args)
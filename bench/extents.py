@@ -0,0 +1,68 @@
+"""
+Benchmark the free extent index on synthetic, fragmented partition tables.
+
+    python bench/extents.py --extents 1000 10000
+"""
+
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).parent.parent))
+from extent import FreeExtents,FIT_FIRST,FIT_BEST
+
+ALIGNMENT=2048  # 1MiB of 512 byte sectors
+
+
+def fragmented(extentcount, seed=0):
+    """Index of a disk with about extentcount free extents of random sizes"""
+    rng=random.Random(seed)
+    sector=ALIGNMENT
+    used=[]
+    for _ in range(extentcount):
+        size=rng.randint(1,64)*ALIGNMENT
+        used.append((sector,sector+size-1))
+        sector+=size+rng.randint(1,64)*ALIGNMENT
+    extents=FreeExtents(34,sector+128*ALIGNMENT,ALIGNMENT)
+    for start,end in used:
+        extents.allocate(start,end)
+    return(extents,used,rng)
+
+
+def benchmark(extentcount, repeat):
+    extents,used,rng=fragmented(extentcount)
+    sizes=[rng.randint(1,64)*ALIGNMENT for _ in range(repeat)]
+
+    def find(fit, before=None):
+        for size in sizes:
+            extents.find(size,fit,before)
+
+    def churn():
+        # Add then remove partitions, as a layout being planned does
+        for size in sizes:
+            start,end=extents.find(size,FIT_FIRST)
+            extents.allocate(start,end)
+            extents.release(start,end)
+
+    results={
+        'build':min(timeit.repeat(lambda:fragmented(extentcount),number=1,repeat=3)),
+        'first fit':min(timeit.repeat(lambda:find(FIT_FIRST),number=1,repeat=3))/repeat,
+        'best fit':min(timeit.repeat(lambda:find(FIT_BEST),number=1,repeat=3))/repeat,
+        # Only the first tenth of the disk may be used
+        'best fit before':min(timeit.repeat(lambda:find(FIT_BEST,extents.last//10),number=1,repeat=3))/repeat,
+        'allocate+release':min(timeit.repeat(churn,number=1,repeat=3))/repeat,
+    }
+    for name,seconds in results.items():
+        unit='per table' if name=='build' else 'per op'
+        print(f'{extentcount: >8} extents  {name: <18} {seconds*1e6: >10.1f}[us] {unit}')
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--extents',type=int,nargs='+',default=[100,1000,10000])
+    parser.add_argument('--repeat',type=int,default=1000)
+    args=parser.parse_args()
+    for n in args.extents:
+        benchmark(n,args.repeat)
@@ -0,0 +1,78 @@
+"""
+Benchmark the parallel tree copier against cp -r.
+
+The synthetic tree is shaped like an OpenELEC system partition: a large
+SYSTEM squashfs, a KERNEL, and many small files in nested directories.
+
+    python bench/filecopy.py --small 5000 --system 256 --workers 1 4 8
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).parent.parent))
+from treecopy import TreeCopy
+
+FANOUT=32   # Small files per directory
+
+
+def buildTree(root, small, smallsize, systemmib, kernelmib):
+    """Write the synthetic tree under root. Returns its size in bytes"""
+    block=os.urandom(pow(2,20))
+    for name,mib in (('SYSTEM',systemmib),('KERNEL',kernelmib)):
+        with open(Path(root,name),'wb') as f:
+            for _ in range(mib):
+                f.write(block)
+    for n in range(small):
+        directory=Path(root,'tree',f'{n//(FANOUT*FANOUT)}',f'{n//FANOUT%FANOUT}')
+        directory.mkdir(parents=True,exist_ok=True)
+        Path(directory,f'file{n}').write_bytes(block[n%1024:n%1024+smallsize])
+    return((systemmib+kernelmib)*pow(2,20)+small*smallsize)
+
+
+def timed(fn):
+    subprocess.run(['sync'])
+    start=time.perf_counter()
+    fn()
+    return(time.perf_counter()-start)
+
+
+def benchmark(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as scratch:
+        source=Path(scratch,'source')
+        source.mkdir()
+        bytesize=buildTree(source,args.small,args.smallsize,args.system,args.kernel)
+        print(f'Tree of {args.small} small files of {args.smallsize}[B], {args.system}[MiB] SYSTEM, '
+              f'{args.kernel}[MiB] KERNEL: {bytesize/pow(2,20):.1f}[MiB]')
+
+        runs=[('cp -r',lambda target:subprocess.run(['cp','-r',f'{source}/.',str(target)],check=True))]
+        for workers in args.workers:
+            runs.append((f'TreeCopy x{workers}',lambda target,w=workers:TreeCopy(source,target,w).run()))
+
+        for name,run in runs:
+            seconds=[]
+            for n in range(args.repeat):
+                target=Path(scratch,'target')
+                target.mkdir()
+                seconds.append(timed(lambda:run(target)))
+                shutil.rmtree(target)
+            best=min(seconds)
+            print(f'{name: <16} {best: >8.3f}[s] {bytesize/pow(2,20)/best: >9.1f}[MiB/s] {args.small/best: >10.0f}[files/s]')
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small',type=int,default=5000,help='Number of small files')
+    parser.add_argument('--smallsize',type=int,default=4096)
+    parser.add_argument('--system',type=int,default=128,help='SYSTEM size in MiB')
+    parser.add_argument('--kernel',type=int,default=8,help='KERNEL size in MiB')
+    parser.add_argument('--workers',type=int,nargs='+',default=[1,4,8])
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--dir',help='Scratch directory, on the filesystem to test')
+    benchmark(parser.parse_args())
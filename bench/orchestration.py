@@ -0,0 +1,82 @@
+"""
+Benchmark the orchestration of install.py apart from the cost of its I/O.
+
+Partitioning, formatting, grub install & menu generation are run against a
+simulated disk, so only the python side is timed: probing, planning the
+layout, scripting sfdisk, parsing command output... Image download &
+streaming are left out, they are all I/O.
+
+    python bench/orchestration.py --runs 100
+
+Given a file recorded on a real disk with install.py --record, the same run
+is replayed from it instead, and the time commands took when recorded is
+reported as the I/O cost alongside.
+
+    python bench/orchestration.py --replay install.rec
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).parent.parent))
+import install
+import tracing
+from config import config
+from executor import SimulatedExecutor,SimulatedDisk,ReplayExecutor
+
+DEVICE='/dev/sdb'
+DISK_SIZE=64*pow(2,30)
+
+
+def installFlow(executor):
+    """The install.py flow, less images"""
+    disk=install.partitionDisk(DEVICE,install.MODE_STREAM,executor)
+    for osid,osdata in config['os'].items():
+        systemPartition=disk.partitiontable.getPartitionBy(osdata['partition']['system']['partitionlabel'],'partlabel')
+        install.addMenuEntries(disk,osdata,systemPartition)
+    disk.updateGrubMenu()
+    disk.close()
+
+
+def installRun(executor):
+    """Returns the number of commands run"""
+    installFlow(executor)
+    return(sum(t['count'] for t in tracing.tracer.totals[tracing.KIND_COMMAND].values()))
+
+
+def benchmark(runs, replay=None):
+    seconds=[]
+    commands=0
+    for _ in range(runs):
+        if replay is None:
+            executor=SimulatedExecutor(SimulatedDisk(DEVICE,DISK_SIZE))
+        else:
+            executor=replay
+            executor.rewind()
+        tracing.tracer.totals={tracing.KIND_PHASE:{},tracing.KIND_COMMAND:{}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            start=time.perf_counter()
+            commands=installRun(executor)
+            seconds.append(time.perf_counter()-start)
+
+    seconds.sort()
+    print(f"{'simulated' if replay is None else 'replayed'} install of {len(config['os'])} os, {runs} runs, {commands} commands per run")
+    print(f'orchestration  min {seconds[0]*1e3: >8.2f}[ms]  median {seconds[len(seconds)//2]*1e3: >8.2f}[ms]')
+    if replay is not None:
+        print(f'recorded I/O       {replay.recordedSeconds*1e3: >8.2f}[ms]  skipped commands {replay.skipped}')
+    print('Orchestration time by phase, last run')
+    phases=tracing.tracer.totals[tracing.KIND_PHASE]
+    for name,t in sorted(phases.items(),key=lambda x:-x[1]['seconds']):
+        print(f"  {name: <16} {t['count']: >6} {t['seconds']/t['count']*1e3: >8.2f}[ms] mean")
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs',type=int,default=50)
+    parser.add_argument('--replay',type=Path,help='Command recording made with install.py --record')
+    args=parser.parse_args()
+    benchmark(args.runs,ReplayExecutor(args.replay) if args.replay is not None else None)
@@ -0,0 +1,254 @@
+"""
+Raw writes of partition data, tuned to the device written.
+
+A BlockWriter gathers the stream into page aligned buffers of one block
+size and writes them with O_DIRECT, so the data goes straight to the device
+and does not fill the page cache. Several writes are kept in flight at once,
+and fdatasync is called every SYNC_INTERVAL bytes. Without that, the kernel
+would flush everything at close and appear to hang. Where O_DIRECT is
+refused, as on tmpfs, buffered writes are used, and the synced range is
+dropped from the cache.
+
+USB sticks, SD cards and SATA disks each do best with a different block size
+and number of writes in flight. calibrate() times a short write of each
+block size, then of each depth, at the start of the region about to be
+written, and tuning() remembers the pick for each device.
+
+    blocksize,depth=tuning(device,bytesize)
+    with BlockWriter(device,blocksize,depth) as out:
+        out.write(chunk)
+
+bench/blockwrite.py reports the rate of every configuration.
+"""
+
+import collections
+import errno
+import mmap
+import os
+import queue
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from checksum import DIRECT_ALIGN
+import tracing
+
+BLOCK_SIZE=4*pow(2,20)          # Untuned defaults
+DEPTH=2
+BLOCK_SIZES=(256*pow(2,10),pow(2,20),4*pow(2,20),16*pow(2,20))
+DEPTHS=(1,2,4,8)
+SYNC_INTERVAL=64*pow(2,20)      # Bytes written between fdatasyncs
+CALIBRATE_SIZE=32*pow(2,20)     # Most bytes written per configuration tried
+CALIBRATE_TIME=0.5              # Most seconds per configuration tried
+CALIBRATE_MIN=pow(2,30)         # Smaller writes are not worth calibrating for
+
+
+def _openWrite(path, direct=True):
+    """fd of existing path for writing, O_DIRECT when asked & the filesystem allows it
+
+    :return: (fd, direct)
+    """
+    if direct:
+        try:
+            return(os.open(path,os.O_WRONLY|os.O_DIRECT),True)
+        except OSError as e:
+            if e.errno!=errno.EINVAL:
+                raise
+    return(os.open(path,os.O_WRONLY),False)
+
+
+class BlockWriter:
+    """Writable file object for a device or file, writing blocksize aligned
+    blocks, depth of them at once
+
+    Blocks are written at increasing offsets from offset, in the order
+    given. Only the last one may be short. It is written buffered when
+    not a whole number of DIRECT_ALIGN units.
+
+    :param path: Existing device or file
+    :param direct: Write with O_DIRECT where possible
+    :param offset: Byte offset in path to start at. Written buffered unless
+        a multiple of DIRECT_ALIGN
+    """
+
+    def __init__(self, path, blocksize=BLOCK_SIZE, depth=DEPTH, direct=True, syncInterval=SYNC_INTERVAL, offset=0):
+        self.path=Path(path)
+        self.blocksize=blocksize
+        self.depth=depth
+        self.syncInterval=syncInterval
+        self.offset=offset
+        # Direct writes must start on an aligned offset, as a partition in an image file may not
+        self.fd,self.direct=_openWrite(self.path,direct and offset%DIRECT_ALIGN==0)
+        self.written=0          # Bytes taken by write
+        self.synced=offset      # Offset up to which data is on the device
+        self._position=offset   # Offset of the block being filled
+        self._unsynced=0
+        self._pending=collections.deque()   # (offset, future) of writes in flight
+        # mmap memory is page aligned, as O_DIRECT wants. One block fills while depth are written
+        self._buffers=[mmap.mmap(-1,blocksize) for _ in range(depth+1)]
+        self._free=queue.Queue()
+        [self._free.put(b) for b in self._buffers[1:]]
+        self._buffer=self._buffers[0]
+        self._filled=0
+        self._pool=ThreadPoolExecutor(max_workers=depth)
+        self._closed=False
+
+    def write(self, data):
+        view=memoryview(data)
+        size=len(view)
+        while view:
+            n=min(self.blocksize-self._filled,len(view))
+            self._buffer[self._filled:self._filled+n]=view[:n]
+            self._filled+=n
+            view=view[n:]
+            if self._filled==self.blocksize:
+                self._submit()
+        self.written+=size
+        return(size)
+
+    def _submit(self):
+        self._pending.append((self._position,self._pool.submit(self._write,self._buffer,self._filled,self._position)))
+        self._position+=self._filled
+        self._unsynced+=self._filled
+        self._filled=0
+        while self._pending and self._pending[0][1].done():
+            # Raises any error of the write
+            self._pending.popleft()[1].result()
+        if self._unsynced>=self.syncInterval:
+            self._sync()
+        self._buffer=self._free.get()
+
+    def _write(self, buffer, length, at):
+        try:
+            with memoryview(buffer) as view:
+                done=0
+                while done<length:
+                    done+=os.pwrite(self.fd,view[done:length],at+done)
+        finally:
+            self._free.put(buffer)
+
+    def _sync(self):
+        """Sync the writes completed so far, without waiting on those in flight"""
+        durable=self._pending[0][0] if self._pending else self._position
+        os.fdatasync(self.fd)
+        if not self.direct:
+            # Written back, so free to drop from the cache
+            os.posix_fadvise(self.fd,self.offset,durable-self.offset,os.POSIX_FADV_DONTNEED)
+        self.synced=durable
+        self._unsynced=self._position-durable
+
+    def close(self):
+        """Write what is left, wait for every write & sync"""
+        if self._closed:
+            return
+        self._closed=True
+        try:
+            tail=self._filled%DIRECT_ALIGN if self.direct else 0
+            rest=bytes(self._buffer[self._filled-tail:self._filled])
+            if self._filled>tail:
+                self._filled-=tail
+                self._submit()
+            while self._pending:
+                self._pending.popleft()[1].result()
+            if tail:
+                fd=os.open(self.path,os.O_WRONLY)
+                try:
+                    os.pwrite(fd,rest,self._position)
+                    os.fdatasync(fd)
+                finally:
+                    os.close(fd)
+                self._position+=tail
+            self._sync()
+        finally:
+            self._pool.shutdown()
+            os.close(self.fd)
+            [b.close() for b in self._buffers]
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_pattern=None
+
+def _data(size):
+    """size bytes of random data, kept between calls. Zeros could be written
+    faster than an image by devices that compress or skip them"""
+    global _pattern
+    if _pattern is None or len(_pattern)<size:
+        _pattern=os.urandom(size)
+    return(memoryview(_pattern)[:size])
+
+
+def measure(path, blocksize, depth, size=CALIBRATE_SIZE, limit=None, direct=True, offset=0):
+    """Rate writing to path through a BlockWriter, sync included
+
+    :param size: Bytes to write
+    :param limit: Seconds after which to stop short of size
+    :return: (bytes/s, direct)
+    """
+    data=_data(blocksize)
+    start=time.perf_counter()
+    with BlockWriter(path,blocksize,depth,direct,offset=offset) as out:
+        while out.written<size and (limit is None or time.perf_counter()-start<limit):
+            out.write(data[:size-out.written])
+    return(out.written/(time.perf_counter()-start),out.direct)
+
+
+def calibrate(path, offset=0, size=CALIBRATE_SIZE, blocksizes=BLOCK_SIZES, depths=DEPTHS):
+    """Pick the fastest block size at DEPTH writes in flight, then the fastest
+    depth at that block size, by writing to path
+
+    Overwrites up to size bytes of path from offset, which are to be written
+    after anyway. A regular file is truncated back to its size.
+
+    :return: (blocksize, depth)
+    """
+    filesize=os.stat(path).st_size if stat.S_ISREG(os.stat(path).st_mode) else None
+    with tracing.span('calibrate',target=str(path)) as attrs:
+        try:
+            rates={(b,DEPTH):measure(path,b,DEPTH,size,CALIBRATE_TIME,offset=offset)[0] for b in blocksizes}
+            blocksize,_=max(rates,key=rates.get)
+            for depth in depths:
+                if (blocksize,depth) not in rates:
+                    rates[(blocksize,depth)]=measure(path,blocksize,depth,size,CALIBRATE_TIME,offset=offset)[0]
+            best=max(((b,d) for b,d in rates if b==blocksize),key=rates.get)
+        finally:
+            if filesize is not None:
+                os.truncate(path,filesize)
+        attrs.update(blocksize=best[0],depth=best[1],rate=round(rates[best]))
+    print(f'Writing {path} in {best[0]//pow(2,10)}[KiB] blocks, {best[1]} at once, '
+          f'{rates[best]/pow(2,20):.1f}[MiB/s] when calibrated')
+    return(best)
+
+
+_tuned={}
+_tunedLock=threading.Lock()
+
+def _deviceKey(path):
+    """What writes to path are limited by: the device itself, or the filesystem holding a file"""
+    info=os.stat(path)
+    return(('dev',info.st_rdev) if stat.S_ISBLK(info.st_mode) else ('fs',info.st_dev))
+
+
+def tuning(path, bytesize=None, offset=0):
+    """(blocksize, depth) for writing bytesize bytes to path
+
+    Writes of CALIBRATE_MIN or more are worth calibrating for, once per
+    device. Smaller ones, and those of unknown size, use the defaults,
+    or what an earlier calibration found for the device.
+    """
+    key=_deviceKey(path)
+    with _tunedLock:
+        if key in _tuned:
+            return(_tuned[key])
+    if bytesize is None or bytesize<CALIBRATE_MIN:
+        return((BLOCK_SIZE,DEPTH))
+    # Not calibrated under the lock, targets being written at once calibrate at once
+    tuned=calibrate(path,offset,min(CALIBRATE_SIZE,bytesize))
+    with _tunedLock:
+        _tuned.setdefault(key,tuned)
+    return(tuned)
@@ -0,0 +1,280 @@
+"""
+Content addressed store for OS images.
+
+Objects are stored under their SHA-256 and shared by every url or path that
+resolves to the same bytes. Decompressed images are kept as sparse files
+alongside the archive they came from so a repeat install skips both the
+download and the gunzip. Least recently used objects are evicted once the
+allocated size of the store exceeds its byte budget.
+
+Downloads are made to a name of their url in the cache root, so one cut
+short resumes on the next run. Their partial files count against the
+budget, and are the first to go when over it.
+
+Archives can also be given a gzip access point index, kept beside them, so
+their partitions are read without decompressing everything before them.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from download import Download,PART_SUFFIX,STATE_SUFFIX
+from image import gzipChunks
+import checksum
+import gzindex
+import progress
+import tracing
+
+HASH_BLOCK_SIZE=pow(2,20)
+SPARSE_BLOCK_SIZE=64*pow(2,10)
+ZERO_BLOCK=bytes(SPARSE_BLOCK_SIZE)
+
+KIND_ARCHIVE='gz'
+KIND_IMAGE='img'
+
+INCOMING_PREFIX='incoming.'
+
+
+def copyHashed(source, target):
+    """Copy file source to target, hashing it on the way
+
+    :return: sha256 hex digest
+    """
+    digest=checksum.new(checksum.SHA256)
+    with open(source,'rb') as src, open(target,'wb') as out:
+        while True:
+            block=src.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    return(digest.hexdigest())
+
+
+def writeSparse(out, chunks, digest=None):
+    """Write chunks to out, seeking over all zero blocks instead of writing them
+
+    :param out: File opened for binary writing
+    :param digest: Optional hashlib object updated with every byte, zeros included
+    :return: Total bytes of content
+    """
+    total=0
+    for chunk in chunks:
+        view=memoryview(chunk)
+        if digest is not None:
+            digest.update(view)
+        for offset in range(0,len(view),SPARSE_BLOCK_SIZE):
+            block=view[offset:offset+SPARSE_BLOCK_SIZE]
+            if block==ZERO_BLOCK[:len(block)]:
+                out.seek(len(block),os.SEEK_CUR)
+            else:
+                out.write(block)
+        total+=len(view)
+    out.truncate(total)
+    return(total)
+
+
+class ImageCache:
+    """Content addressed, size bounded LRU cache of image archives & their
+    decompressed images
+
+    :param root: Directory holding the cache
+    :param budget: Max allocated bytes before least recently used objects are evicted
+    """
+
+    INDEX_FILE='index.json'
+
+    def __init__(self, root, budget):
+        self.root=Path(root)
+        self.budget=budget
+        self.objectdir=Path(self.root,'objects')
+        self.objectdir.mkdir(parents=True,exist_ok=True)
+        self.indexfile=Path(self.root,ImageCache.INDEX_FILE)
+        self._index=self._loadIndex()
+
+    def _loadIndex(self):
+        index={'objects':{},'names':{},'images':{},
+               'stats':{'hits':0,'misses':0,'evictions':0,'evictedbytes':0}}
+        if self.indexfile.exists():
+            try:
+                index.update(json.loads(self.indexfile.read_text()))
+            except ValueError:
+                pass
+        # Drop entries whose object has been removed behind our back
+        index['objects']={k:v for k,v in index['objects'].items() if self.objectPath(k).exists()}
+        return(index)
+
+    def _saveIndex(self):
+        temp=Path(f'{self.indexfile}.tmp')
+        temp.write_text(json.dumps(self._index,indent=1))
+        os.replace(temp,self.indexfile)
+
+    def objectPath(self, sha):
+        return(Path(self.objectdir,sha))
+
+    def _has(self, sha):
+        return(sha is not None and sha in self._index['objects'])
+
+    def _touch(self, sha):
+        self._index['objects'][sha]['lastused']=time.time()
+
+    def _count(self, stat):
+        self._index['stats'][stat]+=1
+
+    def _store(self, path, sha, kind, keep=()):
+        """Move file at path into the store as sha, sharing any existing copy
+
+        :param keep: Other objects that must survive the eviction this may trigger
+        """
+        target=self.objectPath(sha)
+        if target.exists():
+            os.unlink(path)
+        else:
+            os.replace(path,target)
+        self._index['objects'][sha]={
+            'kind':kind,
+            'size':target.stat().st_blocks*512,
+            'lastused':time.time(),
+        }
+        self._evict(keep={sha,*keep})
+        return(target)
+
+    def _partials(self):
+        """[(mtime, allocated bytes, path)] of partial downloads, oldest first"""
+        found=[]
+        for part in self.root.glob(f'{INCOMING_PREFIX}*{PART_SUFFIX}'):
+            try:
+                info=part.stat()
+            except FileNotFoundError:
+                continue
+            found.append((info.st_mtime,info.st_blocks*512,part))
+        return(sorted(found))
+
+    def _evict(self, keep=()):
+        """Remove partial downloads, then least recently used objects, until within budget"""
+        objects=self._index['objects']
+        used=sum(o['size'] for o in objects.values())
+        partials=self._partials()
+        used+=sum(size for _,size,_ in partials)
+        for _,size,part in partials:
+            if used<=self.budget:
+                break
+            used-=size
+            part.unlink(missing_ok=True)
+            Path(f'{str(part)[:-len(PART_SUFFIX)]}{STATE_SUFFIX}').unlink(missing_ok=True)
+        for sha in sorted(objects,key=lambda k:objects[k]['lastused']):
+            if used<=self.budget:
+                break
+            if sha in keep:
+                continue
+            used-=objects[sha]['size']
+            self._index['stats']['evictions']+=1
+            self._index['stats']['evictedbytes']+=objects[sha]['size']
+            os.unlink(self.objectPath(sha))
+            gzindex.GzipIndex.indexPath(self.objectPath(sha)).unlink(missing_ok=True)
+            del objects[sha]
+        self._index['names']={k:v for k,v in self._index['names'].items() if v in objects}
+        self._index['images']={k:v for k,v in self._index['images'].items() if v in objects}
+
+    def _tempPath(self):
+        fd,path=tempfile.mkstemp(dir=self.root,prefix=INCOMING_PREFIX)
+        os.close(fd)
+        return(Path(path))
+
+    def _downloadPath(self, url):
+        """Download target of url, the same every run so an interrupted download resumes"""
+        return(Path(self.root,f'{INCOMING_PREFIX}{hashlib.sha256(url.encode()).hexdigest()[:32]}'))
+
+    def getArchive(self, url, sha256=None, seed=None):
+        """Path of the cached archive for url, downloading it on a miss
+
+        :param sha256: Expected digest. Mismatching downloads are rejected
+        :param seed: Local copy of the archive to import instead of downloading
+        """
+        sha=sha256 if sha256 is not None else self._index['names'].get(url)
+        if self._has(sha):
+            self._count('hits')
+            self._touch(sha)
+            self._index['names'][url]=sha
+            self._saveIndex()
+            return(self.objectPath(sha))
+
+        self._count('misses')
+        seeded=seed is not None and Path(seed).exists()
+        incoming=self._tempPath() if seeded else self._downloadPath(url)
+        try:
+            # Hashed as it arrives, not read again after
+            if seeded:
+                actual=copyHashed(seed,incoming)
+            else:
+                fetch=Download(url,incoming)
+                fetch.run()
+                actual=fetch.sha256
+            if sha256 is not None and actual!=sha256:
+                raise ValueError(f'{url} has sha256 {actual}, expected {sha256}')
+        except BaseException:
+            # Partial downloads are kept to resume from, see _evict
+            if incoming.exists():
+                os.unlink(incoming)
+            raise
+        path=self._store(incoming,actual,KIND_ARCHIVE)
+        self._index['names'][url]=actual
+        self._saveIndex()
+        return(path)
+
+    @tracing.traced('extract')
+    def getImage(self, archive):
+        """Path of the sparse decompressed image of a cached archive
+
+        :param archive: Path returned by getArchive
+        """
+        archivesha=Path(archive).name
+        sha=self._index['images'].get(archivesha)
+        if self._has(sha):
+            self._count('hits')
+            self._touch(sha)
+            if self._has(archivesha):
+                self._touch(archivesha)
+            self._saveIndex()
+            return(self.objectPath(sha))
+
+        self._count('misses')
+        incoming=self._tempPath()
+        digest=hashlib.sha256()
+        try:
+            with open(incoming,'wb') as out, progress.bar('extract',label=Path(archive).name[:12]) as bar:
+                writeSparse(out,bar.track(gzipChunks(archive)),digest)
+        except BaseException:
+            os.unlink(incoming)
+            raise
+        sha=digest.hexdigest()
+        path=self._store(incoming,sha,KIND_IMAGE,keep={archivesha})
+        if self._has(archivesha):
+            self._touch(archivesha)
+        self._index['images'][archivesha]=sha
+        self._saveIndex()
+        return(path)
+
+    def getIndex(self, archive):
+        """gzip access point index of a cached archive, built & saved beside it on a miss
+
+        :param archive: Path returned by getArchive
+        :return: gzindex.GzipIndex, None when libz cannot be used to index it
+        """
+        if not gzindex.available():
+            return(None)
+        index=gzindex.GzipIndex.load(archive)
+        if index is not None:
+            return(index)
+        return(gzindex.GzipIndex.build(archive).save())
+
+    def stats(self):
+        """Hit, miss & eviction counters along with current usage"""
+        stats=dict(self._index['stats'])
+        stats['objects']=len(self._index['objects'])
+        stats['usedbytes']=sum(o['size'] for o in self._index['objects'].values())
+        stats['budget']=self.budget
+        return(stats)
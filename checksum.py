@@ -0,0 +1,214 @@
+"""
+Digests computed as bytes flow through the install, and read-back
+verification of what was written.
+
+Each stage hashes the bytes it moves as they pass, so no stage needs a
+pass of its own: downloads as blocks arrive, decompression as chunks come
+out, partition writes as chunks go to the targets. Two digests are
+offered, sha256 to compare with published checksums, and zlib's crc32,
+many times faster, for telling blocks apart.
+
+A BlockDigest keeps a crc32 of every BLOCK_SIZE block of a partition as it
+is written, along with the sha256 of the whole. verify() then reads the
+target back once, sequentially, in large O_DIRECT reads so the page cache
+cannot answer for the disk, and reports the blocks that differ.
+
+    blocks=BlockDigest()
+    fanoutPartition(image,targets,digest=blocks)
+    bad=verify(target,blocks)       # [(block, byte offset)] that differ
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import threading
+import zlib
+import progress
+import tracing
+
+SHA256='sha256'
+CRC32='crc32'
+ALGORITHMS=(SHA256,CRC32)
+
+BLOCK_SIZE=4*pow(2,20)      # Granularity mismatches are reported at
+READ_SIZE=16*pow(2,20)      # Read-back request size
+DIRECT_ALIGN=4096           # O_DIRECT buffer, offset & length alignment
+
+
+class Crc32:
+    """zlib's crc32 behind the interface of hashlib objects"""
+
+    name=CRC32
+    digest_size=4
+
+    def __init__(self, data=b'', value=0):
+        self.value=zlib.crc32(data,value)
+
+    def update(self, data):
+        self.value=zlib.crc32(data,self.value)
+
+    def copy(self):
+        return(Crc32(value=self.value))
+
+    def digest(self):
+        return(self.value.to_bytes(4,'big'))
+
+    def hexdigest(self):
+        return(f'{self.value:08x}')
+
+
+def new(name):
+    """Digest object of algorithm name, one of ALGORITHMS"""
+    if name==CRC32:
+        return(Crc32())
+    return(hashlib.new(name))
+
+
+class OrderedDigest:
+    """Digest of a file written out of order, as chunks of a ranged download
+
+    Chunks are hashed in file order once all those before them are complete,
+    read back from the file while still in the page cache.
+
+    :param fd: File being written, open for reading
+    """
+
+    def __init__(self, fd, size, chunksize, name=SHA256):
+        self.fd=fd
+        self.size=size
+        self.chunksize=chunksize
+        self.digest=new(name)
+        self._complete=set()
+        self._next=0
+        self._lock=threading.Lock()
+
+    def complete(self, n):
+        """Mark chunk n written, hashing every chunk now in order"""
+        with self._lock:
+            self._complete.add(n)
+            while self._next in self._complete:
+                self._complete.discard(self._next)
+                start=self._next*self.chunksize
+                end=min(start+self.chunksize,self.size)
+                while start<end:
+                    data=os.pread(self.fd,min(READ_SIZE,end-start),start)
+                    if not data:
+                        raise EOFError(f'File ends at {start} of {self.size}[B]')
+                    self.digest.update(data)
+                    start+=len(data)
+                self._next+=1
+
+    @property
+    def finished(self):
+        return(self._next*self.chunksize>=self.size)
+
+    def hexdigest(self):
+        if not self.finished:
+            raise ValueError(f'Chunk {self._next} not complete, the digest is partial')
+        return(self.digest.hexdigest())
+
+
+class BlockDigest:
+    """crc32 of each block of a stream, & the sha256 of all of it
+
+    :param blocksize: Bytes per block, a multiple of DIRECT_ALIGN
+    """
+
+    def __init__(self, blocksize=BLOCK_SIZE):
+        self.blocksize=blocksize
+        self.blocks=[]
+        self.size=0
+        self.sha256=hashlib.sha256()
+        self._crc=0
+        self._filled=0          # Bytes of the current block hashed
+
+    def update(self, data):
+        view=memoryview(data)
+        self.sha256.update(view)
+        self.size+=len(view)
+        while view:
+            n=min(self.blocksize-self._filled,len(view))
+            self._crc=zlib.crc32(view[:n],self._crc)
+            self._filled+=n
+            view=view[n:]
+            if self._filled==self.blocksize:
+                self.blocks.append(self._crc)
+                self._crc=0
+                self._filled=0
+
+    def finish(self):
+        """Close the last, partial, block. No more data may follow"""
+        if self._filled:
+            self.blocks.append(self._crc)
+            self._crc=0
+            self._filled=0
+        return(self)
+
+
+def _openDirect(path):
+    """fd of path for reading, O_DIRECT where the filesystem allows it
+
+    :return: (fd, direct)
+    """
+    try:
+        return(os.open(path,os.O_RDONLY|os.O_DIRECT),True)
+    except OSError as e:
+        if e.errno!=errno.EINVAL:
+            raise
+    fd=os.open(path,os.O_RDONLY)
+    return(fd,False)
+
+
+@tracing.traced('verify')
+def verify(path, blocks:BlockDigest, offset=0, readsize=READ_SIZE):
+    """Read blocks.size bytes of path back from offset, comparing each block with blocks
+
+    :param offset: Byte offset of the data in path, a multiple of DIRECT_ALIGN
+    :return: [(block number, byte offset in path)] of the blocks that differ,
+        empty when all match
+    """
+    readsize=max(readsize//blocks.blocksize,1)*blocks.blocksize
+    fd,direct=_openDirect(path)
+    # mmap memory is page aligned, as O_DIRECT wants
+    buffer=mmap.mmap(-1,readsize)
+    view=memoryview(buffer)
+    mismatched=[]
+    try:
+        with progress.bar('verify',blocks.size,label=str(path)) as bar:
+            position=0
+            while position<blocks.size:
+                want=min(readsize,blocks.size-position)
+                # Direct reads must be whole aligned units, even past the end of the data
+                length=-(-want//DIRECT_ALIGN)*DIRECT_ALIGN if direct else want
+                try:
+                    n=os.preadv(fd,[view[:length]],offset+position)
+                except OSError as e:
+                    if not direct or e.errno!=errno.EINVAL:
+                        raise
+                    # Device or filesystem refused this read direct, carry on through the page cache
+                    os.close(fd)
+                    fd=os.open(path,os.O_RDONLY)
+                    direct=False
+                    continue
+                if n<want:
+                    # Compare whole blocks only, the rest is read again
+                    n-=n%blocks.blocksize
+                n=min(n,want)
+                if n==0:
+                    raise EOFError(f'{path} ends {blocks.size-position}[B] short of the data written')
+                for start in range(0,n,blocks.blocksize):
+                    block=(position+start)//blocks.blocksize
+                    end=min(start+blocks.blocksize,n)
+                    if zlib.crc32(view[start:end])!=blocks.blocks[block]:
+                        mismatched.append((block,offset+position+start))
+                position+=n
+                bar.add(n)
+                if not direct:
+                    # Keep read back data from pushing everything else out of the cache
+                    os.posix_fadvise(fd,offset,position,os.POSIX_FADV_DONTNEED)
+    finally:
+        view.release()
+        buffer.close()
+        os.close(fd)
+    return(mismatched)
@@ -20,12 +20,14 @@ config = {
                     'fslabel':'oe_system_root',
                     'partitionlabel':'oe_root',
                     'fstype':'ext4',
+                    'profile':'fast',
                     },
                 'data':{
                     'size':12*1024,
                     'fslabel':'oe_data',
                     'partitionlabel':'oe_data',
                     'fstype':'ext4',
+                    'profile':'media',
                     },
                 },
             },
@@ -46,12 +48,14 @@ config = {
                     'fslabel':'lakka_system_root',
                     'partitionlabel':'lakka_root',
                     'fstype':'ext4',
+                    'profile':'fast',
                     },
                 'data':{
                     'size':36*1024,
                     'fslabel':'lakka_data',
                     'partitionlabel':'lakka_data',
                     'fstype':'ext4',
+                    'profile':'media',
                     },
                 },
             }
@@ -59,3 +63,22 @@ config = {
     }   
 
 ROOT=Path(__file__).parent
+config['cache']={
+    'path':Path(ROOT,'cache'),
+    'budget':16*pow(2,30),  # Bytes allocated on disk, sparse images count their data only
+    'images':False,         # Stream installs also keep the decompressed image, so repeats skip gunzip at the cost of a pass to disk first
+    'probes':Path(ROOT,'cache','probes.json'),  # Disk probe results kept between runs, see probecache. None to always probe
+    }
+config['mkfs']={
+    'workers':4,            # Partitions formatted at once
+    'profiles':{            # mke2fs options by name, see mkfs.py
+        'fast':{
+            'extended':['lazy_itable_init=1','lazy_journal_init=1','nodiscard'],
+            },
+        'media':{           # Few, large files
+            'extended':['lazy_itable_init=1','lazy_journal_init=1','nodiscard'],
+            'inoderatio':4*pow(2,20),
+            'reserved':0,
+            },
+        },
+    }
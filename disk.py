@@ -1,9 +1,16 @@
 from collections import defaultdict as dd
-import re
-import ast
-import tempfile
+import os
+import uuid
 from pathlib import Path
-from util import bash,getDictionaryFromKeyValueString,userConfirm
+from util import userConfirm
+from probe import probeDisk,partitionNode
+from extent import FreeExtents,FIT_FIRST
+import tracing
+from gpt import GptTable,GptEntry,attrsFromString,isRegularFile
+import executor as executors
+import probecache
+from mount import MountManager
+from mkfs import MkfsScheduler,profileOptions
 
 """
 @TODO:
@@ -13,15 +20,19 @@ Make fs before attempting to mount
 
 
 class PartitionTable:
-    def __init__(self, disk):
+    def __init__(self, disk, native=None):
+        '''
+        :param native: Read & write the table with the in process gpt engine
+            rather than sfdisk. Defaults to True for disk image files. Only
+            possible with a local executor
+        '''
         self.disk=disk
+        self.executor=disk.executor
+        self.native=disk.isimage if native is None else native and self.executor.local
 
         self.partitiondata={}
         self._data={}
-        self._updatePartitionTableData()
-        
-        self.uuid=self._data['blkid']['PTUUID']
-        self.type=self._data['blkid']['PTTYPE']
+        self._updatePartitionTableData(cached=True)
 
         
     def __str__(self):
@@ -30,60 +41,50 @@ class PartitionTable:
             s+=str(p)
         return(s)
 
-    def _updatePartitionTableData(self):
-        """Use sfdisk, parted and blkid to read partition table information from disk"""
+    @tracing.traced('probe')
+    def _updatePartitionTableData(self, cached=False):
+        """Read partition table information from disk in a single probe
+
+        :param cached: Take the probe of an earlier run when the disk is
+            unchanged since. Fresh probes are always kept for later runs.
+            Probes that are not cached follow a write, so wait for udev to
+            settle first where the probe reads its database
+        :seealso: probe.probeDisk, probecache
+        """
         if self.disk is None:
             raise ValueError("Disk must be set to read partition table")
 
-        self._data['sfdisk']=\
-            ast.literal_eval(bash(f'sudo sfdisk -l -J {self.disk.device}').stdout)
-        self._data['parted']=\
-            list(map(
-                lambda x:x.rstrip(';').split(':'),
-                    filter(
-                        lambda x:re.match('[0-9]',x) is not None,
-                        bash(f'sudo parted -m {self.disk.device} unit s print')
-                            .stdout
-                            .splitlines()
-                        )
-                    ))
-        self._data['blkid']=getDictionaryFromKeyValueString(\
-            bash(f'sudo blkid -o export {self.disk.device}').stdout)
-
-        self.firstlba=self._data['sfdisk']['partitiontable']['firstlba']
-        self.lastlba=self._data['sfdisk']['partitiontable']['lastlba']
-        self.bytessector=self._data['sfdisk']['partitiontable']['sectorsize']
-
-        def _collatePartitionData(sfdiskData):
-
-            device = Path(sfdiskData['node'])
-            blkidData=getDictionaryFromKeyValueString(\
-                bash(f'sudo blkid -o export {device}').stdout)
-
-            start = int(sfdiskData['start'])
-
-            partedData = list(filter(lambda x: int(x[1].rstrip('s'))==start, self._data['parted'])).pop()
-            data={
-                'device':device,
-                'startsector':start,
-                'endsector':int(partedData[2].rstrip('s')),
-                'sectorcount':int(sfdiskData['size']),
-                'fstype':partedData[4],
-                'fslabel':blkidData['LABEL'],
-                'fsuuid':blkidData['UUID'],
-                'partlabel':sfdiskData['name'],
-                'partuuid':sfdiskData['uuid'],
-                'partflag':partedData[6],
-                'partnbr':int(partedData[0])
-            }
-            self.partitiondata[device]=data                 #By device
-            self.partitiondata[sfdiskData['name']]=data
-            self.partitiondata[sfdiskData['uuid']]=data     #By uuid
-            self.partitiondata[blkidData['UUID']]=data     #By fsuuid
-            
-        if 'partitions' in self._data['sfdisk']['partitiontable']:
-            [_collatePartitionData(d) for d in self._data['sfdisk']['partitiontable']['partitions']]
+        # Identity taken first, a change made while probing shows as a different disk next time
+        probes=self.disk.probes
+        identity=probes.identity(self.disk.device,self.executor)
+        section='nativeprobe' if self.native else 'probe'
+        self._data=probes.get(identity,section) if cached else None
+        if self._data is None:
+            if not cached and not self.native:
+                # udev may still hold the filesystems of before a write just made
+                self.executor.run('udevadm settle',check=False)
+            self._data=probeDisk(self.disk.device,native=self.native,executor=self.executor)
+            probes.put(identity,section,self._data)
+        else:
+            for data in self._data['partitions']:
+                data['device']=Path(data['device'])
+
+        table=self._data['table']
+        self.uuid=table['uuid']
+        self.type=table['type']
+        self.firstlba=table['firstlba']
+        self.lastlba=table['lastlba']
+        self.bytessector=table['sectorsize']
 
+        self.partitiondata={}
+        for data in self._data['partitions']:
+            self.partitiondata[data['device']]=data         #By device
+            self.partitiondata[data['partlabel']]=data
+            self.partitiondata[data['partuuid']]=data       #By uuid
+            if data['fsuuid'] is not None:
+                self.partitiondata[data['fsuuid']]=data     #By fsuuid
+
+        self._updateFreeExtents()
         self._updatePartitions()
 
     def _updatePartitions(self):
@@ -91,77 +92,36 @@ class PartitionTable:
         self._partitions=set([Partition(self,Path(x)) for x in self._listDevices()])
 
     def _listDevices(self):
-        if not 'partitions' in self._data['sfdisk']['partitiontable']:
-            return([])
-        return([n['node'] for n in self._data['sfdisk']['partitiontable']['partitions']])
-
-    def _getNextFreeSectorBlock(self, after=None):
-        """Returns the next free contiguous set of usable adresses [start,end]
-        
-        :param after: Find chunk starting on this sector or after
-        :return:(None,None) if not found, else (start, end)
-        """
+        return([p['device'] for p in self._data['partitions']])
 
-        if(after is None):after=self.firstlba
-        after=self.disk.alignStartSector(after)
+    def _updateFreeExtents(self):
+        """Index free space between the partitions currently in the table"""
+        alignment=Disk.ALIGNMENT_OFFSET*pow(2,20)//self.bytessector
+        self.freeextents=FreeExtents(self.firstlba,self.lastlba,alignment)
+        for p in self._data['partitions']:
+            self.freeextents.allocate(p['startsector'],p['endsector'])
 
-        end=set()
-        [end.add(x.endsector) for x in self._partitions]
-        
-        # Ending at beginning of disk for initial partition
-        # Only want aligned start sectors orthis algo wont work
-        end.add(self.disk.alignStartSector(self.firstlba)-1)
+    def sectorsFor(self, size):
+        """Sectors needed to hold size MiB"""
+        bytesize=size*pow(2,20)
+        return(bytesize//self.bytessector + bool(bytesize%self.bytessector))
 
-        orderedEnd=list(end)
-        orderedEnd.sort()
-        
-        start=set()
-        [start.add(x.startsector) for x in self._partitions]
-        orderedStart=list(start)
-        orderedStart.sort()
-        
-        def _findNextStart(onOrAfter):
-            if(len(start)==0):
-                return(self.lastlba)
-
-            for s in orderedStart:
-                if s>=onOrAfter:
-                    return(s)
-                
-            return(self.lastlba)
-
-        for e in orderedEnd:
-            if not e+1 in start and (e+1) >= after:
-                if e+1<self.lastlba:
-                    return((e+1, _findNextStart(e+1)-1))
-                
-        return((None,None))
- 
-    def _findSpace(self,size, after=None):
+    def _findSpace(self, size, fit=FIT_FIRST, within=None, freeextents=None):
         """Find space for a partition of size
         
-        :param after: Find space starting after or on this sector
-        :param before: Find space on or before this sector
         :param size: size in MiB
+        :param fit: FIT_FIRST for the lowest free address, FIT_BEST for the
+            smallest free extent the partition fits in
+        :param within: Partition must end within this many MiB of the start of disk
+        :param freeextents: Search these rather than the tables current free space
+        :return: (startsector, endsector)
         """
-        if after is None:
-            after=self.firstlba
-
-        bytesize=size*pow(2,20)
-        startsector,maxendsector=self._getNextFreeSectorBlock(after)
-
+        if freeextents is None:
+            freeextents=self.freeextents
+        before=None if within is None else within*pow(2,20)//self.bytessector-1
+        startsector,endsector=freeextents.find(self.sectorsFor(size),fit,before)
         if startsector is None:
             raise ValueError(f"Cant find space for a partition fo {size}MiB on {self.disk}")
-
-        lengthInSectors=bytesize//self.bytessector + bool(bytesize%self.bytessector)
-
-        # Align sectors to physical block
-        startsector=self.disk.alignStartSector(startsector)
-        endsector=startsector+lengthInSectors-1
-
-        if endsector > maxendsector:
-            return(self._findSpace(size,after=maxendsector))
-
         return(startsector, endsector)
 
     def getPartitionBy(self,idvalue,identifier='partuuid'):
@@ -170,9 +130,14 @@ class PartitionTable:
                 return p
         return(None)
 
+    def newLayout(self):
+        """Start planning changes to this table. See PartitionLayout"""
+        return(PartitionLayout(self))
+
     def rmPartition(self,partition:'Partition'):
-        bash(f'sudo parted {self.disk.device} rm {partition.partnbr}')
-        self._updatePartitionTableData()
+        layout=self.newLayout()
+        layout.remove(partition.partuuid)
+        layout.commit()
 
     def addPartition(self, size, partitionlabel, keep=False,fslabel=None,fstype='', partitionflag=[]):
         """Add a partition of given size in MiB to partition table
@@ -182,43 +147,203 @@ class PartitionTable:
         Where the partition size differs, the partition with the given partition label
         will be deleted and recreated at the appropriate size.
 
+        To add several partitions in a single table write, use newLayout()
+
         :param: keep - when True, if the partition with given label exists keep it
         :return: uuid of existing or created partition
         """
-        if not self.disk.confirmedAsExpectedDisk:
-            self.disk.confirmExpectedDisk()
-        
-        existingPartition=self.getPartitionBy(partitionlabel, 'partlabel')
-        if not existingPartition is None:
-            if existingPartition.mibsize == size and keep:
-                if fstype=='' or fstype==existingPartition.fstype:
-                    return(existingPartition.partuuid)
-            # Replacing 
-            self.rmPartition(existingPartition)
-            existingPartition=None
-            
-        currentDevices=set(self._listDevices())
-        startsector,endsector=self._findSpace(size)
-        bash(f'sudo parted {self.disk.device} mkpart {partitionlabel} {fstype} {startsector}s {endsector}s')
-       
-        self._updatePartitionTableData()
-        newDevice=set(self._listDevices())-currentDevices
-        print(f'Making partition {partitionlabel} on {self.disk.device}')
-        if(len(newDevice))==0:
-            raise OSError(f'Partition {partitionlabel} could not be created on {self.disk.device}')
+        layout=self.newLayout()
+        partuuid=layout.add(size,partitionlabel,keep=keep,fslabel=fslabel,fstype=fstype,partitionflag=partitionflag)
+        layout.commit()
+        return(partuuid)
 
-        newDevice=Path(newDevice.pop())
 
-        newPartition=self.getPartitionBy(newDevice,'device')
+class PartitionLayout:
+    """Partition table changes planned in memory and written in one transaction
 
-        for flag in partitionflag:
-            bash(f'sudo parted {self.disk.device} set {newPartition.partnbr} {flag} on')
+    Sectors for every added partition are resolved against the table as planned
+    so far. commit() hands sfdisk a script describing the complete table, which
+    it validates in full before writing anything, so a bad plan leaves the
+    table on disk untouched. New partitions are then formatted and commit
+    callbacks run.
+    """
 
-        print('Partition table written. Checking alignment')
-        print(bash(f'sudo parted {self.disk.device} align-check optimal {newPartition.partnbr}').stdout)
-        
-        newPartition.mkfs(fstype, fslabel)
-        return(newPartition.partuuid)
+    SFDISK_TYPE_LINUX='0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+    SFDISK_TYPE_BIOSBOOT='21686148-6449-6E6F-744E-656564454649'
+
+    # Parted partition flags, as sfdisk partition types or attributes
+    FLAG_TYPE={'bios_grub':SFDISK_TYPE_BIOSBOOT}
+    FLAG_ATTRS={'boot':'LegacyBIOSBootable','legacy_boot':'LegacyBIOSBootable'}
+
+    def __init__(self, table:PartitionTable):
+        self.table=table
+        self.disk=table.disk
+        self.entries=[]
+        self.created=[]
+        self.kept=[]        # uuids of existing partitions add() kept
+        self.changed=False
+        self.doOnCommit=[]
+        self.freeextents=table.freeextents.copy()
+
+        for p in table._data['partitions']:
+            self.entries.append({
+                'partnbr':p['partnbr'],
+                'start':p['startsector'],
+                'size':p['sectorcount'],
+                'type':p['parttype'] or PartitionLayout.SFDISK_TYPE_LINUX,
+                'uuid':p['partuuid'],
+                'name':p['partlabel'],
+                'attrs':p['partattrs'],
+                'fstype':p['fstype'],
+            })
+
+    def __str__(self):
+        return(self.script())
+
+    def _removeEntry(self, entry):
+        self.entries.remove(entry)
+        self.freeextents.release(entry['start'],entry['start']+entry['size']-1)
+
+    def _getEntry(self, value, key):
+        return(next(filter(lambda e:e[key]==value,self.entries),None))
+
+    def _nextPartnbr(self):
+        """Lowest unused partition number"""
+        used=set([e['partnbr'] for e in self.entries])
+        n=1
+        while n in used:
+            n+=1
+        return(n)
+
+    def add(self, size, partitionlabel, keep=False, fslabel=None, fstype='', partitionflag=[], fit=FIT_FIRST, within=None, profile=None):
+        """Plan a partition of given size in MiB. See PartitionTable.addPartition
+
+        :param fit, within: Placement. See PartitionTable._findSpace
+        :param profile: Format profile of the new filesystem. See mkfs.py
+        :return: uuid the partition will have once committed
+        """
+        existing=self._getEntry(partitionlabel,'name')
+        if existing is not None:
+            mibsize=existing['size']*self.table.bytessector/pow(2,20)
+            if mibsize==size and keep:
+                if fstype=='' or fstype==existing['fstype']:
+                    self.kept.append(existing['uuid'])
+                    return(existing['uuid'])
+            # Replacing
+            self._removeEntry(existing)
+
+        start,end=self.table._findSpace(size,fit,within,self.freeextents)
+        self.freeextents.allocate(start,end)
+        attrs=[PartitionLayout.FLAG_ATTRS[f] for f in partitionflag if f in PartitionLayout.FLAG_ATTRS]
+        entry={
+            'partnbr':self._nextPartnbr(),
+            'start':start,
+            'size':end-start+1,
+            'type':PartitionLayout.SFDISK_TYPE_LINUX,
+            'uuid':str(uuid.uuid4()).upper(),
+            'name':partitionlabel,
+            'attrs':' '.join(attrs) if attrs else None,
+            'fstype':fstype,
+        }
+        for flag in partitionflag:
+            entry['type']=PartitionLayout.FLAG_TYPE.get(flag,entry['type'])
+
+        self.entries.append(entry)
+        self.created.append({'uuid':entry['uuid'],'fstype':fstype,'fslabel':fslabel,'profile':profile})
+        self.changed=True
+        return(entry['uuid'])
+
+    def remove(self, partuuid):
+        """Plan removal of the partition with given uuid"""
+        existing=self._getEntry(partuuid,'uuid')
+        if existing is None:
+            raise ValueError(f'No partition {partuuid} on {self.disk.device}')
+        self._removeEntry(existing)
+        self.created=[c for c in self.created if c['uuid']!=partuuid]
+        self.changed=True
+
+    def onCommit(self, fn):
+        """Adds a callback to be run once the table is written and partitions formatted"""
+        self.doOnCommit.append(fn)
+
+    def script(self):
+        """sfdisk script describing the whole planned table"""
+        self._checkTableType()
+        lines=['label: gpt']
+        if self.table.uuid:
+            lines.append(f'label-id: {self.table.uuid}')
+        lines.extend(['unit: sectors',''])
+        for e in sorted(self.entries,key=lambda e:e['start']):
+            fields=[f"start={e['start']}",f"size={e['size']}",f"type={e['type']}"]
+            if e['uuid']:
+                fields.append(f"uuid={e['uuid']}")
+            if e['name']:
+                fields.append(f'name="{e["name"]}"')
+            if e['attrs']:
+                fields.append(f'attrs="{e["attrs"]}"')
+            lines.append(f"{partitionNode(self.disk.device,e['partnbr'])} : {', '.join(fields)}")
+        return('\n'.join(lines)+'\n')
+
+    def _checkTableType(self):
+        """Disks without a table get a new gpt, other table types are not handled"""
+        if self.table.type not in ('gpt',None):
+            raise ValueError(f'Only gpt partition tables can be planned, {self.disk.device} has {self.table.type}')
+
+    def _writeSfdisk(self):
+        self.table.executor.run(f'sudo sfdisk -q {self.disk.device}',input=self.script().encode())
+
+    def _writeNative(self):
+        """Write the table in process. Validated in full before anything is written"""
+        self._checkTableType()
+        if self.table.type is None:
+            table=GptTable.create(self.disk.device,self.table.bytessector)
+        else:
+            table=GptTable.read(self.disk.device,self.table.bytessector)
+        table.entries=[None]*table.entrycount
+        for e in self.entries:
+            table.setEntry(e['partnbr'],GptEntry(e['type'],e['uuid'],
+                e['start'],e['start']+e['size']-1,attrsFromString(e['attrs']),e['name']))
+        table.write()
+
+        # Kernel keeps its own copy of a block devices table
+        if not self.disk.isimage:
+            for action in ('-d','-a','-u'):
+                self.table.executor.run(f'sudo partx {action} {self.disk.device}',check=False)
+            self.table.executor.run('udevadm settle',check=False)
+
+    @tracing.traced('partition')
+    def commit(self):
+        """Write the planned table, format new partitions and run commit callbacks"""
+        if self.changed:
+            if not self.disk.confirmedAsExpectedDisk:
+                self.disk.confirmExpectedDisk()
+
+            print(f'Writing partition table to {self.disk.device}')
+            self.disk.probes.invalidate(self.disk.device)
+            if self.table.native:
+                self._writeNative()
+            else:
+                self._writeSfdisk()
+            self.table._updatePartitionTableData()
+
+            # New partitions are independent, format them all at once
+            scheduler=MkfsScheduler()
+            for c in self.created:
+                partition=self.table.getPartitionBy(c['uuid'])
+                if partition is None:
+                    raise OSError(f"Partition {c['uuid']} could not be created on {self.disk.device}")
+                scheduler.add(partition,c['fstype'],c['fslabel'],c['profile'])
+            scheduler.run()
+
+            # Pick up filesystem uuids & labels made by mkfs
+            if self.created:
+                self.table._updatePartitionTableData()
+
+        self.changed=False
+        self.created=[]
+        for f in self.doOnCommit:
+            f()
+        self.doOnCommit=[]
 
 class Partition:
     
@@ -226,39 +351,9 @@ class Partition:
     PARTED_PARTTYPE_BIOSBOOT='ef02'
 
     MKFS_FSTYPE=['ext4'] #mkfs for all these partitions
+    GROW_FSTYPE=['ext2','ext3','ext4'] #resize2fs can grow these
     DEFAULT_FSTYPE='ext4'
     
-    class Mountpoint:
-
-        SYSTEM_MOUNTS = '/proc/mounts'
-
-        def __init__(self, partition):
-            """
-            :sideeffect: Creates tempdir and mounts parititon there if not 
-                already mounted. This will be cleaned up on object.__del__()
-            """
-
-            #Check false for if grep finds nothing
-            mountsline=bash(f'cat {Partition.Mountpoint.SYSTEM_MOUNTS} | grep {partition.device}',check=False)
-
-            if mountsline.returncode == 0:
-                mountinfo=mountsline.stdout.split()
-                self.mountpoint=Path(mountinfo[1])
-                self.mountoptions=mountinfo[3]
-            else:
-                self.tempmount=Path(tempfile.mkdtemp())
-                self.mountpoint=self.tempmount
-                bash(f'sudo mount {partition.device} {self.mountpoint}')
-                
-        def __str__(self):
-            return(str(self.mountpoint))
-
-        def __del__(self):
-            '''Unmounts and deletes any temporary mountpoint that exists for ptn'''
-            if hasattr(self,'mountpoint'):
-                bash(f'sudo umount {self.mountpoint}')
-                bash(f'rmdir {self.mountpoint}')
-        
     def __str__(self):
         return(f'{self.mountpoint} {self.partlabel} {self.fstype} {self.mountpoint} {self.mibsize}[MiB]')
 
@@ -276,30 +371,85 @@ class Partition:
             setattr(self,k,v)
         self.bytesize=self.sectorcount*self.table.bytessector
         self.mibsize= self.bytesize / pow(2,20)
-
-    def mkfs(self,typevalue,label):
+        # Partitions of image files are named like those of a block device, but
+        # have no device node. Their bytes are a range of the image file
+        if table.disk.isimage:
+            self.backing=Path(table.disk.device)
+            self.offset=self.startsector*self.table.bytessector
+        else:
+            self.backing=Path(self.device)
+            self.offset=0
+
+    @tracing.traced('mkfs')
+    def mkfs(self,typevalue,label,profile=None):
         """Format partition filesystem and run pending callbacks
+        :param profile: Name of format profile in config['mkfs']['profiles']
         :note: Only fs types in Disk.Partition.MKFS_FSTYPE will be
             prepared
         """
         if typevalue in Partition.MKFS_FSTYPE:
             self.fslabel=label
+            self.table.disk.probes.invalidate(self.table.disk.device)
             print(f'Building {typevalue} filesystem on {self.device}')
-            bash(f'sudo mkfs -t {typevalue} -L {self.fslabel} {self.device}')
+            labelopt=['-L',self.fslabel] if self.fslabel else []
+            if self.table.disk.isimage:
+                # Partition of an image file, mke2fs writes at an offset into it
+                args=['-q','-F']+labelopt+profileOptions(typevalue,profile,[f'offset={self.offset}'])
+                self.table.executor.run(f"mkfs -t {typevalue} {' '.join(args)} {self.backing} {self.bytesize//1024}k")
+            else:
+                args=labelopt+profileOptions(typevalue,profile)
+                self.table.executor.run(f"sudo mkfs -t {typevalue} {' '.join(args+[str(self.device)])}")
             for f in self.doonmkfs:
                 f()
         
+    @tracing.traced('resize')
+    def growFilesystem(self):
+        """Grow the filesystem to fill the partition, eg once a smaller one was cloned to it
+
+        :return: False for filesystems that are not grown, see GROW_FSTYPE
+        """
+        if self.fstype not in Partition.GROW_FSTYPE:
+            return(False)
+        print(f'Growing {self.fstype} filesystem on {self.device} to {self.mibsize}[MiB]')
+        device=self.device
+        if self.table.disk.isimage:
+            device=self.table.executor.run(f'sudo losetup --find --show -o {self.offset} --sizelimit {self.bytesize} {self.backing}').stdout.strip()
+        try:
+            # resize2fs wants a freshly checked filesystem. 1 is errors corrected
+            check=self.table.executor.run(f'sudo e2fsck -f -p {device}',check=False)
+            if check.returncode>1:
+                raise OSError(f'e2fsck of {self.device} failed with {check.returncode}: {check.stderr}')
+            self.table.executor.run(f'sudo resize2fs {device}')
+        finally:
+            if device!=self.device:
+                self.table.executor.run(f'sudo losetup -d {device}')
+        return(True)
+
     def onmkfs(self, fn):
         """Adds a callback to be run once the filesystem has been prepared
         """
         self.doonmkfs.append(fn)
 
     def getMountpoint(self):
-        if not self.mountpoint is None:
-            return(self.mountpoint)
+        """Mount of the partition, mounted on first use and shared with any
+        existing mount of it. Unmounted by Disk.close()
 
-        self.mountpoint=Partition.Mountpoint(self)
-        return(self.getMountpoint())
+        :return: mount.Mount
+        """
+        if self.mountpoint is None:
+            disk=self.table.disk
+            if disk.isimage:
+                # Partition of an image file, loop mounted at its offset
+                self.mountpoint=disk.mounts.mount(self.backing,f'loop,offset={self.offset},sizelimit={self.bytesize}')
+            else:
+                self.mountpoint=disk.mounts.mount(self.device)
+        return(self.mountpoint)
+
+    def releaseMountpoint(self):
+        """Drop the mount taken by getMountpoint, unmounting it unless used elsewhere"""
+        if self.mountpoint is not None:
+            self.mountpoint.release()
+            self.mountpoint=None
 
 
 class Disk:
@@ -313,17 +463,49 @@ class Disk:
     def __str__(self):
         return(f'{self.device} {self.GiBcount}[GiB]')
 
-    def __init__(self, devicepath):
+    def __init__(self, devicepath, native=None, executor=None, probes=None):
+        '''
+        :param devicepath: Block device, or a disk image file
+        :param native: See PartitionTable
+        :param executor: Runs external commands for the disk, its table and
+            partitions. Defaults to executor.ShellExecutor. See executor
+        :param probes: Probe results kept between runs. Defaults to
+            probecache.DEFAULT. See probecache
+        '''
         
         self.device=devicepath
-        self.partitiontable=PartitionTable(self)
+        self.executor=executor or executors.DEFAULT
+        self.probes=probes or probecache.DEFAULT
+        self.mounts=MountManager(self.executor)
+        self.isimage=self.executor.local and isRegularFile(self.device)
+        self.partitiontable=PartitionTable(self,native)
         self.alignmentoffset=Disk.ALIGNMENT_OFFSET
-        self.confirmedAsExpectedDisk=False
-        self.bytecount=int(bash(f'sudo blockdev --getsize64 {self.device}').stdout)
+        # Image files, and disks commands are not run on, cannot be mistaken for somebody elses disk
+        self.confirmedAsExpectedDisk=self.isimage or not self.executor.local
+        if self.isimage:
+            self.bytecount=os.stat(self.device).st_size
+            self.bytessector=self.partitiontable.bytessector
+        else:
+            identity=self.probes.identity(self.device,self.executor)
+            sizes=self.probes.get(identity,'blockdev')
+            if sizes is None:
+                sizes=[int(self.executor.run(f'sudo blockdev --getsize64 {self.device}').stdout),
+                       int(self.executor.run(f'sudo blockdev --getpbsz {self.device}').stdout)]
+                self.probes.put(identity,'blockdev',sizes)
+            self.bytecount,self.bytessector=sizes
         self.GiBcount=int(self.bytecount/(pow(2,30)))
-        self.bytessector=int(bash(f'sudo blockdev --getpbsz {self.device}').stdout)
         self.sectorcount=self.bytecount/self.bytessector
        
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmount partitions mounted through getMountpoint"""
+        self.mounts.close()
+
     def _data(self):
         _data=dd(lambda:'')
         for k,v in self.__dict__.items():
@@ -335,7 +517,7 @@ class Disk:
         """Given a sector to start with, make sure it is aligned on an alignment boundary
         :return: Start adjusted upward to alignment boundary if not on one
         """
-        sectorsPerBoundary = pow(2,20)/self.bytessector
+        sectorsPerBoundary = Disk.ALIGNMENT_OFFSET*pow(2,20)//self.bytessector
         if (start % sectorsPerBoundary)==0:
             return(start)
         
@@ -343,12 +525,19 @@ class Disk:
         return((wholeSectorsToStart+1)*sectorsPerBoundary)
 
     def confirmExpectedDisk(self): 
+        if self.partitiontable.native:
+            print(self)
+            print(self.partitiontable)
+            userConfirm('Is this the right disk? Y|N')
+            self.confirmedAsExpectedDisk=True
+            return
+
         print('Is this disk the right disk?')
-        print(bash(f'sudo sfdisk -l {self.device}').stdout)
+        print(self.executor.run(f'sudo sfdisk -l {self.device}').stdout)
         userConfirm('Is this the right disk? Y|N')
 
         print('Disk has the following partitions, confirm each one')
-        print(bash(f'sudo parted -l {self.device}').stdout)
+        print(self.executor.run(f'sudo parted -l {self.device}').stdout)
         #userConfirm('Are these the right partitions? Y|N')
         print('Disk now cleared to be have its partition table modified.')
         self.confirmedAsExpectedDisk=True
@@ -0,0 +1,183 @@
+"""
+Resumable, parallel http downloads.
+
+Where the server supports Range requests, the file is split into fixed size
+chunks fetched concurrently straight into their offset of a preallocated
+.part file. Finished chunks are recorded in a .part.json state file so an
+interrupted download picks up where it stopped. Otherwise a single stream is
+used. Memory use is bounded by BLOCK_SIZE per connection either way.
+
+The sha256 of the file is computed as it arrives, chunks of a ranged
+download in order as they complete, so it needs no pass of its own.
+"""
+
+import json
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import checksum
+import progress
+import tracing
+
+CONNECTIONS=4
+CHUNK_SIZE=8*pow(2,20)
+BLOCK_SIZE=256*pow(2,10)
+TIMEOUT=30
+
+PART_SUFFIX='.part'
+STATE_SUFFIX='.part.json'
+
+
+def _probe(url):
+    """Find size, range support & validators of a remote file
+
+    :return: (size or None, supportsRanges, {'etag','lastmodified'})
+    """
+    request=urllib.request.Request(url,headers={'Range':'bytes=0-0'})
+    with urllib.request.urlopen(request,timeout=TIMEOUT) as resp:
+        validators={
+            'etag':resp.getheader('ETag'),
+            'lastmodified':resp.getheader('Last-Modified'),
+        }
+        contentrange=resp.getheader('Content-Range')
+        if resp.status==206 and contentrange is not None:
+            match=re.fullmatch(r'bytes\s+\d+-\d+/(\d+)',contentrange.strip())
+            if match is not None:
+                return(int(match.group(1)),True,validators)
+        length=resp.getheader('Content-Length')
+        return(int(length) if length is not None else None,False,validators)
+
+
+class Download:
+    """Download of url to target, resumable across runs
+
+    :param url: http(s) url of file
+    :param target: File to write. Not created until the download completes
+    :param connections: Number of concurrent range requests
+    :param chunksize: Bytes per range request, the unit of resumption
+    """
+
+    def __init__(self, url, target, connections=CONNECTIONS, chunksize=CHUNK_SIZE, showProgress=True):
+        self.url=url
+        self.target=Path(target)
+        self.part=Path(f'{self.target}{PART_SUFFIX}')
+        self.statefile=Path(f'{self.target}{STATE_SUFFIX}')
+        self.connections=connections
+        self.chunksize=chunksize
+        self.showProgress=showProgress
+        self._lock=threading.Lock()
+        self.state=None
+        self.sha256=None        # Hex digest of the file, once downloaded
+
+    def _loadState(self, size, validators):
+        """Resume from state on disk when it describes this same remote file"""
+        fresh={
+            'url':self.url,
+            'size':size,
+            'chunksize':self.chunksize,
+            'validators':validators,
+            'done':[],
+        }
+        if not self.statefile.exists() or not self.part.exists():
+            return(fresh)
+        try:
+            state=json.loads(self.statefile.read_text())
+        except ValueError:
+            return(fresh)
+        same=all(state.get(k)==fresh[k] for k in ('url','size','chunksize','validators'))
+        return(state if same else fresh)
+
+    def _saveState(self):
+        temp=Path(f'{self.statefile}.tmp')
+        temp.write_text(json.dumps(self.state))
+        os.replace(temp,self.statefile)
+
+    def _chunks(self):
+        size=self.state['size']
+        count=(size+self.chunksize-1)//self.chunksize
+        done=set(self.state['done'])
+        return([n for n in range(count) if n not in done])
+
+    def _bar(self, size, done=0):
+        return(progress.bar('download',size,label=self.target.name,done=done,show=self.showProgress))
+
+    def _fetchChunk(self, fd, n, bar, digest):
+        start=n*self.chunksize
+        end=min(start+self.chunksize,self.state['size'])-1
+        request=urllib.request.Request(self.url,headers={'Range':f'bytes={start}-{end}'})
+        with urllib.request.urlopen(request,timeout=TIMEOUT) as resp:
+            if resp.status!=206:
+                raise OSError(f'{self.url} ignored range request for bytes {start}-{end}')
+            offset=start
+            while offset<=end:
+                block=resp.read(min(BLOCK_SIZE,end+1-offset))
+                if not block:
+                    raise EOFError(f'{self.url} ended at {offset} inside chunk {start}-{end}')
+                os.pwrite(fd,block,offset)
+                offset+=len(block)
+                bar.add(len(block))
+        with self._lock:
+            self.state['done'].append(n)
+            self._saveState()
+        digest.complete(n)
+
+    def _rangedDownload(self, size, validators):
+        self.state=self._loadState(size,validators)
+        if not self.state['done']:
+            with open(self.part,'wb') as f:
+                f.truncate(size)
+        self._saveState()
+
+        pending=self._chunks()
+        already=size-sum(min(self.chunksize,size-n*self.chunksize) for n in pending)
+        fd=os.open(self.part,os.O_RDWR)
+        try:
+            # Chunks are hashed in order as they complete, those of an earlier attempt first
+            digest=checksum.OrderedDigest(fd,size,self.chunksize)
+            [digest.complete(n) for n in self.state['done']]
+            with self._bar(size,already) as bar, ThreadPoolExecutor(max_workers=self.connections) as pool:
+                # Result raises any exception from the worker
+                [f.result() for f in [pool.submit(self._fetchChunk,fd,n,bar,digest) for n in pending]]
+            os.fsync(fd)
+            self.sha256=digest.hexdigest()
+        finally:
+            os.close(fd)
+
+    def _streamDownload(self, size):
+        digest=checksum.new(checksum.SHA256)
+        with self._bar(size) as bar, urllib.request.urlopen(self.url,timeout=TIMEOUT) as resp, open(self.part,'wb') as out:
+            while True:
+                block=resp.read(BLOCK_SIZE)
+                if not block:
+                    break
+                out.write(block)
+                digest.update(block)
+                bar.add(len(block))
+        self.sha256=digest.hexdigest()
+        if size is not None and self.part.stat().st_size!=size:
+            raise EOFError(f'{self.url} ended after {self.part.stat().st_size} of {size}[B]')
+
+    @tracing.traced('download')
+    def run(self):
+        """Download, resuming any previous attempt
+
+        :return: Path of downloaded file
+        """
+        size,ranged,validators=_probe(self.url)
+        if ranged and size:
+            self._rangedDownload(size,validators)
+        else:
+            self._streamDownload(size)
+        os.replace(self.part,self.target)
+        if self.statefile.exists():
+            self.statefile.unlink()
+        return(self.target)
+
+
+def download(url, target, connections=CONNECTIONS, chunksize=CHUNK_SIZE, showProgress=True):
+    """Download url to target file. See Download"""
+    return(Download(url,target,connections,chunksize,showProgress).run())
@@ -0,0 +1,387 @@
+"""
+Command executors for Disk, PartitionTable, Partition & GrubDisk.
+
+Every external command those classes run goes through an executor's run(),
+which takes the same arguments as util.bash and returns the same
+subprocess.CompletedProcess. Swapping the executor lets the orchestration
+run without root or real disks:
+
+ShellExecutor       Runs commands for real, through util.bash. The default
+SimulatedExecutor   Models blockdev, sfdisk, lsblk, mkfs, mount... against
+                    in memory disks
+RecordingExecutor   Runs commands with another executor, saving each result
+ReplayExecutor      Plays back results saved by a RecordingExecutor
+
+Executors with local False do not describe the host, so callers must not
+read sysfs, stat devices and the like behind their back.
+"""
+
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from util import bash,splitPipeline
+import tracing
+
+
+class Executor:
+    local=True
+
+    def run(self, cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+        raise NotImplementedError
+
+    def writeFile(self, path, data:bytes):
+        """Replace the root owned file at path with data, whole or not at all"""
+        self.run(f'sudo tee {path}.tmp',input=data)
+        self.run(f'sudo mv {path}.tmp {path}')
+
+    @staticmethod
+    def _result(args, returncode, stdout, stderr, check, online):
+        """CompletedProcess as util.bash would return it"""
+        if online is not None:
+            [online(line) for line in stdout.splitlines(keepends=True)]
+        result=subprocess.CompletedProcess(args,returncode,stdout,stderr)
+        if check and returncode!=0:
+            raise subprocess.CalledProcessError(returncode,args,stdout,stderr)
+        return(result)
+
+
+class ShellExecutor(Executor):
+    """Runs commands on this host"""
+
+    def run(self, cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+        return(bash(cmd,viashell=viashell,check=check,input=input,online=online))
+
+
+DEFAULT=ShellExecutor()
+
+
+class RecordingExecutor(Executor):
+    """Runs commands with inner, appending each command & result to path as JSON lines"""
+
+    def __init__(self, path, inner=DEFAULT):
+        self.path=Path(path)
+        self.inner=inner
+        self.local=inner.local
+        self._lock=threading.Lock()     # Commands may run concurrently, records must not interleave
+
+    def run(self, cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+        start=time.monotonic()
+        try:
+            result=self.inner.run(cmd,viashell=viashell,check=False,input=input,online=online)
+        finally:
+            seconds=time.monotonic()-start
+        stderr=result.stderr.decode(errors='replace') if isinstance(result.stderr,bytes) else result.stderr
+        with self._lock, open(self.path,'a') as f:
+            f.write(json.dumps({
+                'cmd':cmd,
+                'viashell':viashell,
+                'input':input.decode(errors='replace') if input is not None else None,
+                'returncode':result.returncode,
+                'stdout':result.stdout,
+                'stderr':stderr,
+                'seconds':seconds,
+            })+'\n')
+        return(Executor._result(result.args,result.returncode,result.stdout,result.stderr,check,None))
+
+
+class ReplayExecutor(Executor):
+    """Plays back a RecordingExecutor file
+
+    Each command is answered by the first unused recorded result for the
+    same command, so commands run concurrently may arrive in any order.
+    Recorded commands the replayed run no longer makes, such as the
+    listings shown to confirm a disk, are skipped. Temporary paths are
+    ignored when comparing commands, they differ from run to run. So do the
+    partition uuids in sfdisk scripts: those of the replayed script replace
+    the recorded ones in all later output.
+
+    :param strict: Raise ValueError rather than skip recorded commands
+    """
+    local=False
+
+    TEMP_PATH=re.compile(re.escape(tempfile.gettempdir())+r'/[^\s/]+')
+    UUID=re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+    def __init__(self, path, strict=False):
+        with open(path) as f:
+            self.records=[json.loads(line) for line in f if line.strip()]
+        self.strict=strict
+        self.rewind()
+
+    @property
+    def recordedSeconds(self):
+        """Time the recorded commands took when they ran for real"""
+        return(sum(r['seconds'] for r in self.records))
+
+    def rewind(self):
+        self.position=0     # First unused record
+        self.used=set()
+        self.uuids={}       # recorded: replayed, upper case
+        self._lock=threading.Lock()
+
+    @property
+    def skipped(self):
+        """Recorded commands passed over by later ones"""
+        last=max(self.used,default=-1)
+        return(last+1-len(self.used))
+
+    def _find(self, cmd):
+        key=ReplayExecutor.TEMP_PATH.sub('TMP',cmd)
+        for n in range(self.position,len(self.records)):
+            if n in self.used:
+                continue
+            if ReplayExecutor.TEMP_PATH.sub('TMP',self.records[n]['cmd'])==key:
+                return(n)
+            if self.strict:
+                break
+        raise ValueError(f'No recorded result for {cmd} after command {self.position} of {len(self.records)}')
+
+    def _mapUuids(self, recorded, replayed):
+        recorded=ReplayExecutor.UUID.findall(recorded)
+        replayed=ReplayExecutor.UUID.findall(replayed)
+        if len(recorded)==len(replayed):
+            self.uuids.update({r.upper():p.upper() for r,p in zip(recorded,replayed)})
+
+    def _substitute(self, text):
+        def replace(match):
+            found=self.uuids.get(match.group(0).upper())
+            if found is None:
+                return(match.group(0))
+            return(found if match.group(0).isupper() else found.lower())
+        return(ReplayExecutor.UUID.sub(replace,text) if self.uuids else text)
+
+    def run(self, cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+        with self._lock:
+            n=self._find(cmd)
+            record=self.records[n]
+            self.used.add(n)
+            while self.position in self.used:
+                self.position+=1
+            if input is not None and record.get('input'):
+                self._mapUuids(record['input'],input.decode(errors='replace'))
+            stdout=self._substitute(record['stdout'])
+        with tracing.command([cmd]) as traced:
+            traced['exitcode']=record['returncode']
+            traced['stdoutbytes']=len(stdout)
+        return(Executor._result(cmd,record['returncode'],stdout,record['stderr'].encode(),check,online))
+
+
+class SimulatedDisk:
+    """In memory disk: size, gpt & filesystem signatures only, no data"""
+
+    def __init__(self, device, bytesize, sectorsize=512, physicalsectorsize=512):
+        self.device=str(device)
+        self.bytesize=bytesize
+        self.sectorsize=sectorsize
+        self.physicalsectorsize=physicalsectorsize
+        self.ptuuid=None
+        self.pttype=None
+        self.partitions={}      # partnbr: entry
+
+    @property
+    def sectorcount(self):
+        return(self.bytesize//self.sectorsize)
+
+    def node(self, partnbr):
+        separator='p' if self.device[-1].isdigit() else ''
+        return(f'{self.device}{separator}{partnbr}')
+
+    def byNode(self, node):
+        for n,p in self.partitions.items():
+            if self.node(n)==node:
+                return(p)
+        return(None)
+
+
+class SimulatedExecutor(Executor):
+    """Models the commands disk.py & grub run, against SimulatedDisks
+
+    :param disks: SimulatedDisk or list of them
+    """
+    local=False
+
+    SCRIPT_FIELD=re.compile(r'(\w+)=("[^"]*"|[^,\s]+)')
+    NOOP={'udevadm','partx','grub-install','chmod','cp','mkdir','rmdir','rm','true','e2label','e2fsck','resize2fs'}
+
+    def __init__(self, disks=()):
+        if isinstance(disks,SimulatedDisk):
+            disks=[disks]
+        self.disks={d.device:d for d in disks}
+        self.mounts={}          # device: mountpoint
+        self.commands=[]
+        self.files={}           # path: content, of files written with tee
+
+    def _disk(self, device):
+        if device not in self.disks:
+            raise FileNotFoundError(device)
+        return(self.disks[device])
+
+    def _partition(self, node):
+        for d in self.disks.values():
+            p=d.byNode(node)
+            if p is not None:
+                return(p)
+        raise FileNotFoundError(node)
+
+    def run(self, cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+        self.commands.append(cmd)
+        stages=splitPipeline(cmd)
+        with tracing.command(stages) as traced:
+            stdin=input.decode() if input is not None else ''
+            returncode,stdout,stderr=0,'',''
+            for argv in stages:
+                returncode,stdout,stderr=self._stage(argv,stdin)
+                if returncode!=0:
+                    break
+                stdin=stdout
+            traced['exitcode']=returncode
+            traced['stdoutbytes']=len(stdout)
+        return(Executor._result(stages,returncode,stdout,stderr.encode(),check,online))
+
+    def _stage(self, argv, stdin):
+        """Simulate one command. Returns (returncode, stdout, stderr)"""
+        while argv and argv[0]=='sudo':
+            argv=argv[1:]
+        program=os.path.basename(argv[0])
+        handler=getattr(self,'_'+program.replace('-','_').replace('.','_'),None)
+        if handler is not None:
+            try:
+                return(handler(argv[1:],stdin))
+            except (FileNotFoundError,ValueError) as e:
+                return(1,'',f'{program}: {e}\n')
+        if program in SimulatedExecutor.NOOP:
+            return(0,'','')
+        return(127,'',f'{program}: not simulated\n')
+
+    def _blockdev(self, args, stdin):
+        disk=self._disk(args[-1])
+        if '--getsize64' in args:
+            return(0,f'{disk.bytesize}\n','')
+        if '--getpbsz' in args:
+            return(0,f'{disk.physicalsectorsize}\n','')
+        if '--getss' in args:
+            return(0,f'{disk.sectorsize}\n','')
+        return(0,'','')
+
+    def _lsblk(self, args, stdin):
+        disk=self._disk(args[-1])
+        children=[]
+        for n,p in sorted(disk.partitions.items()):
+            children.append({
+                'path':disk.node(n),'type':'part','start':p['start']*disk.sectorsize//512,
+                'size':p['size']*disk.sectorsize,'log-sec':disk.sectorsize,
+                'fstype':p.get('fstype'),'label':p.get('fslabel'),'uuid':p.get('fsuuid'),
+                'partlabel':p['name'],'partuuid':p['uuid'].lower(),'parttype':p['type'].lower(),
+                'partflags':hex(p['attrbits']) if p['attrbits'] else None,
+                'ptuuid':disk.ptuuid,'pttype':disk.pttype,
+            })
+        device={
+            'path':disk.device,'type':'disk','start':None,'size':disk.bytesize,
+            'log-sec':disk.sectorsize,'fstype':None,'label':None,'uuid':None,
+            'partlabel':None,'partuuid':None,'parttype':None,'partflags':None,
+            'ptuuid':disk.ptuuid,'pttype':disk.pttype,
+        }
+        if children:
+            device['children']=children
+        return(0,json.dumps({'blockdevices':[device]}),'')
+
+    def _sfdisk(self, args, stdin):
+        disk=self._disk(args[-1])
+        if '-l' in args:
+            lines=[f'Disk {disk.device}: {disk.bytesize} bytes, {disk.sectorcount} sectors',
+                   f'Disklabel type: {disk.pttype}',f'Disk identifier: {disk.ptuuid}']
+            for n,p in sorted(disk.partitions.items()):
+                lines.append(f"{disk.node(n)} {p['start']} {p['start']+p['size']-1} {p['size']} {p['name']}")
+            return(0,'\n'.join(lines)+'\n','')
+        return(self._sfdiskScript(disk,stdin))
+
+    def _sfdiskScript(self, disk, script):
+        """Apply a whole table script, all or nothing as sfdisk does"""
+        from gpt import attrsFromString
+        ptuuid=disk.ptuuid or str(uuid.uuid4()).upper()
+        partitions={}
+        entrysectors=128*128//disk.sectorsize
+        first,last=2+entrysectors,disk.sectorcount-2-entrysectors
+        for line in script.splitlines():
+            line=line.strip()
+            if not line or (':' in line and line.split(':',1)[0].strip() in ('label','unit','first-lba','last-lba')):
+                continue
+            if line.startswith('label-id:'):
+                ptuuid=line.split(':',1)[1].strip()
+                continue
+            node,_,spec=line.partition(':')
+            fields={k:v.strip('"') for k,v in SimulatedExecutor.SCRIPT_FIELD.findall(spec)}
+            partnbr=int(re.search(r'([0-9]+)$',node.strip()).group(1))
+            start,size=int(fields['start']),int(fields['size'])
+            if start<first or start+size-1>last:
+                return(1,'',f'sfdisk: partition {partnbr} outside usable sectors {first}-{last}\n')
+            existing=disk.partitions.get(partnbr,{})
+            moved=existing.get('start')!=start or existing.get('size')!=size
+            partitions[partnbr]={
+                'start':start,
+                'size':size,
+                'type':fields.get('type','0FC63DAF-8483-4772-8E79-3D69D8477DE4').upper(),
+                'uuid':fields.get('uuid',str(uuid.uuid4())).upper(),
+                'name':fields.get('name',''),
+                'attrbits':attrsFromString(fields.get('attrs')),
+                # Filesystem survives only where the partition stays put
+                'fstype':None if moved else existing.get('fstype'),
+                'fslabel':None if moved else existing.get('fslabel'),
+                'fsuuid':None if moved else existing.get('fsuuid'),
+            }
+        ordered=sorted(partitions.values(),key=lambda p:p['start'])
+        for a,b in zip(ordered,ordered[1:]):
+            if a['start']+a['size']>b['start']:
+                return(1,'','sfdisk: partitions overlap\n')
+        disk.ptuuid=ptuuid
+        disk.pttype='gpt'
+        disk.partitions=partitions
+        return(0,'','')
+
+    def _parted(self, args, stdin):
+        return(self._sfdisk(['-l',args[-1]],stdin))
+
+    def _mkfs(self, args, stdin):
+        fstype=args[args.index('-t')+1] if '-t' in args else 'ext2'
+        label=args[args.index('-L')+1] if '-L' in args else None
+        p=self._partition(args[-1])
+        p['fstype'],p['fslabel'],p['fsuuid']=fstype,label,str(uuid.uuid4())
+        return(0,'','')
+
+    def _mount(self, args, stdin):
+        device,mountpoint=[a for a in args if not a.startswith('-')][-2:]
+        self.mounts[device]=mountpoint
+        return(0,'','')
+
+    def _umount(self, args, stdin):
+        mountpoint=args[-1]
+        self.mounts={d:m for d,m in self.mounts.items() if m!=mountpoint and d!=mountpoint}
+        return(0,'','')
+
+    def _cat(self, args, stdin):
+        if args==['/proc/mounts']:
+            return(0,''.join(f'{d} {m} ext4 rw 0 0\n' for d,m in self.mounts.items()),'')
+        if args and args[-1] in self.files:
+            return(0,self.files[args[-1]],'')
+        return(1,'',f'cat: {args}: not simulated\n')
+
+    def _tee(self, args, stdin):
+        self.files[args[-1]]=stdin
+        return(0,stdin,'')
+
+    def _mv(self, args, stdin):
+        source,target=args[-2:]
+        if source in self.files:
+            self.files[target]=self.files.pop(source)
+        return(0,'','')
+
+    def _grep(self, args, stdin):
+        pattern=args[-1]
+        lines=[l for l in stdin.splitlines(keepends=True) if pattern in l]
+        return(0 if lines else 1,''.join(lines),'')
@@ -0,0 +1,274 @@
+"""
+Index of free sector extents on a disk.
+
+Free extents are kept in a treap ordered by start sector, where each node
+also knows the largest aligned extent in its subtree. That gives first-fit
+(lowest address) allocation in O(log n). A second treap ordered by (size,
+start), where each node knows the lowest start in its subtree, gives
+best-fit in O(log n), also when the allocation has to end before a given
+sector. Extents are split on allocation and merged with their neighbours
+on release, so the index is updated incrementally as partitions are added
+or removed rather than rebuilt.
+"""
+
+import random
+
+FIT_FIRST='first'
+FIT_BEST='best'
+
+
+class _Node:
+    """Extent of the address treap, keyed on start"""
+
+    __slots__=('start','end','usable','best','priority','left','right')
+
+    def __init__(self, start, end, usable):
+        self.start=start
+        self.end=end
+        self.usable=usable
+        self.best=usable
+        self.priority=random.random()
+        self.left=None
+        self.right=None
+
+    def update(self):
+        self.best=max(self.usable,
+                      self.left.best if self.left else 0,
+                      self.right.best if self.right else 0)
+
+    @property
+    def key(self):
+        return(self.start)
+
+
+class _SizeNode:
+    """Extent of the size treap, keyed on (usable, start)"""
+
+    __slots__=('start','usable','low','priority','left','right')
+
+    def __init__(self, start, usable):
+        self.start=start
+        self.usable=usable
+        self.low=start
+        self.priority=random.random()
+        self.left=None
+        self.right=None
+
+    def update(self):
+        self.low=min(self.start,
+                     self.left.low if self.left else self.start,
+                     self.right.low if self.right else self.start)
+
+    @property
+    def key(self):
+        return((self.usable,self.start))
+
+
+def _split(node, key):
+    """Split into nodes with key < key, and >= key"""
+    if node is None:
+        return(None,None)
+    if node.key<key:
+        node.right,right=_split(node.right,key)
+        node.update()
+        return(node,right)
+    left,node.left=_split(node.left,key)
+    node.update()
+    return(left,node)
+
+def _merge(left, right):
+    if left is None:
+        return(right)
+    if right is None:
+        return(left)
+    if left.priority>right.priority:
+        left.right=_merge(left.right,right)
+        left.update()
+        return(left)
+    right.left=_merge(left,right.left)
+    right.update()
+    return(right)
+
+
+class FreeExtents:
+    """Free, inclusive [start,end] sector extents between first & last
+
+    :param first: First usable sector
+    :param last: Last usable sector
+    :param alignment: Sectors per alignment boundary. Allocations start on one
+    """
+
+    def __init__(self, first, last, alignment=1):
+        self.first=first
+        self.last=last
+        self.alignment=alignment
+        self._root=None
+        self._bysize=None   # _SizeNode treap, for best fit
+        self._count=0
+        if last>=first:
+            self._insert(first,last)
+
+    def __len__(self):
+        return(self._count)
+
+    def __iter__(self):
+        """(start, end) of free extents, in sector order"""
+        stack=[]
+        node=self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node=node.left
+            node=stack.pop()
+            yield((node.start,node.end))
+            node=node.right
+
+    def copy(self):
+        other=FreeExtents(self.first,self.last,self.alignment)
+        other._root=None
+        other._bysize=None
+        other._count=0
+        for start,end in self:
+            other._insert(start,end)
+        return(other)
+
+    def align(self, sector):
+        """Sector, moved up to the next alignment boundary if not on one"""
+        return(-(-sector//self.alignment)*self.alignment)
+
+    def _usable(self, start, end):
+        return(max(end-self.align(start)+1,0))
+
+    def _insert(self, start, end):
+        usable=self._usable(start,end)
+        left,right=_split(self._root,start)
+        self._root=_merge(_merge(left,_Node(start,end,usable)),right)
+        left,right=_split(self._bysize,(usable,start))
+        self._bysize=_merge(_merge(left,_SizeNode(start,usable)),right)
+        self._count+=1
+
+    def _remove(self, start):
+        """Remove the extent starting at start, returning its end"""
+        left,rest=_split(self._root,start)
+        node,right=_split(rest,start+1)
+        self._root=_merge(left,right)
+        left,rest=_split(self._bysize,(node.usable,node.start))
+        _,right=_split(rest,(node.usable,node.start+1))
+        self._bysize=_merge(left,right)
+        self._count-=1
+        return(node.end)
+
+    def _floor(self, sector):
+        """Extent with the greatest start <= sector, as (start, end), or None"""
+        node=self._root
+        found=None
+        while node is not None:
+            if node.start<=sector:
+                found=node
+                node=node.right
+            else:
+                node=node.left
+        return(None if found is None else (found.start,found.end))
+
+    def _ceiling(self, sector):
+        """Extent with the least start >= sector"""
+        node=self._root
+        found=None
+        while node is not None:
+            if node.start>=sector:
+                found=node
+                node=node.left
+            else:
+                node=node.right
+        return(None if found is None else (found.start,found.end))
+
+    def allocate(self, start, end):
+        """Mark [start,end] as used. It must lie inside one free extent"""
+        extent=self._floor(start)
+        if extent is None or extent[1]<end:
+            raise ValueError(f'Sectors {start}-{end} are not free')
+        self._remove(extent[0])
+        if extent[0]<start:
+            self._insert(extent[0],start-1)
+        if end<extent[1]:
+            self._insert(end+1,extent[1])
+
+    def release(self, start, end):
+        """Mark [start,end] as free, merging with free neighbours"""
+        before=self._floor(start)
+        if before is not None and before[1]>=start:
+            raise ValueError(f'Sectors {start}-{end} overlap free extent {before}')
+        after=self._ceiling(start)
+        if after is not None and after[0]<=end:
+            raise ValueError(f'Sectors {start}-{end} overlap free extent {after}')
+
+        if before is not None and before[1]+1==start:
+            self._remove(before[0])
+            start=before[0]
+        if after is not None and end+1==after[0]:
+            end=self._remove(after[0])
+        self._insert(start,end)
+
+    def _firstFit(self, count):
+        node=self._root
+        if node is None or node.best<count:
+            return(None)
+        while True:
+            if node.left is not None and node.left.best>=count:
+                node=node.left
+            elif node.usable>=count:
+                return(node.start)
+            else:
+                node=node.right
+
+    def _bestFit(self, count, before):
+        """Start of the smallest extent holding count aligned sectors, ending
+        by before. O(log n), through the lowest start each subtree holds"""
+        # Ending by before means an aligned start <= before-count+1, that is
+        # a start <= the boundary at or below it
+        limit=None if before is None else (before-count+1)//self.alignment*self.alignment
+        # Nodes large enough on the search path, each followed in size order
+        # by its right subtree, smallest last
+        large=[]
+        node=self._bysize
+        while node is not None:
+            if node.key<(count,-1):
+                node=node.right
+            else:
+                large.append(node)
+                node=node.left
+        for node in reversed(large):
+            if limit is None or node.start<=limit:
+                return(node.start)
+            node=node.right
+            if node is None or node.low>limit:
+                continue
+            while True:
+                if node.left is not None and node.left.low<=limit:
+                    node=node.left
+                elif node.start<=limit:
+                    return(node.start)
+                else:
+                    node=node.right
+        return(None)
+
+    def find(self, count, fit=FIT_FIRST, before=None):
+        """Aligned place for count sectors
+
+        :param fit: FIT_FIRST for the lowest address, FIT_BEST for the smallest
+            extent that holds count sectors
+        :param before: Last sector the allocation may end on
+        :return: (start, end) or (None, None) when there is no room
+        """
+        if fit==FIT_BEST:
+            start=self._bestFit(count,before)
+        else:
+            start=self._firstFit(count)
+        if start is None:
+            return((None,None))
+        start=self.align(start)
+        end=start+count-1
+        if before is not None and end>before:
+            # First fit is lowest address, nothing later can end sooner
+            return((None,None))
+        return((start,end))
@@ -0,0 +1,616 @@
+"""
+Read only access to FAT & ext2/3/4 filesystems within disk images, without
+mounting them.
+
+A filesystem is opened at the byte offset of its partition within an image
+file, or any seekable file object such as a gzindex.IndexedGzipReader over
+the compressed image. Directories are listed and files read by following
+the on disk structures directly: cluster chains of the FAT, and extent trees
+or indirect blocks of ext inodes. Files are read as runs of contiguous bytes
+in the image, so a fragmented file costs one read per fragment, not per
+block, and runs are moved in kernel with copy_file_range when the image is
+a file.
+
+    with openFilesystem('image.img',offset) as fs:
+        fs.listdir('/')
+        for chunk in fs.chunks('/KERNEL'):
+            ...
+        TreeExtract(fs,target).run()
+
+Nothing here needs root. Extended attributes, ext inline data, meta_bg &
+encryption are not supported, and ext journals are not replayed; filesystems
+using them, or needing recovery, raise UnsupportedFilesystem on open, so
+callers can fall back to mounting.
+"""
+
+import errno
+import os
+import stat
+import struct
+import threading
+import time
+from pathlib import PurePosixPath
+from treecopy import TreeWriter,WORKERS,FALLBACK_ERRORS
+
+CHUNK_SIZE=8*pow(2,20)
+
+# vfat presents every file with these modes under the default umask
+FAT_DIR_MODE=stat.S_IFDIR|0o755
+FAT_FILE_MODE=stat.S_IFREG|0o755
+FAT_READONLY=0x01
+FAT_VOLUME=0x08
+FAT_DIRECTORY=0x10
+FAT_LFN=0x0f
+FAT_LOWER_BASE=0x08
+FAT_LOWER_EXT=0x10
+
+EXT_MAGIC=0xef53
+EXT_ROOT_INODE=2
+EXT_EXTENTS_FL=0x80000
+EXT_INLINE_DATA_FL=0x10000000
+EXT_EXTENT_MAGIC=0xf30a
+EXT_INCOMPAT_FILETYPE=0x2
+EXT_INCOMPAT_RECOVER=0x4
+EXT_INCOMPAT_EXTENTS=0x40
+EXT_INCOMPAT_64BIT=0x80
+EXT_INCOMPAT_MMP=0x100
+EXT_INCOMPAT_FLEX_BG=0x200
+EXT_INCOMPAT_CSUM_SEED=0x2000
+EXT_INCOMPAT_LARGEDIR=0x4000
+EXT_INCOMPAT_SUPPORTED=(EXT_INCOMPAT_FILETYPE|EXT_INCOMPAT_EXTENTS|EXT_INCOMPAT_64BIT
+    |EXT_INCOMPAT_MMP|EXT_INCOMPAT_FLEX_BG|EXT_INCOMPAT_CSUM_SEED|EXT_INCOMPAT_LARGEDIR)
+
+
+class UnsupportedFilesystem(ValueError):
+    """Partition holds no filesystem, or one that cannot be read here"""
+
+
+class FsEntry:
+    """A file of a filesystem, as listed by its directory
+
+    :param key: Identifies the file within its filesystem, its inode number
+        where it has one, so hard links are seen as such
+    """
+
+    __slots__=('name','mode','size','mtime','uid','gid','nlink','key','rdev','_data')
+
+    def __init__(self, name, mode, size, mtime, key, uid=0, gid=0, nlink=1, rdev=0, data=None):
+        self.name=name
+        self.mode=mode
+        self.size=size
+        self.mtime=mtime        # Nanoseconds since the epoch
+        self.key=key
+        self.uid=uid
+        self.gid=gid
+        self.nlink=nlink
+        self.rdev=rdev
+        self._data=data         # Filesystem specific location of the contents
+
+    def __repr__(self):
+        return(f'FsEntry({self.name!r} {stat.filemode(self.mode)} {self.size})')
+
+    @property
+    def isdir(self):
+        return(stat.S_ISDIR(self.mode))
+
+    @property
+    def isfile(self):
+        return(stat.S_ISREG(self.mode))
+
+    @property
+    def islink(self):
+        return(stat.S_ISLNK(self.mode))
+
+
+class _Volume:
+    """Positioned reads of the bytes of one partition
+
+    :param source: Image path, or a seekable binary file object
+    :param offset: Byte offset of the partition in source
+    """
+
+    def __init__(self, source, offset=0):
+        self.offset=offset
+        self._owned=isinstance(source,(str,os.PathLike))
+        self._file=None
+        self._fd=None
+        if self._owned:
+            self._fd=os.open(source,os.O_RDONLY)
+        else:
+            try:
+                self._fd=source.fileno()
+            except (AttributeError,OSError):
+                self._file=source
+        self._lock=threading.Lock()
+
+    def close(self):
+        if self._owned and self._fd is not None:
+            os.close(self._fd)
+            self._fd=None
+
+    def read(self, pos, size):
+        """size bytes from pos in the partition, short only at the end of source"""
+        if self._file is not None:
+            with self._lock:
+                self._file.seek(self.offset+pos)
+                return(self._file.read(size))
+        parts=[]
+        while size>0:
+            data=os.pread(self._fd,size,self.offset+pos)
+            if not data:
+                break
+            parts.append(data)
+            pos+=len(data)
+            size-=len(data)
+        return(b''.join(parts))
+
+    def copyTo(self, fd, pos, size):
+        """Write size bytes from pos in the partition to fd at its current position"""
+        if self._fd is not None:
+            try:
+                while size>0:
+                    n=os.copy_file_range(self._fd,fd,min(CHUNK_SIZE,size),self.offset+pos)
+                    if n==0:
+                        raise EOFError(f'Image ends before offset {self.offset+pos}')
+                    pos+=n
+                    size-=n
+                return
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRORS:
+                    raise
+        while size>0:
+            data=self.read(pos,min(CHUNK_SIZE,size))
+            if not data:
+                raise EOFError(f'Image ends before offset {self.offset+pos}')
+            os.write(fd,data)
+            pos+=len(data)
+            size-=len(data)
+
+
+class Filesystem:
+    """Read only filesystem on a _Volume. See FatFilesystem & ExtFilesystem"""
+
+    def __init__(self, volume):
+        self.volume=volume
+
+    def close(self):
+        self.volume.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def root(self):
+        raise NotImplementedError
+
+    def _list(self, entry):
+        """FsEntries of directory entry, without . & .."""
+        raise NotImplementedError
+
+    def runs(self, entry):
+        """Yield (pos, size) runs making up the contents of entry, pos None for holes"""
+        raise NotImplementedError
+
+    def readlink(self, entry):
+        raise OSError(errno.EINVAL,f'{entry.name} is not a symlink')
+
+    def lookup(self, path):
+        """FsEntry at path, from the root of the filesystem"""
+        entry=self.root()
+        for part in PurePosixPath('/',path).parts[1:]:
+            if not entry.isdir:
+                raise NotADirectoryError(errno.ENOTDIR,f'{entry.name} is not a directory')
+            found=[e for e in self._list(entry) if e.name==part]
+            if not found:
+                raise FileNotFoundError(errno.ENOENT,f'No {path} in filesystem')
+            entry=found[0]
+        return(entry)
+
+    def listdir(self, path='/'):
+        """FsEntries of directory path, or of an FsEntry of a directory"""
+        entry=path if isinstance(path,FsEntry) else self.lookup(path)
+        if not entry.isdir:
+            raise NotADirectoryError(errno.ENOTDIR,f'{entry.name} is not a directory')
+        return(self._list(entry))
+
+    def chunks(self, path, chunksize=CHUNK_SIZE):
+        """Yield the contents of file path, or of an FsEntry, in chunks of at most chunksize"""
+        entry=path if isinstance(path,FsEntry) else self.lookup(path)
+        for pos,size in self.runs(entry):
+            while size>0:
+                n=min(chunksize,size)
+                yield(bytes(n) if pos is None else self.volume.read(pos,n))
+                if pos is not None:
+                    pos+=n
+                size-=n
+
+    def read(self, path):
+        return(b''.join(self.chunks(path)))
+
+    def copyTo(self, entry, fd):
+        """Write the contents of entry to fd, seeking over holes
+
+        :return: Bytes of content
+        """
+        for pos,size in self.runs(entry):
+            if pos is None:
+                os.lseek(fd,size,os.SEEK_CUR)
+            else:
+                self.volume.copyTo(fd,pos,size)
+        # Trailing holes are only made by the truncate
+        os.ftruncate(fd,entry.size)
+        return(entry.size)
+
+
+def _mergeRuns(runs):
+    """Join (pos, size) runs that are contiguous"""
+    merged=[]
+    for pos,size in runs:
+        if merged and size and (merged[-1][0] is None)==(pos is None) and (pos is None or merged[-1][0]+merged[-1][1]==pos):
+            merged[-1]=(merged[-1][0],merged[-1][1]+size)
+        elif size:
+            merged.append((pos,size))
+    return(merged)
+
+
+class FatFilesystem(Filesystem):
+    """FAT12, FAT16 or FAT32, with long file names"""
+
+    def __init__(self, volume, boot):
+        super().__init__(volume)
+        (self.sectorsize,self.clustersectors,reserved,fats,rootentries,total16,
+            fatsize16)=struct.unpack('<HBHBHH',boot[11:21])+struct.unpack('<H',boot[22:24])
+        total32,fatsize32,self.rootcluster=struct.unpack('<I',boot[32:36])+struct.unpack('<II',boot[36:40]+boot[44:48])
+        total=total16 or total32
+        fatsize=fatsize16 or fatsize32
+        self.clustersize=self.sectorsize*self.clustersectors
+        rootsectors=(rootentries*32+self.sectorsize-1)//self.sectorsize
+        self.rootpos=(reserved+fats*fatsize)*self.sectorsize
+        self.rootsize=rootentries*32
+        self.datapos=self.rootpos+rootsectors*self.sectorsize
+        self.clusters=(total-reserved-fats*fatsize-rootsectors)//self.clustersectors
+        if self.clusters<4085:
+            self.bits=12
+        elif self.clusters<65525:
+            self.bits=16
+        else:
+            self.bits=32
+        self.fat=volume.read(reserved*self.sectorsize,fatsize*self.sectorsize)
+
+    @staticmethod
+    def probe(boot):
+        if boot[510:512]!=b'\x55\xaa' or boot[0] not in (0xeb,0xe9):
+            return(False)
+        sectorsize,clustersectors,_,fats=struct.unpack('<HBHB',boot[11:17])
+        return(sectorsize in (512,1024,2048,4096) and clustersectors and clustersectors&(clustersectors-1)==0 and fats>0)
+
+    def _next(self, cluster):
+        if self.bits==12:
+            value=struct.unpack_from('<H',self.fat,cluster+cluster//2)[0]
+            value=value>>4 if cluster&1 else value&0xfff
+            end=0xff8
+        elif self.bits==16:
+            value=struct.unpack_from('<H',self.fat,cluster*2)[0]
+            end=0xfff8
+        else:
+            value=struct.unpack_from('<I',self.fat,cluster*4)[0]&0x0fffffff
+            end=0x0ffffff8
+        return(None if value>=end else value)
+
+    def _chain(self, cluster):
+        """Runs of the clusters chained from cluster"""
+        runs=[]
+        seen=0
+        while cluster is not None:
+            if cluster<2 or cluster>=self.clusters+2 or seen>self.clusters:
+                raise OSError(errno.EIO,f'Corrupt cluster chain at cluster {cluster}')
+            runs.append((self.datapos+(cluster-2)*self.clustersize,self.clustersize))
+            cluster=self._next(cluster)
+            seen+=1
+        return(_mergeRuns(runs))
+
+    def root(self):
+        return(FsEntry('/',FAT_DIR_MODE,0,0,self.rootcluster if self.bits==32 else 0,data=self.rootcluster if self.bits==32 else None))
+
+    def runs(self, entry):
+        if entry.isdir:
+            if entry._data is None:
+                return([(self.rootpos,self.rootsize)])
+            return(self._chain(entry._data))
+        remaining=entry.size
+        runs=[]
+        for pos,size in self._chain(entry._data) if remaining else []:
+            runs.append((pos,min(size,remaining)))
+            remaining-=runs[-1][1]
+            if remaining==0:
+                break
+        if remaining:
+            raise OSError(errno.EIO,f'Cluster chain of {entry.name} ends {remaining}[B] short')
+        return(runs)
+
+    @staticmethod
+    def _checksum(shortname):
+        total=0
+        for c in shortname:
+            total=(((total&1)<<7)+(total>>1)+c)&0xff
+        return(total)
+
+    @staticmethod
+    def _time(date, clock):
+        if not date:
+            return(0)
+        try:
+            seconds=time.mktime(((date>>9)+1980,(date>>5)&15,date&31,clock>>11,(clock>>5)&63,(clock&31)*2,0,0,-1))
+        except (OverflowError,ValueError):
+            return(0)
+        return(int(seconds)*pow(10,9))
+
+    def _list(self, entry):
+        data=b''.join(self.chunks(entry))
+        entries=[]
+        longname=[]
+        checksum=None
+        for offset in range(0,len(data)-31,32):
+            raw=data[offset:offset+32]
+            if raw[0]==0:
+                break
+            if raw[0]==0xe5:
+                longname=[]
+                continue
+            attr=raw[11]
+            if attr&0x3f==FAT_LFN:
+                if raw[0]&0x40:
+                    longname=[]
+                    checksum=raw[13]
+                longname.append(raw[1:11]+raw[14:26]+raw[28:32])
+                continue
+            if attr&FAT_VOLUME:
+                longname=[]
+                continue
+            shortname=raw[0:11]
+            if longname and checksum==self._checksum(shortname):
+                name=b''.join(reversed(longname)).decode('utf-16-le',errors='replace').split('\x00')[0]
+            else:
+                base=shortname[0:8].rstrip(b' ')
+                ext=shortname[8:11].rstrip(b' ')
+                if base[:1]==b'\x05':
+                    base=b'\xe5'+base[1:]
+                if raw[12]&FAT_LOWER_BASE:
+                    base=base.lower()
+                if raw[12]&FAT_LOWER_EXT:
+                    ext=ext.lower()
+                name=(base+(b'.'+ext if ext else b'')).decode('cp437')
+            longname=[]
+            if name in ('.','..'):
+                continue
+            clock,date=struct.unpack('<HH',raw[22:26])
+            cluster=struct.unpack('<H',raw[20:22])[0]<<16|struct.unpack('<H',raw[26:28])[0]
+            size=struct.unpack('<I',raw[28:32])[0]
+            if attr&FAT_DIRECTORY:
+                mode=FAT_DIR_MODE
+                size=0
+            else:
+                mode=FAT_FILE_MODE
+            if attr&FAT_READONLY:
+                mode&=~0o222
+            # Directories always have a cluster, empty files none
+            entries.append(FsEntry(name,mode,size,self._time(date,clock),(entry.key,offset),data=cluster or None))
+        return(entries)
+
+
+class ExtFilesystem(Filesystem):
+    """ext2, ext3 or ext4, that has no journal left to replay"""
+
+    def __init__(self, volume, superblock):
+        super().__init__(volume)
+        (self.firstblock,logblocksize)=struct.unpack('<II',superblock[20:28])
+        self.blockspergroup,_,self.inodespergroup=struct.unpack('<III',superblock[32:44])
+        revision=struct.unpack('<I',superblock[76:80])[0]
+        self.inodesize=struct.unpack('<H',superblock[88:90])[0] if revision>=1 else 128
+        incompat=struct.unpack('<I',superblock[96:100])[0]
+        if incompat&EXT_INCOMPAT_RECOVER:
+            # Metadata read as is could be stale, mounting replays the journal
+            raise UnsupportedFilesystem('ext filesystem needs journal recovery')
+        if incompat&~EXT_INCOMPAT_SUPPORTED:
+            raise UnsupportedFilesystem(f'ext filesystem has unsupported features {incompat&~EXT_INCOMPAT_SUPPORTED:#x}')
+        self.filetype=bool(incompat&EXT_INCOMPAT_FILETYPE)
+        self.blocksize=1024<<logblocksize
+        descsize=struct.unpack('<H',superblock[254:256])[0] if incompat&EXT_INCOMPAT_64BIT else 32
+        self.descsize=max(descsize,32)
+        self._tables={}
+        self._tableslock=threading.Lock()
+
+    @staticmethod
+    def probe(superblock):
+        return(len(superblock)>=256 and struct.unpack('<H',superblock[56:58])[0]==EXT_MAGIC)
+
+    def _inodeTable(self, group):
+        with self._tableslock:
+            table=self._tables.get(group)
+            if table is None:
+                pos=(self.firstblock+1)*self.blocksize+group*self.descsize
+                desc=self.volume.read(pos,self.descsize)
+                table=struct.unpack('<I',desc[8:12])[0]
+                if self.descsize>=64:
+                    table|=struct.unpack('<I',desc[40:44])[0]<<32
+                self._tables[group]=table
+        return(table)
+
+    def inode(self, number, name=''):
+        """FsEntry of inode number"""
+        group,index=divmod(number-1,self.inodespergroup)
+        raw=self.volume.read(self._inodeTable(group)*self.blocksize+index*self.inodesize,self.inodesize)
+        mode,uid,sizelo=struct.unpack('<HHI',raw[0:8])
+        mtime=struct.unpack('<i',raw[16:20])[0]
+        gid,nlink=struct.unpack('<HH',raw[24:28])
+        flags=struct.unpack('<I',raw[32:36])[0]
+        block=raw[40:100]
+        sizehi=struct.unpack('<I',raw[108:112])[0]
+        uidhi,gidhi=struct.unpack('<HH',raw[120:124])
+        nsec=0
+        if self.inodesize>128 and struct.unpack('<H',raw[128:130])[0]>=12:
+            extra=struct.unpack('<I',raw[136:140])[0]
+            mtime+=(extra&3)<<32
+            nsec=extra>>2
+        if flags&EXT_INLINE_DATA_FL:
+            raise UnsupportedFilesystem(f'{name or number} has its data inline')
+        size=sizelo|sizehi<<32 if stat.S_ISREG(mode) or stat.S_ISDIR(mode) else sizelo
+        rdev=0
+        if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            old,new=struct.unpack('<II',block[0:8])
+            rdev=os.makedev((old>>8)&0xff,old&0xff) if old else os.makedev((new&0xfff00)>>8,(new&0xff)|((new>>12)&0xfff00))
+        return(FsEntry(name,mode,size,mtime*pow(10,9)+nsec,number,uid|uidhi<<16,gid|gidhi<<16,nlink,rdev,(flags,block)))
+
+    def root(self):
+        return(self.inode(EXT_ROOT_INODE,'/'))
+
+    def _extents(self, block):
+        """Yield (logical, physical, count, initialised) of an extent tree node"""
+        magic,entries,_,depth=struct.unpack('<HHHH',block[0:8])
+        if magic!=EXT_EXTENT_MAGIC:
+            raise OSError(errno.EIO,'Corrupt extent tree')
+        for n in range(entries):
+            raw=block[12+12*n:24+12*n]
+            if depth==0:
+                logical,length,hi,lo=struct.unpack('<IHHI',raw)
+                initialised=length<=32768
+                yield(logical,lo|hi<<32,length if initialised else length-32768,initialised)
+            else:
+                _,lo,hi=struct.unpack('<IIH',raw[0:10])
+                yield from self._extents(self.volume.read((lo|hi<<32)*self.blocksize,self.blocksize))
+
+    def _indirect(self, block, depth, logical):
+        """Yield (logical, physical, 1, True) of the blocks mapped under an indirect block"""
+        perblock=self.blocksize//4
+        pointers=struct.unpack(f'<{perblock}I',self.volume.read(block*self.blocksize,self.blocksize))
+        span=perblock**depth
+        for n,pointer in enumerate(pointers):
+            if pointer==0:
+                continue
+            if depth==0:
+                yield(logical+n,pointer,1,True)
+            else:
+                yield from self._indirect(pointer,depth-1,logical+n*span)
+
+    def _mapping(self, entry):
+        flags,block=entry._data
+        if flags&EXT_EXTENTS_FL:
+            yield from self._extents(block)
+            return
+        pointers=struct.unpack('<15I',block)
+        perblock=self.blocksize//4
+        for n in range(12):
+            if pointers[n]:
+                yield(n,pointers[n],1,True)
+        logical=12
+        for depth in range(3):
+            if pointers[12+depth]:
+                yield from self._indirect(pointers[12+depth],depth,logical)
+            logical+=perblock**(depth+1)
+
+    def runs(self, entry):
+        runs=[]
+        position=0              # Bytes of the file mapped so far
+        for logical,physical,count,initialised in sorted(self._mapping(entry)):
+            start=logical*self.blocksize
+            if start>=entry.size:
+                break
+            if start>position:
+                runs.append((None,start-position))
+            size=min(count*self.blocksize,entry.size-start)
+            # Uninitialised extents read as zeros
+            runs.append((physical*self.blocksize if initialised else None,size))
+            position=start+size
+        if position<entry.size:
+            runs.append((None,entry.size-position))
+        return(_mergeRuns(runs))
+
+    def readlink(self, entry):
+        if not entry.islink:
+            return(super().readlink(entry))
+        flags,block=entry._data
+        if not flags&EXT_EXTENTS_FL and entry.size<60:
+            # Fast symlink, the target is held in place of the block map
+            return(block[:entry.size].decode(errors='surrogateescape'))
+        return(b''.join(self.chunks(entry)).decode(errors='surrogateescape'))
+
+    def _list(self, entry):
+        data=b''.join(self.chunks(entry))
+        entries=[]
+        offset=0
+        while offset+8<=len(data):
+            inode,reclen,namelen=struct.unpack('<IHB',data[offset:offset+7])
+            if reclen<8:
+                raise OSError(errno.EIO,f'Corrupt directory {entry.name}')
+            if not self.filetype:
+                namelen|=data[offset+7]<<8
+            if inode:
+                name=data[offset+8:offset+8+namelen].decode(errors='surrogateescape')
+                if name not in ('.','..'):
+                    entries.append(self.inode(inode,name))
+            offset+=reclen
+        return(entries)
+
+
+def openFilesystem(source, offset=0):
+    """Filesystem of the partition at offset in source
+
+    :param source: Image path, or a seekable binary file object
+    :raises UnsupportedFilesystem: When it is neither FAT nor ext, or uses
+        features not read here
+    """
+    volume=_Volume(source,offset)
+    try:
+        head=volume.read(0,2048)
+        if ExtFilesystem.probe(head[1024:]):
+            return(ExtFilesystem(volume,head[1024:]))
+        if FatFilesystem.probe(head[:512]):
+            return(FatFilesystem(volume,head[:512]))
+        raise UnsupportedFilesystem(f'No FAT or ext filesystem at {offset} in {source}')
+    except BaseException:
+        volume.close()
+        raise
+
+
+class TreeExtract(TreeWriter):
+    """Copy of the whole of a Filesystem into existing directory target
+
+    Items are the FsEntry of each file. Modes, ownership, times, symlinks,
+    hard links, device nodes and fifos are preserved. See
+    treecopy.TreeWriter for the parameters
+    """
+
+    PHASE='extract-tree'
+
+    def __init__(self, fs:Filesystem, target, workers=WORKERS, preserveOwner=None):
+        super().__init__(target,workers,preserveOwner)
+        self.fs=fs
+
+    def _applyMetadata(self, entry, target):
+        """Apply owner, mode & mtime of entry to target, a path or an open fd"""
+        follow={} if isinstance(target,int) else {'follow_symlinks':False}
+        if self.preserveOwner:
+            os.chown(target,entry.uid,entry.gid,**follow)
+        if not entry.islink:
+            os.chmod(target,stat.S_IMODE(entry.mode))
+        os.utime(target,ns=(entry.mtime,entry.mtime),**follow)
+
+    def _root(self):
+        return(self.fs.root())
+
+    def _list(self, directory):
+        for entry in self.fs.listdir(directory):
+            yield((entry.name,entry,entry.mode,entry.size,entry.key if entry.nlink>1 else None))
+
+    def _writeFile(self, entry, fd):
+        written=self.fs.copyTo(entry,fd)
+        self._applyMetadata(entry,fd)
+        return(written)
+
+    def _makeEntry(self, entry, target):
+        if entry.islink:
+            os.symlink(self.fs.readlink(entry),target)
+        else:
+            os.mknod(target,entry.mode,entry.rdev)
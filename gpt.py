@@ -0,0 +1,288 @@
+"""
+Native GPT reader & writer.
+
+Works on block devices and regular disk image files alike through large
+positioned reads & writes: the protective mbr, primary header & entry array
+at the start of the disk, and the backup entry array & header at its end.
+Header and entry array CRC32s are validated on read and computed on write.
+"""
+
+import os
+import stat
+import struct
+import uuid
+import zlib
+from pathlib import Path
+
+SECTOR_SIZE=512
+SIGNATURE=b'EFI PART'
+REVISION=0x00010000
+HEADER_SIZE=92
+ENTRY_COUNT=128
+ENTRY_SIZE=128
+
+MBR_BOOTCODE_SIZE=446
+MBR_SIGNATURE=b'\x55\xaa'
+MBR_PARTTYPE_GPT=0xee
+
+HEADER_FORMAT='<8sIIIIQQQQ16sQIII'
+ENTRY_FORMAT='<16s16sQQQ72s'
+
+# Attribute bits, as sfdisk names them
+ATTRIBUTES={0:'RequiredPartition',1:'NoBlockIOProtocol',2:'LegacyBIOSBootable'}
+
+
+def attrsToString(bits):
+    """Attribute bits as an sfdisk attrs string, None when no bits are set"""
+    if not bits:
+        return(None)
+    names=[ATTRIBUTES.get(bit,f'GUID:{bit}') for bit in range(64) if bits & (1<<bit)]
+    return(' '.join(names))
+
+def attrsFromString(attrs):
+    """Attribute bits from an sfdisk attrs string"""
+    bits=0
+    byname={v:k for k,v in ATTRIBUTES.items()}
+    for name in (attrs or '').replace(',',' ').split():
+        if name.startswith('GUID:'):
+            for bit in name[5:].split(','):
+                bits|=1<<int(bit)
+        else:
+            bits|=1<<byname[name]
+    return(bits)
+
+def _guidBytes(value):
+    return(uuid.UUID(value).bytes_le)
+
+def _guidString(data):
+    return(str(uuid.UUID(bytes_le=bytes(data))).upper())
+
+def deviceSectorSize(path):
+    """Logical sector size of a block device, SECTOR_SIZE for anything else"""
+    try:
+        return(int(Path('/sys/class/block',Path(path).resolve().name,'queue','logical_block_size').read_text()))
+    except (OSError,ValueError):
+        return(SECTOR_SIZE)
+
+
+class GptEntry:
+    """One partition entry. first & last are inclusive lbas"""
+
+    def __init__(self, typeguid, uniqueguid, first, last, attrs=0, name=''):
+        self.typeguid=typeguid.upper()
+        self.uniqueguid=uniqueguid.upper()
+        self.first=first
+        self.last=last
+        self.attrs=attrs
+        self.name=name
+
+    def __repr__(self):
+        return(f'GptEntry({self.name!r} {self.first}-{self.last} {self.uniqueguid})')
+
+    def pack(self):
+        return(struct.pack(ENTRY_FORMAT,
+            _guidBytes(self.typeguid),
+            _guidBytes(self.uniqueguid),
+            self.first,
+            self.last,
+            self.attrs,
+            self.name.encode('utf-16-le')[:72]))
+
+    @staticmethod
+    def unpack(data):
+        """Entry from its on disk form, None for unused entries"""
+        typeguid,uniqueguid,first,last,attrs,name=struct.unpack(ENTRY_FORMAT,bytes(data[:ENTRY_SIZE]))
+        if typeguid==bytes(16):
+            return(None)
+        name=name.decode('utf-16-le').split('\x00',1)[0]
+        return(GptEntry(_guidString(typeguid),_guidString(uniqueguid),first,last,attrs,name))
+
+
+class GptTable:
+    """GPT of a device or image file
+
+    entries is a list of length entrycount, None for unused slots; the slot
+    index is the partition number less one.
+    """
+
+    def __init__(self, path, sectorsize=None):
+        self.path=Path(path)
+        self.sectorsize=sectorsize if sectorsize is not None else deviceSectorSize(path)
+        self.sectorcount=self._size()//self.sectorsize
+        self.diskguid=None
+        self.entrycount=ENTRY_COUNT
+        self.entrysize=ENTRY_SIZE
+        self.entries=[None]*ENTRY_COUNT
+        self.primaryvalid=False
+        self.backupvalid=False
+        self._bootcode=bytes(MBR_BOOTCODE_SIZE)
+        self._usable=None
+
+    def _size(self):
+        fd=os.open(self.path,os.O_RDONLY)
+        try:
+            return(os.lseek(fd,0,os.SEEK_END))
+        finally:
+            os.close(fd)
+
+    @property
+    def entrysectors(self):
+        bytesize=self.entrycount*self.entrysize
+        return(bytesize//self.sectorsize + bool(bytesize%self.sectorsize))
+
+    @property
+    def firstlba(self):
+        if self._usable is not None:
+            return(self._usable[0])
+        return(2+self.entrysectors)
+
+    @property
+    def lastlba(self):
+        if self._usable is not None:
+            return(self._usable[1])
+        return(self.sectorcount-2-self.entrysectors)
+
+    @property
+    def backuplba(self):
+        return(self.sectorcount-1)
+
+    @staticmethod
+    def create(path, sectorsize=None, diskguid=None):
+        """New, empty table for path. Nothing is written until write()"""
+        table=GptTable(path,sectorsize)
+        table.diskguid=(diskguid or str(uuid.uuid4())).upper()
+        try:
+            with open(table.path,'rb') as f:
+                table._bootcode=f.read(MBR_BOOTCODE_SIZE).ljust(MBR_BOOTCODE_SIZE,b'\x00')
+        except OSError:
+            pass
+        return(table)
+
+    @staticmethod
+    def read(path, sectorsize=None):
+        """Table read from path, falling back to the backup header when the
+        primary is damaged
+
+        :raises ValueError: When no valid gpt is found
+        """
+        table=GptTable(path,sectorsize)
+        fd=os.open(table.path,os.O_RDONLY)
+        try:
+            table._bootcode=os.pread(fd,MBR_BOOTCODE_SIZE,0)
+            primary=table._readHeader(fd,1)
+            backup=table._readHeader(fd,table.backuplba)
+        finally:
+            os.close(fd)
+        table.primaryvalid=primary is not None
+        table.backupvalid=backup is not None
+        header=primary or backup
+        if header is None:
+            raise ValueError(f'No valid gpt on {path}')
+        table.diskguid=header['diskguid']
+        table.entrycount=header['entrycount']
+        table.entrysize=header['entrysize']
+        table.entries=header['entries']
+        # Keep usable range of a table read from a primary at the start of this disk
+        if primary is not None:
+            table._usable=(header['firstusable'],min(header['lastusable'],table.sectorcount-2-table.entrysectors))
+        return(table)
+
+    def _readHeader(self, fd, lba):
+        """Parse & validate header at lba and its entry array, None if invalid"""
+        raw=os.pread(fd,self.sectorsize,lba*self.sectorsize)
+        if len(raw)<HEADER_SIZE or raw[0:8]!=SIGNATURE:
+            return(None)
+        (signature,revision,headersize,headercrc,_,current,backup,
+            firstusable,lastusable,diskguid,entrylba,entrycount,entrysize,entriescrc)=\
+            struct.unpack(HEADER_FORMAT,raw[:HEADER_SIZE])
+        if headersize<HEADER_SIZE or headersize>self.sectorsize or current!=lba:
+            return(None)
+        check=bytearray(raw[:headersize])
+        check[16:20]=bytes(4)
+        if zlib.crc32(check)!=headercrc:
+            return(None)
+        if entrysize<ENTRY_SIZE or entrycount*entrysize>64*pow(2,20):
+            return(None)
+        array=os.pread(fd,entrycount*entrysize,entrylba*self.sectorsize)
+        if zlib.crc32(array)!=entriescrc:
+            return(None)
+        view=memoryview(array)
+        return({
+            'diskguid':_guidString(diskguid),
+            'firstusable':firstusable,
+            'lastusable':lastusable,
+            'entrycount':entrycount,
+            'entrysize':entrysize,
+            'entries':[GptEntry.unpack(view[n*entrysize:(n+1)*entrysize]) for n in range(entrycount)],
+        })
+
+    def partitions(self):
+        """(partnbr, GptEntry) of used entries, in lba order"""
+        used=[(n+1,e) for n,e in enumerate(self.entries) if e is not None]
+        return(sorted(used,key=lambda x:x[1].first))
+
+    def setEntry(self, partnbr, entry):
+        """Set or, with entry None, clear the entry for partition number partnbr"""
+        if entry is not None and (entry.first<self.firstlba or entry.last>self.lastlba or entry.first>entry.last):
+            raise ValueError(f'{entry} outside usable lbas {self.firstlba}-{self.lastlba} of {self.path}')
+        self.entries[partnbr-1]=entry
+
+    def validate(self):
+        """Raise ValueError for overlapping or out of range entries"""
+        last=None
+        for n,e in self.partitions():
+            if e.first<self.firstlba or e.last>self.lastlba or e.first>e.last:
+                raise ValueError(f'Partition {n} {e} outside usable lbas {self.firstlba}-{self.lastlba}')
+            if last is not None and e.first<=last[1].last:
+                raise ValueError(f'Partition {n} {e} overlaps partition {last[0]} {last[1]}')
+            last=(n,e)
+
+    def _packEntries(self):
+        array=bytearray(self.entrycount*self.entrysize)
+        for n,e in enumerate(self.entries):
+            if e is not None:
+                array[n*self.entrysize:n*self.entrysize+ENTRY_SIZE]=e.pack()
+        return(bytes(array))
+
+    def _packHeader(self, current, other, entrylba, entriescrc):
+        fields=[SIGNATURE,REVISION,HEADER_SIZE,0,0,current,other,
+            self.firstlba,self.lastlba,_guidBytes(self.diskguid),
+            entrylba,self.entrycount,self.entrysize,entriescrc]
+        header=struct.pack(HEADER_FORMAT,*fields)
+        fields[3]=zlib.crc32(header)
+        return(struct.pack(HEADER_FORMAT,*fields).ljust(self.sectorsize,b'\x00'))
+
+    def _packProtectiveMbr(self):
+        entry=struct.pack('<B3sB3sII',0,b'\x00\x02\x00',MBR_PARTTYPE_GPT,b'\xff\xff\xff',
+            1,min(self.sectorcount-1,0xffffffff))
+        mbr=self._bootcode[:MBR_BOOTCODE_SIZE]+entry+bytes(48)+MBR_SIGNATURE
+        return(mbr.ljust(self.sectorsize,b'\x00'))
+
+    def write(self):
+        """Write protective mbr, both headers & both entry arrays
+
+        The backup copy is written first, so a failure part way through
+        leaves at least one valid table on disk.
+        """
+        self.validate()
+        entries=self._packEntries()
+        entriescrc=zlib.crc32(entries)
+        backupentrylba=self.backuplba-self.entrysectors
+
+        fd=os.open(self.path,os.O_WRONLY)
+        try:
+            os.pwrite(fd,entries,backupentrylba*self.sectorsize)
+            os.pwrite(fd,self._packHeader(self.backuplba,1,backupentrylba,entriescrc),self.backuplba*self.sectorsize)
+            os.fsync(fd)
+            os.pwrite(fd,entries,2*self.sectorsize)
+            os.pwrite(fd,self._packHeader(1,self.backuplba,2,entriescrc),self.sectorsize)
+            os.pwrite(fd,self._packProtectiveMbr(),0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.primaryvalid=self.backupvalid=True
+
+
+def isRegularFile(path):
+    """True for disk image files, False for block devices"""
+    return(stat.S_ISREG(os.stat(path).st_mode))
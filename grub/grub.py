@@ -1,31 +1,30 @@
 from disk import Disk,Partition
-from util import bash,dlFile
 from pathlib import Path
-import config
-import stat
-import os
 from config import ROOT
-
-EMPTY_GRUB_CUSTOM_MENU='''
-#!/bin/sh
-exec tail -n +3 $0
-'''
+import tracing
+from manifest import Manifest
+from grub.theme import ThemeCache,FAILED
 
 GRUB_PATH=Path(ROOT,'grub/')
-GRUB_THEME_PATH=f'{GRUB_PATH}/theme'
+GRUB_THEME_PATH='grub/themes'   # Relative to the boot directory, grub_data
 GRUB_THEME_SOURCE_PATH=f'{GRUB_PATH}/themeSource'
+# archive: tar or zip of the theme, path: its directory within, when not the shallowest holding a theme.txt
 GRUB_THEMES={
     'Zenburn':{
-        'url':'https://github.com/trefmanic/grub2-zenburn'
+        'url':'https://github.com/trefmanic/grub2-zenburn',
+        'archive':'https://github.com/trefmanic/grub2-zenburn/archive/HEAD.tar.gz',
         },
     'Primitive':{
-        'url':'https://gitlab.com/fffred/primitivistical-grub.git'
+        'url':'https://gitlab.com/fffred/primitivistical-grub.git',
+        'archive':'https://gitlab.com/fffred/primitivistical-grub/-/archive/master/primitivistical-grub-master.tar.gz',
         },
     'PolyDark':{
-        'url':'https://github.com/shvchk/poly-dark'
+        'url':'https://github.com/shvchk/poly-dark',
+        'archive':'https://github.com/shvchk/poly-dark/archive/HEAD.tar.gz',
         },
     'Griffin':{
-        'url':'https://github.com/LordShenron/Grub-Themes/tree/griffin-grub-remix'
+        'url':'https://github.com/LordShenron/Grub-Themes/tree/griffin-grub-remix',
+        'archive':'https://github.com/LordShenron/Grub-Themes/archive/griffin-grub-remix.tar.gz',
     }
 }
 GRUB_MKCONFIG_OPTS={
@@ -33,16 +32,93 @@ GRUB_MKCONFIG_OPTS={
     'GRUB_TIMEOUT=-1',
     'GRUB_TIMEOUT_STYLE=menu',
 }
-GRUB_SYSTEM_CONFIG_DIR='/etc/grub.d'
-GRUB_MENU_FILE='50_custom'
-GRUB_MENU_WHITELIST=['00_header']
+GRUB_CFG='grub/grub.cfg'     # Relative to the boot directory, grub_data
+GRUB_CFG_MODULES=['part_gpt','ext2']
+
+
+def grubQuote(value):
+    """value as a single quoted grub script word"""
+    return("'"+str(value).replace("'","'\\''")+"'")
+
+def grubOptions(opts=GRUB_MKCONFIG_OPTS):
+    """GRUB_* settings from KEY=value strings, as a dict"""
+    return(dict(o.split('=',1) for o in opts))
+
+def renderMenuEntry(entry, savedefault=False):
+    """grub.cfg menuentry of an entry added with GrubDisk.addGrubMenuEntry"""
+    cl=f" --class {grubQuote(entry['class'])}" if entry['class'] is not None else ''
+    lines=[f"menuentry {grubQuote(entry['name'])}{cl} {{"]
+    if savedefault:
+        lines.append('\tsavedefault')
+    lines.extend([
+        '\tinsmod ext2',
+        f"\tsearch --no-floppy --set=root --fs-uuid {entry['fsuuid']}",
+        f"\tlinux {entry['kernelpath']} {entry['kernelarg']}".rstrip(),
+        '}',
+    ])
+    return('\n'.join(lines)+'\n')
+
+def renderGrubCfg(entries, opts=GRUB_MKCONFIG_OPTS, theme=None):
+    """grub.cfg booting entries, as grub-mkconfig would with only 00_header & a custom menu
+
+    Settings understood are GRUB_DEFAULT, GRUB_SAVEDEFAULT, GRUB_TIMEOUT &
+    GRUB_TIMEOUT_STYLE.
 
+    :param entries: Menu entry dicts, see GrubDisk.addGrubMenuEntry
+    :param opts: KEY=value strings, see GRUB_MKCONFIG_OPTS
+    :param theme: {'name','fonts'} of a theme installed to GRUB_THEME_PATH, see GrubDisk.installTheme
+    """
+    options=grubOptions(opts)
+    savedefault=options.get('GRUB_SAVEDEFAULT')=='true'
+    lines=['# Written by install.py, regenerated on every install']
+    lines.extend(f'insmod {m}' for m in GRUB_CFG_MODULES)
+    lines.extend([
+        'if [ -s $prefix/grubenv ]; then',
+        '  load_env',
+        'fi',
+    ])
+    if savedefault or options.get('GRUB_DEFAULT')=='saved':
+        lines.extend([
+            'if [ "${next_entry}" ] ; then',
+            '  set default="${next_entry}"',
+            '  set next_entry=',
+            '  save_env next_entry',
+            '  set boot_once=true',
+            'else',
+            '  set default="${saved_entry}"',
+            'fi',
+            'function savedefault {',
+            '  if [ -z "${boot_once}" ]; then',
+            '    saved_entry="${chosen}"',
+            '    save_env saved_entry',
+            '  fi',
+            '}',
+        ])
+    else:
+        lines.append(f"set default={grubQuote(options.get('GRUB_DEFAULT','0'))}")
+    if theme is not None:
+        # $prefix is the grub directory of grub_data
+        themepath=f"$prefix/{Path(GRUB_THEME_PATH).relative_to('grub')}/{theme['name']}"
+        lines.extend(['insmod all_video','insmod gfxterm','insmod png','terminal_output gfxterm'])
+        # Double quoted, for $prefix to expand
+        lines.extend(f'loadfont "{themepath}/{f}"' for f in theme['fonts'])
+        lines.append(f'set theme="{themepath}/theme.txt"')
+    lines.append(f"set timeout_style={options.get('GRUB_TIMEOUT_STYLE','menu')}")
+    lines.append(f"set timeout={options.get('GRUB_TIMEOUT','5')}")
+    return('\n'.join(lines)+'\n\n'+''.join(renderMenuEntry(e,savedefault) for e in entries))
+
+def getThemes(names=None):
+    """Fetch configured themes concurrently, those unchanged since last fetched are kept
 
-def getThemes():
-    """Get configured themes"""
-    for theme,data in GRUB_THEMES.items():
-        dlFile(data['url'],Path(config.ROOT,GRUB_THEME_SOURCE_PATH),True)
-        print(theme)
+    :param names: Themes of GRUB_THEMES to fetch, all when None
+    :return: ThemeCache holding them
+    """
+    cache=ThemeCache(GRUB_THEME_SOURCE_PATH)
+    themes={n:d for n,d in GRUB_THEMES.items() if names is None or n in names}
+    for theme,result in cache.fetchAll(themes).items():
+        error=f': {cache.errors[theme]}' if result==FAILED else ''
+        print(f'{theme} {result}{error}')
+    return(cache)
 
             
         
@@ -58,26 +134,62 @@ class GrubDisk(Disk):
     GRUB_DATA_FSLABEL='grub_data'
     
     GRUB_PARTFLAG='bios_grub'
+    GRUB_BOOT_WITHIN=2*1024     # core.img must be within the first 2[GiB], in MiB
     
     # None for boot partition
     
-    def __init__(self, path):
+    def __init__(self, path, commit=True, executor=None, keep=False):
         '''Initialize disk so that partitions may be edited. 
         
-        Attempts to make grub data partition in the next available area on disk. 
+        Plans grub bios boot & data partitions in the next available area on disk,
+        on self.layout. Grub is installed once that layout is committed.
         Assumes there is a 1Mibi block of free space at beginning of disk
+
+        :param commit: When False, the caller may add further partitions to
+            self.layout and must commit it, so the whole table is written at once
+        :param executor: See Disk
+        :param keep: Keep grub partitions already on disk, and skip installing
+            grub again when the manifest on grub_data says it was installed to them
         '''
 
-        super().__init__(path)
+        super().__init__(path,executor=executor)
         
-        self.rawGrubmenu=EMPTY_GRUB_CUSTOM_MENU
         self.grubmenu=[]
+        self.theme=None
 
+        self.keep=keep
+        self.grubinstalled=False
+        self.layout=self.partitiontable.newLayout()
         self._initGrubBiosBootPartition()
         self._initGrubDataPartition()
-        
+        self.layout.onCommit(self._onLayoutCommitted)
 
-        
+        # Only a kept grub_data partition can hold a manifest worth comparing with
+        self.manifest=Manifest.read(self.partitiontable.getPartitionBy(self.grubuuid)) if keep else Manifest()
+
+        if commit:
+            self.layout.commit()
+
+    def _onLayoutCommitted(self):
+        '''Resolve the planned grub partitions & install grub to them'''
+        self.grubbootpartition=self.partitiontable.getPartitionBy(self.grubbootuuid)
+        self.grubpartition=self.partitiontable.getPartitionBy(self.grubuuid)
+        if self.manifest.grubCurrent(self.grubbootuuid,self.grubuuid):
+            print(f'Grub already installed to {self.device}')
+            return
+        self._installGrub()
+        self.manifest.setGrub(self.grubbootuuid,self.grubuuid)
+        self.grubinstalled=True
+
+    def writeManifest(self):
+        '''Save the manifest to grub_data. See manifest.Manifest'''
+        self.manifest.write(self.grubpartition)
+
+    def grubMenuChanged(self):
+        '''Whether the menu entries added differ from those last written, or grub was installed afresh'''
+        return(self.grubinstalled or not self.manifest.menuCurrent(self.renderGrubMenu()))
+
+    @tracing.traced('grub-install')
     def _installGrub(self):
         '''Installs grub to the grub data partition once its fs has been intialized
         
@@ -90,7 +202,7 @@ class GrubDisk(Disk):
         # see function grub_make_system_path_relative_to_its_root_os of grub source 
         option=f'--boot-directory={self.grubpartition.getMountpoint()}'
         print(f"Installing grub to disk {self.device}'s mbr, boot partition {self.grubbootpartition} & grub data partition {self.grubpartition}")
-        result = bash(f'sudo grub-install {option} {self.device}')
+        result = self.executor.run(f'sudo grub-install {option} {self.device}')
         print(result.stdout)
         
     def addGrubMenuEntry(self, 
@@ -99,40 +211,44 @@ class GrubDisk(Disk):
                         kernelpath:str,
                         kernelarg:str,
                         cl=None):
+        '''Add an entry booting kernelpath from the filesystem of partition'''
+        self.grubmenu.append({
+            'name':name,
+            'fsuuid':partition.fsuuid,
+            'kernelpath':kernelpath,
+            'kernelarg':kernelarg,
+            'class':cl,
+            })
+
+    def renderGrubMenu(self):
+        '''grub.cfg of the menu entries added. See renderGrubCfg'''
+        return(renderGrubCfg(self.grubmenu,theme=self.theme))
 
-        entry=f'''
-            menuentry {name} 
-            {f"--class={cl}" if cl is not None else ""} {{
-                search --set=root --label {partition.fslabel}
-                linux {kernelpath} {kernelarg}
+    def installTheme(self, name, cache:ThemeCache):
+        '''Copy a fetched theme to grub_data & show the menu with it
 
-            }}
+        :param cache: Holding the theme, see getThemes
         '''
-        self.grubmenu.append(entry)
-        
+        source=cache.themeDir(name,GRUB_THEMES[name].get('path'))
+        if source is None:
+            raise ValueError(f'Theme {name} has not been fetched')
+        target=Path(self.grubpartition.getMountpoint(),GRUB_THEME_PATH,name)
+        print(f'Installing theme {name} to {target}')
+        self.executor.run(f'sudo rm -rf {target}')
+        self.executor.run(f'sudo mkdir -p {target}')
+        self.executor.run(f'sudo cp -r {source}/. {target}')
+        self.theme={'name':name,'fonts':sorted(str(f.relative_to(source)) for f in source.rglob('*.pf2'))}
+
+    @tracing.traced('grub-menu')
     def updateGrubMenu(self):
-        '''Updates the grub menu in grub_data'''
-        
-        # Write menu file. Disable all others. 
-        resetExecuteFile=[]
-        for entry in os.scandir(Path(GRUB_SYSTEM_CONFIG_DIR)):
-            if entry.is_file() and not entry.name in GRUB_MENU_WHITELIST:
-                entryStat=entry.stat()
-                if stat.filemode(entryStat.st_mode)[-1]=='x':
-                    resetExecuteFile.append(entry.path)
-                    bash(f'sudo chmod -x {entry.path}')
-
-        menuFilePath=Path(ROOT,GRUB_MENU_FILE)
-        menuFile=open(menuFilePath,'wt')
-        menuFile.write(EMPTY_GRUB_CUSTOM_MENU)
-        [menuFile.write(entry) for entry in self.grubmenu ]
-        menuFile.close()
-        bash(f'sudo chmod +x {menuFilePath}')
-        bash(f'sudo cp {menuFilePath} {GRUB_SYSTEM_CONFIG_DIR}')
-        bash(f'sudo grub-mkconfig -o {self.grubpartition.mountpoint}')
-        os.unlink(menuFilePath)
-        [bash(f'sudo chmod +x {p}') for p in resetExecuteFile]
-        # Renable others. Remove menu file.
+        '''Write grub.cfg to grub_data
+
+        The menu is rendered in process, the hosts grub-mkconfig & /etc/grub.d
+        are neither run nor touched.
+        '''
+        menu=self.renderGrubMenu()
+        self.executor.writeFile(Path(self.grubpartition.getMountpoint(),GRUB_CFG),menu.encode())
+        self.manifest.setMenu(menu)
 
     def _initGrubDataPartition(self,size=GRUB_DATA_SIZE):
         ''' Install grub_data partition, format it.
@@ -142,13 +258,11 @@ class GrubDisk(Disk):
         '''
 
 
-        uuid=self.partitiontable.addPartition(size, 
-                                         fstype='ext4',
-                                         partitionlabel=GrubDisk.GRUB_DATA_PARTLABEL);
-        
-
-        self.grubpartition=self.partitiontable.getPartitionBy(uuid)
-        self._installGrub()
+        self.grubuuid=self.layout.add(size, 
+                                      keep=self.keep,
+                                      fstype='ext4',
+                                      fslabel=GrubDisk.GRUB_DATA_FSLABEL,
+                                      partitionlabel=GrubDisk.GRUB_DATA_PARTLABEL);
 
     def _initGrubBiosBootPartition(self,size=GRUB_BOOT_SIZE):
         ''' Install grub_bios_boot partition
@@ -160,13 +274,11 @@ class GrubDisk(Disk):
         used to load grubs core.img. core.img will load device drivers that enable
         access to the partition holding grub files. (grub_data)
         
-        ASSUMES: 
-            *) The sector returned by self._getNextFreeSectorBlock() has enough space 
-            following it for this partition.
-            *) The sector returned by self._getNextFreeSectorBlock() is within the first
-            2[GiB] - size[MiB] of disk space
+        The partition is placed in the first free aligned block that holds it,
+        which must lie within the first GRUB_BOOT_WITHIN[MiB] of disk space
         '''
-        uuid=self.partitiontable.addPartition(size, 
-                                         partitionlabel=GrubDisk.GRUB_BOOT_PARTLABEL,
-                                         partitionflag=[GrubDisk.GRUB_PARTFLAG]);
-        self.grubbootpartition=self.partitiontable.getPartitionBy(uuid)
+        self.grubbootuuid=self.layout.add(size, 
+                                          partitionlabel=GrubDisk.GRUB_BOOT_PARTLABEL,
+                                          keep=self.keep,
+                                          partitionflag=[GrubDisk.GRUB_PARTFLAG],
+                                          within=GrubDisk.GRUB_BOOT_WITHIN);
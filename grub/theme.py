@@ -0,0 +1,164 @@
+"""
+Fetch, cache & unpack grub themes.
+
+Each theme has its own directory in the cache, holding its archive, the
+validators it was served with and the archive unpacked. Themes are fetched
+concurrently with conditional requests, so a theme the server reports as
+not modified since (304) is neither downloaded nor unpacked again. A theme
+that fails to fetch does not stop the others, its cached copy, if any, is
+used instead.
+
+    cache=ThemeCache(GRUB_THEME_SOURCE_PATH)
+    results=cache.fetchAll({'Zenburn':{'archive':'https://...tar.gz'}})
+    cache.themeDir('Zenburn')      # Directory holding theme.txt
+"""
+
+import json
+import os
+import shutil
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import tracing
+
+WORKERS=4
+TIMEOUT=30
+BLOCK_SIZE=256*pow(2,10)
+
+FETCHED='fetched'
+UNCHANGED='unchanged'
+FAILED='failed'
+
+ARCHIVE_FILE='archive'
+META_FILE='meta.json'
+UNPACKED_DIR='unpacked'
+THEME_FILE='theme.txt'
+
+
+def _unpack(archive, target):
+    """Unpack a tar or zip archive into target, refusing members outside of it"""
+    root=os.path.realpath(target)
+    def inside(name):
+        path=os.path.realpath(os.path.join(root,name))
+        return(path==root or path.startswith(root+os.sep))
+    if tarfile.is_tarfile(archive):
+        with tarfile.open(archive) as tar:
+            members=[m for m in tar.getmembers() if (m.isfile() or m.isdir()) and inside(m.name)]
+            tar.extractall(target,members)
+    elif zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as z:
+            z.extractall(target,[n for n in z.namelist() if inside(n)])
+    else:
+        raise ValueError(f'{archive} is neither a tar nor a zip archive')
+
+
+class ThemeCache:
+    """Themes fetched to, and unpacked in, root
+
+    :param workers: Themes fetched concurrently
+    """
+
+    def __init__(self, root, workers=WORKERS):
+        self.root=Path(root)
+        self.workers=workers
+        self._lock=threading.Lock()
+
+    def _dir(self, name):
+        return(Path(self.root,name))
+
+    def _meta(self, name):
+        try:
+            return(json.loads(Path(self._dir(name),META_FILE).read_text()))
+        except (OSError,ValueError):
+            return({})
+
+    def fetch(self, name, url):
+        """Fetch theme name from url unless the cached copy is current
+
+        :return: FETCHED or UNCHANGED
+        """
+        directory=self._dir(name)
+        directory.mkdir(parents=True,exist_ok=True)
+        meta=self._meta(name)
+        headers={}
+        # Validators only apply to the same url, with the archive unpacked
+        if meta.get('url')==url and Path(directory,UNPACKED_DIR).is_dir():
+            if meta.get('etag'):
+                headers['If-None-Match']=meta['etag']
+            if meta.get('lastmodified'):
+                headers['If-Modified-Since']=meta['lastmodified']
+
+        part=Path(directory,f'{ARCHIVE_FILE}.part')
+        request=urllib.request.Request(url,headers=headers)
+        try:
+            with urllib.request.urlopen(request,timeout=TIMEOUT) as resp, open(part,'wb') as out:
+                shutil.copyfileobj(resp,out,BLOCK_SIZE)
+                meta={
+                    'url':url,
+                    'etag':resp.getheader('ETag'),
+                    'lastmodified':resp.getheader('Last-Modified'),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code==304:
+                return(UNCHANGED)
+            raise
+        except BaseException:
+            if part.exists():
+                part.unlink()
+            raise
+
+        archive=Path(directory,ARCHIVE_FILE)
+        os.replace(part,archive)
+        # Unpack beside the current copy, then swap, so a failed unpack leaves it be
+        unpacking=Path(directory,f'{UNPACKED_DIR}.new')
+        shutil.rmtree(unpacking,ignore_errors=True)
+        _unpack(archive,unpacking)
+        unpacked=Path(directory,UNPACKED_DIR)
+        shutil.rmtree(unpacked,ignore_errors=True)
+        os.replace(unpacking,unpacked)
+        temp=Path(directory,f'{META_FILE}.tmp')
+        temp.write_text(json.dumps(meta))
+        os.replace(temp,Path(directory,META_FILE))
+        return(FETCHED)
+
+    @tracing.traced('themes')
+    def fetchAll(self, themes):
+        """Fetch themes concurrently
+
+        :param themes: {name:{'archive':url}}, as GRUB_THEMES
+        :return: {name:FETCHED|UNCHANGED|FAILED}, errors of failed fetches in self.errors
+        """
+        self.errors={}
+        results={}
+        def _fetch(name, url):
+            try:
+                result=self.fetch(name,url)
+            except Exception as e:
+                result=FAILED
+                with self._lock:
+                    self.errors[name]=e
+            with self._lock:
+                results[name]=result
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            [pool.submit(_fetch,name,data['archive']) for name,data in themes.items()]
+        return(results)
+
+    def themeDir(self, name, subpath=None):
+        """Directory of the unpacked theme holding its theme.txt, None if not cached
+
+        :param subpath: Directory of the theme within the archive. The
+            shallowest holding a theme.txt when None
+        """
+        unpacked=Path(self._dir(name),UNPACKED_DIR)
+        if not unpacked.is_dir():
+            return(None)
+        if subpath is not None:
+            # Archives of a repository hold it in a top level directory
+            found=list(unpacked.glob(f'{subpath}/{THEME_FILE}'))+list(unpacked.glob(f'*/{subpath}/{THEME_FILE}'))
+        else:
+            found=sorted(unpacked.rglob(THEME_FILE),key=lambda p:len(p.parts))
+        return(found[0].parent if found else None)
@@ -0,0 +1,397 @@
+"""
+Random access into gzip files through an index of access points, as zlib's
+examples/zran.c does.
+
+Building the index decompresses the file once, noting every SPAN bytes of
+output where a deflate block starts: its offset in the compressed & the
+decompressed data, the bit it starts at, and the 32KiB of output before it
+that later blocks may refer back to. Decompression can then start at the
+access point nearest below any offset rather than at the start of the file.
+The index is saved beside the file it describes.
+
+    index=GzipIndex.load(path) or GzipIndex.build(path).save()
+    with IndexedGzipReader(path,index) as f:
+        f.seek(offset)
+        data=f.read(size)
+
+Stopping at block ends and resuming part way through a byte need inflate
+with Z_BLOCK & inflatePrime, which the zlib module does not offer, so the
+system libz is called through ctypes. Where it cannot be loaded, available()
+is False and gzip files are only read from the start.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import zlib
+from pathlib import Path
+import progress
+import tracing
+
+SPAN=16*pow(2,20)           # Decompressed bytes between access points
+WINDOW_SIZE=32*pow(2,10)
+READ_SIZE=pow(2,20)
+INDEX_SUFFIX='.gzi'
+INDEX_MAGIC=b'GZIX\x01'
+
+Z_OK=0
+Z_STREAM_END=1
+Z_NEED_DICT=2
+Z_BUF_ERROR=-5
+Z_BLOCK=5
+WBITS_GZIP=15+32            # Automatic gzip or zlib header
+WBITS_RAW=-15
+
+BLOCK_END=128               # data_type flags after inflate(Z_BLOCK)
+LAST_BLOCK=64
+
+
+class _ZStream(ctypes.Structure):
+    _fields_=[
+        ('next_in',ctypes.c_void_p),
+        ('avail_in',ctypes.c_uint),
+        ('total_in',ctypes.c_ulong),
+        ('next_out',ctypes.c_void_p),
+        ('avail_out',ctypes.c_uint),
+        ('total_out',ctypes.c_ulong),
+        ('msg',ctypes.c_char_p),
+        ('state',ctypes.c_void_p),
+        ('zalloc',ctypes.c_void_p),
+        ('zfree',ctypes.c_void_p),
+        ('opaque',ctypes.c_void_p),
+        ('data_type',ctypes.c_int),
+        ('adler',ctypes.c_ulong),
+        ('reserved',ctypes.c_ulong),
+    ]
+
+_libz=None
+
+def _loadLibz():
+    global _libz
+    if _libz is None:
+        try:
+            lib=ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+            for name in ('inflateInit2_','inflate','inflateEnd','inflateReset2','inflatePrime','inflateSetDictionary'):
+                getattr(lib,name).restype=ctypes.c_int
+            lib.zlibVersion.restype=ctypes.c_char_p
+            _libz=lib
+        except (OSError,AttributeError):
+            _libz=False
+    return(_libz)
+
+def available():
+    """Whether gzip files can be indexed here"""
+    return(bool(_loadLibz()))
+
+
+class _Inflater:
+    """inflate of the system libz over caller supplied buffers"""
+
+    def __init__(self, wbits):
+        self.lib=_loadLibz()
+        if not self.lib:
+            raise OSError('libz could not be loaded, gzip files cannot be indexed')
+        self.strm=_ZStream()
+        self._check(self.lib.inflateInit2_(ctypes.byref(self.strm),wbits,self.lib.zlibVersion(),ctypes.sizeof(_ZStream)))
+        self._input=None
+
+    def _check(self, ret):
+        if ret<0 and ret!=Z_BUF_ERROR:
+            msg=self.strm.msg.decode(errors='replace') if self.strm.msg else ret
+            raise zlib.error(f'inflate failed: {msg}')
+        return(ret)
+
+    def close(self):
+        self.lib.inflateEnd(ctypes.byref(self.strm))
+
+    def reset(self, wbits):
+        self._check(self.lib.inflateReset2(ctypes.byref(self.strm),wbits))
+
+    def prime(self, bits, value):
+        self._check(self.lib.inflatePrime(ctypes.byref(self.strm),bits,value))
+
+    def setDictionary(self, window):
+        self._check(self.lib.inflateSetDictionary(ctypes.byref(self.strm),window,len(window)))
+
+    def feed(self, data):
+        """Make data the input. It is kept referenced until consumed"""
+        self._input=ctypes.create_string_buffer(data,len(data))
+        self.strm.next_in=ctypes.addressof(self._input)
+        self.strm.avail_in=len(data)
+
+    @property
+    def pending(self):
+        """Input bytes fed but not yet consumed"""
+        return(self.strm.avail_in)
+
+    def unconsumed(self):
+        """Input fed but not yet consumed, as bytes"""
+        if not self.strm.avail_in:
+            return(b'')
+        return(ctypes.string_at(self.strm.next_in,self.strm.avail_in))
+
+    def inflate(self, out, offset, space=None, flush=0):
+        """Inflate into out, a ctypes buffer, up to space bytes from offset
+
+        :return: (zlib return code, bytes written)
+        """
+        if space is None:
+            space=len(out)-offset
+        self.strm.next_out=ctypes.addressof(out)+offset
+        self.strm.avail_out=space
+        ret=self._check(self.lib.inflate(ctypes.byref(self.strm),flush))
+        if ret==Z_NEED_DICT:
+            raise zlib.error('inflate asked for a dictionary')
+        return(ret,space-self.strm.avail_out)
+
+
+class GzipIndex:
+    """Access points of a gzip file, (decompressed offset, compressed offset, bits, window)
+
+    bits is the number of bits of the byte before the compressed offset that
+    belong to the block starting there.
+    """
+
+    def __init__(self, path, points, size, span=SPAN):
+        self.path=Path(path)
+        self.points=points
+        self.size=size          # Decompressed bytes
+        self.span=span
+        self._outs=[p[0] for p in points]
+
+    @staticmethod
+    def indexPath(path):
+        return(Path(f'{path}{INDEX_SUFFIX}'))
+
+    @staticmethod
+    @tracing.traced('gzindex')
+    def build(path, span=SPAN):
+        """Index path, decompressing all of it once"""
+        inflater=_Inflater(WBITS_GZIP)
+        window=ctypes.create_string_buffer(WINDOW_SIZE)
+        points=[]
+        totin=totout=0
+        last=None
+        left=0                  # Space remaining in the circular window
+        try:
+            with open(path,'rb') as f, progress.bar('gzindex',os.fstat(f.fileno()).st_size,label=Path(path).name[:12]) as bar:
+                ret=Z_OK
+                while True:
+                    data=f.read(READ_SIZE)
+                    bar.add(len(data))
+                    if not data:
+                        if ret!=Z_STREAM_END:
+                            raise EOFError(f'{path} ends part way through a gzip member')
+                        break
+                    if ret==Z_STREAM_END:
+                        # Further gzip members follow
+                        inflater.reset(WBITS_GZIP)
+                    inflater.feed(data)
+                    while inflater.pending:
+                        if left==0:
+                            left=WINDOW_SIZE
+                        before=inflater.pending
+                        ret,n=inflater.inflate(window,WINDOW_SIZE-left,flush=Z_BLOCK)
+                        totin+=before-inflater.pending
+                        totout+=n
+                        left-=n
+                        if ret==Z_STREAM_END:
+                            if inflater.pending:
+                                inflater.reset(WBITS_GZIP)
+                                ret=Z_OK
+                            continue
+                        datatype=inflater.strm.data_type
+                        if datatype & BLOCK_END and not datatype & LAST_BLOCK and (last is None or totout-last>=span):
+                            # Window holds the last 32KiB of output, oldest from the write position on
+                            start=WINDOW_SIZE-left
+                            dictionary=window.raw[start:]+window.raw[:start] if totout>=WINDOW_SIZE else window.raw[:totout]
+                            points.append((totout,totin,datatype&7,dictionary))
+                            last=totout
+        finally:
+            inflater.close()
+        return(GzipIndex(path,points,totout,span))
+
+    def save(self, target=None):
+        """Write the index beside the gzip file, or to target"""
+        target=Path(target) if target is not None else GzipIndex.indexPath(self.path)
+        st=os.stat(self.path)
+        parts=[INDEX_MAGIC,struct.pack('<QQQI',st.st_size,self.size,self.span,len(self.points))]
+        for out,inp,bits,window in self.points:
+            packed=zlib.compress(window,1)
+            parts.append(struct.pack('<QQBI',out,inp,bits,len(packed)))
+            parts.append(packed)
+        temp=Path(f'{target}.tmp')
+        temp.write_bytes(b''.join(parts))
+        os.replace(temp,target)
+        return(self)
+
+    @staticmethod
+    def load(path, source=None):
+        """Index saved for the gzip file at path, None if there is none or it is stale
+
+        :param source: Index file, beside path when None
+        """
+        source=Path(source) if source is not None else GzipIndex.indexPath(path)
+        try:
+            data=source.read_bytes()
+        except OSError:
+            return(None)
+        if not data.startswith(INDEX_MAGIC):
+            return(None)
+        offset=len(INDEX_MAGIC)
+        compressedsize,size,span,count=struct.unpack_from('<QQQI',data,offset)
+        if compressedsize!=os.stat(path).st_size:
+            return(None)
+        offset+=struct.calcsize('<QQQI')
+        points=[]
+        header=struct.calcsize('<QQBI')
+        for _ in range(count):
+            out,inp,bits,packedsize=struct.unpack_from('<QQBI',data,offset)
+            offset+=header
+            points.append((out,inp,bits,zlib.decompress(data[offset:offset+packedsize])))
+            offset+=packedsize
+        return(GzipIndex(path,points,size,span))
+
+    def point(self, offset):
+        """Access point nearest at or below decompressed offset"""
+        lo,hi=0,len(self._outs)
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self._outs[mid]<=offset:
+                lo=mid+1
+            else:
+                hi=mid
+        return(self.points[max(lo-1,0)])
+
+
+class IndexedGzipReader:
+    """Read only, seekable file object over the decompressed content of a gzip file
+
+    Reads carry on from where the last one ended. Seeks forward less than a
+    span decompress through to the offset, others restart at the nearest
+    access point.
+    """
+
+    def __init__(self, path, index:GzipIndex, chunksize=READ_SIZE):
+        if not index.points:
+            raise ValueError(f'Index of {path} has no access points')
+        self.path=Path(path)
+        self.index=index
+        self.chunksize=chunksize
+        self._file=open(path,'rb')
+        self._inflater=None
+        self._raw=True          # Raw deflate from an access point, not a gzip member from its header
+        self._scratch=ctypes.create_string_buffer(chunksize)
+        self._position=0        # Offset the inflater will produce next
+        self.offset=0           # Offset of the next read
+        self.decompressed=0     # Bytes inflated, including those skipped over
+
+    def close(self):
+        if self._inflater is not None:
+            self._inflater.close()
+            self._inflater=None
+        self._file.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tell(self):
+        return(self.offset)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence==os.SEEK_CUR:
+            offset+=self.offset
+        elif whence==os.SEEK_END:
+            offset+=self.index.size
+        self.offset=max(offset,0)
+        return(self.offset)
+
+    def _start(self):
+        """Position the inflater at the access point at or below offset"""
+        if self._inflater is not None:
+            self._inflater.close()
+        out,inp,bits,window=self.index.point(self.offset)
+        self._inflater=_Inflater(WBITS_RAW)
+        self._raw=True
+        if bits:
+            # The block starts part way through the byte before
+            self._file.seek(inp-1)
+            self._inflater.prime(bits,self._file.read(1)[0]>>(8-bits))
+        else:
+            self._file.seek(inp)
+        if window:
+            self._inflater.setDictionary(window)
+        self._position=out
+
+    def _nextMember(self):
+        """Move past the end of a gzip member to the next one. False when none follows"""
+        rest=self._inflater.unconsumed()
+        if self._raw:
+            # Raw inflate leaves the crc & length trailer of the member
+            rest+=self._file.read(max(8-len(rest),0))
+            rest=rest[8:]
+        rest+=self._file.read(max(1-len(rest),0))
+        if not rest:
+            return(False)
+        self._inflater.reset(WBITS_GZIP)
+        self._raw=False
+        self._inflater.feed(rest)
+        return(True)
+
+    def _inflate(self, out, offset, space):
+        """Inflate up to space bytes into ctypes buffer out at offset. 0 at the end of the data"""
+        done=0
+        while done<space:
+            if not self._inflater.pending:
+                data=self._file.read(self.chunksize)
+                if not data:
+                    break
+                self._inflater.feed(data)
+            ret,n=self._inflater.inflate(out,offset+done,space-done)
+            done+=n
+            if ret==Z_STREAM_END and not self._nextMember():
+                break
+        return(done)
+
+    def readinto(self, buffer):
+        """Fill buffer from the current offset. Bytes read, 0 at the end"""
+        view=memoryview(buffer).cast('B')
+        if self._inflater is None or self.offset<self._position or self.offset-self._position>=self.index.span:
+            self._start()
+        # Decompress through to the offset asked for
+        while self._position<self.offset:
+            n=self._inflate(self._scratch,0,min(len(self._scratch),self.offset-self._position))
+            if n==0:
+                return(0)
+            self._position+=n
+            self.decompressed+=n
+        out=(ctypes.c_char*len(view)).from_buffer(view)
+        done=self._inflate(out,0,len(view))
+        self._position+=done
+        self.decompressed+=done
+        self.offset=self._position
+        return(done)
+
+    def read(self, size=-1):
+        if size is None or size<0:
+            size=max(self.index.size-self.offset,0)
+        buffer=bytearray(size)
+        n=self.readinto(buffer)
+        del buffer[n:]
+        return(bytes(buffer))
+
+    def chunks(self, start, length, chunksize=None):
+        """Yield the length bytes from start in chunks of at most chunksize"""
+        chunksize=chunksize or self.chunksize
+        self.seek(start)
+        remaining=length
+        while remaining>0:
+            chunk=self.read(min(chunksize,remaining))
+            if not chunk:
+                break
+            remaining-=len(chunk)
+            yield(chunk)
@@ -0,0 +1,683 @@
+"""
+Read OS disk images (.img.gz) as a stream.
+
+The image is decompressed in bounded chunks and never lands on disk, the
+partition table is parsed from the head of the stream and the bytes of a
+partition are written straight to a target device.
+
+One stream can feed the same partition to many targets at once, so a
+batch of disks costs a single decompression. See fanoutPartition.
+
+Given the access point index of a .gz, see gzindex, the partition table is
+read and a partition extracted by seeking to it, decompressing only the
+bytes wanted.
+
+Partitions are written through blockwrite, in aligned direct writes of a
+block size & depth calibrated to each target.
+
+Decompressed images can instead be cloned a partition at a time, copying
+only the extents holding data. See clonePartition. Whole golden disk images
+are replicated the same way, see replicateImage.
+"""
+
+import errno
+import fcntl
+import os
+import queue
+import stat
+import struct
+import subprocess
+import threading
+import zlib
+from pathlib import Path
+from blockwrite import BlockWriter,BLOCK_SIZE,tuning
+from gpt import GptTable,GptEntry,isRegularFile
+from gzindex import IndexedGzipReader
+import progress
+import tracing
+
+CHUNK_SIZE=4*pow(2,20)
+HEAD_CHUNK_SIZE=pow(2,20)
+SECTOR_SIZE=512
+
+MBR_SIGNATURE=b'\x55\xaa'
+MBR_PARTTYPE_GPT=0xee
+GPT_SIGNATURE=b'EFI PART'
+GZIP_MAGIC=b'\x1f\x8b'
+
+FANOUT_DEPTH=8              # Chunks queued per target before the stream waits for it
+CLONE_BLOCK_SIZE=pow(2,20)  # Zero blocks are detected, and skipped, in these
+BLKZEROOUT=0x127f           # _IO(0x12,127), zero a byte range of a block device
+
+
+def gzipChunks(path, chunksize=CHUNK_SIZE):
+    """Yield decompressed chunks of a gzip file
+
+    No chunk is larger than chunksize, so memory stays bounded regardless of
+    the compression ratio. Multi member gzip files are handled.
+
+    :param path: gzip file
+    :param chunksize: Max bytes read from, and yielded out of, the archive at once
+    """
+    decompressor=zlib.decompressobj(16+zlib.MAX_WBITS)
+    with open(path,'rb') as archive:
+        while True:
+            data=archive.read(chunksize)
+            if not data:
+                break
+            while data:
+                out=decompressor.decompress(data,chunksize)
+                if out:
+                    yield(out)
+                if decompressor.eof:
+                    # Next gzip member, if any
+                    data=decompressor.unused_data
+                    decompressor=zlib.decompressobj(16+zlib.MAX_WBITS)
+                else:
+                    data=decompressor.unconsumed_tail
+        out=decompressor.flush()
+        if out:
+            yield(out)
+
+
+def imageChunks(path, chunksize=CHUNK_SIZE):
+    """Yield chunks of a disk image, decompressing it when it is gzipped"""
+    with open(path,'rb') as f:
+        compressed=f.read(len(GZIP_MAGIC))==GZIP_MAGIC
+    if compressed:
+        yield from gzipChunks(path,chunksize)
+        return
+    with open(path,'rb') as f:
+        while True:
+            chunk=f.read(chunksize)
+            if not chunk:
+                break
+            yield(chunk)
+
+
+class ImageStream:
+    """Forward only file like reader over an iterable of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks=iter(chunks)
+        self._buffer=memoryview(b'')
+        self.position=0
+
+    def _fill(self):
+        """Refill buffer from the next chunk. False when exhausted"""
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer=memoryview(chunk)
+                return(True)
+        return(False)
+
+    def readChunk(self, limit=CHUNK_SIZE):
+        """Return the next buffered run of at most limit bytes without joining chunks
+
+        :return: memoryview, empty when the stream is exhausted
+        """
+        if not self._buffer and not self._fill():
+            return(memoryview(b''))
+        out=self._buffer[:limit]
+        self._buffer=self._buffer[len(out):]
+        self.position+=len(out)
+        return(out)
+
+    def read(self, size):
+        """Read exactly size bytes, or less at end of stream"""
+        parts=[]
+        while size>0:
+            chunk=self.readChunk(size)
+            if not chunk:
+                break
+            parts.append(bytes(chunk))
+            size-=len(chunk)
+        return(b''.join(parts))
+
+    def seek(self, offset):
+        """Skip forward to offset. Streams cannot go backwards"""
+        if offset<self.position:
+            raise ValueError(f'Cannot seek backwards from {self.position} to {offset}')
+        while self.position<offset:
+            if not self.readChunk(offset-self.position):
+                raise EOFError(f'Stream ended at {self.position} before offset {offset}')
+
+
+def parsePartitionTable(head, sectorsize=SECTOR_SIZE):
+    """Parse the msdos or gpt partition table at the start of a disk image
+
+    :param head: Bytes from the start of the image, through the gpt entry array
+    :return: list of {'partnbr','start','size'} with start & size in sectors,
+        ordered by start sector
+    """
+    if head[510:512]!=MBR_SIGNATURE:
+        raise ValueError('Image has no partition table')
+
+    partitions=[]
+    for n in range(4):
+        entry=head[446+16*n:446+16*(n+1)]
+        parttype=entry[4]
+        start,size=struct.unpack('<II',entry[8:16])
+        if parttype==MBR_PARTTYPE_GPT:
+            return(_parseGptEntries(head,sectorsize))
+        if parttype!=0 and size>0:
+            partitions.append({'partnbr':n+1,'start':start,'size':size})
+
+    partitions.sort(key=lambda p:p['start'])
+    return(partitions)
+
+
+def _parseGptEntries(head, sectorsize):
+    header=head[sectorsize:2*sectorsize]
+    if header[0:8]!=GPT_SIGNATURE:
+        raise ValueError('Protective mbr found but no gpt header')
+    entrylba,entrycount,entrysize=struct.unpack('<QII',header[72:88])
+    partitions=[]
+    for n in range(entrycount):
+        offset=entrylba*sectorsize+n*entrysize
+        entry=head[offset:offset+entrysize]
+        if len(entry)<entrysize:
+            raise ValueError('Image head too short to hold gpt partition entries')
+        first,last=struct.unpack('<QQ',entry[32:48])
+        if entry[0:16]==bytes(16):
+            continue
+        partitions.append({'partnbr':n+1,'start':first,'size':last-first+1})
+    partitions.sort(key=lambda p:p['start'])
+    return(partitions)
+
+
+def gptHeadSize(head, sectorsize=SECTOR_SIZE):
+    """Bytes needed from the start of the image to parse its partition table"""
+    header=head[sectorsize:2*sectorsize]
+    if header[0:8]!=GPT_SIGNATURE:
+        return(sectorsize)
+    entrylba,entrycount,entrysize=struct.unpack('<QII',header[72:88])
+    return(entrylba*sectorsize+entrycount*entrysize)
+
+
+def readPartitionTable(stream, sectorsize=SECTOR_SIZE):
+    """Read and parse the partition table from the head of an ImageStream"""
+    head=stream.read(2*sectorsize)
+    needed=gptHeadSize(head,sectorsize)
+    if needed>len(head):
+        head+=stream.read(needed-len(head))
+    return(parsePartitionTable(head,sectorsize))
+
+
+def listPartitions(path, index=None):
+    """Partitions of a disk image, read from its head only
+
+    :param path: Disk image, optionally gzip compressed
+    :param index: gzindex.GzipIndex of path when gzipped, to seek rather than stream
+    :return: See parsePartitionTable
+    """
+    if index is not None:
+        with IndexedGzipReader(path,index) as reader:
+            return(readPartitionTable(reader))
+    # Small chunks, the table is in the first few KiB
+    return(readPartitionTable(ImageStream(imageChunks(path,HEAD_CHUNK_SIZE))))
+
+
+class PrivilegedWriter:
+    """Writable file object for a block device or file, through a
+    blockwrite.BlockWriter tuned to it, or via sudo dd when the current
+    user cannot write to it directly
+
+    :param bytesize: Bytes to be written, when known, for blockwrite.tuning
+    :param offset: Byte offset in path to write from, as of a partition in an
+        image file. See disk.Partition backing & offset
+    """
+
+    def __init__(self, path, bytesize=None, offset=0):
+        self.path=Path(path)
+        self._process=None
+        self._file=None
+        if os.access(self.path,os.W_OK):
+            blocksize,depth=tuning(self.path,bytesize,offset)
+            self._file=BlockWriter(self.path,blocksize,depth,offset=offset)
+        else:
+            oflag=['seek_bytes'] if offset else []
+            argv=['sudo','dd',f'of={self.path}',f'bs={BLOCK_SIZE}','conv=notrunc,fsync','status=none']
+            if offset:
+                argv.append(f'seek={offset}')
+            if stat.S_ISBLK(os.stat(self.path).st_mode):
+                # Whole blocks from the pipe, written past the page cache
+                argv.append('iflag=fullblock')
+                oflag.append('direct')
+            if oflag:
+                argv.append(f"oflag={','.join(oflag)}")
+            self._process=subprocess.Popen(argv,stdin=subprocess.PIPE)
+            self._file=self._process.stdin
+
+    def write(self, data):
+        return(self._file.write(data))
+
+    def close(self):
+        if self._process is None:
+            self._file.close()
+            return
+        self._file.close()
+        if self._process.wait()!=0:
+            raise OSError(f'Writing to {self.path} failed with {self._process.returncode}')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FanOutWriter:
+    """Writes one stream of chunks to many targets concurrently
+
+    Each target is written by its own thread, fed through a queue of at most
+    depth chunks. The stream only waits on a target once its queue is full,
+    so a batch moves at the pace of its slowest target. Chunks are shared
+    between targets, not copied. A target that fails is dropped, its error
+    kept, while the others carry on.
+
+    :param targets: Devices or files, see PrivilegedWriter
+    :param bytesize: Bytes to be written to each, when known
+    :param offsets: {target:byte offset} to write targets from, 0 for those not given
+    """
+
+    def __init__(self, targets, depth=FANOUT_DEPTH, bytesize=None, offsets=None):
+        self.bytesize=bytesize
+        self.offsets=offsets or {}
+        self.errors={}
+        self._queues={t:queue.Queue(depth) for t in targets}
+        self._threads=[threading.Thread(target=self._writer,args=(t,q),daemon=True) for t,q in self._queues.items()]
+        [t.start() for t in self._threads]
+
+    def _writer(self, target, chunks):
+        ended=False
+        try:
+            with PrivilegedWriter(target,self.bytesize,self.offsets.get(target,0)) as out:
+                while True:
+                    chunk=chunks.get()
+                    if chunk is None:
+                        ended=True
+                        break
+                    out.write(chunk)
+        except Exception as e:
+            self.errors[target]=e
+            # Keep taking chunks until the end, so the stream never waits on a failed target.
+            # Closing can fail after the end was taken, as on a failed sync, with nothing left to take
+            if not ended:
+                while chunks.get() is not None:
+                    pass
+
+    def write(self, chunk):
+        """Queue chunk for every target still working
+
+        :raises OSError: Once every target has failed
+        """
+        live=[q for t,q in self._queues.items() if t not in self.errors]
+        if not live:
+            raise OSError(f'Writing to all of {", ".join(map(str,self._queues))} failed')
+        for q in live:
+            q.put(chunk)
+
+    def close(self):
+        """Wait for every target to be written
+
+        :return: {target:exception} of the targets that failed
+        """
+        for q in self._queues.values():
+            q.put(None)
+        [t.join() for t in self._threads]
+        return(self.errors)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _openPartition(tarballpath, partnbr, chunksize, index=None):
+    """Stream of an image positioned at the start of one of its partitions
+
+    :param index: gzindex.GzipIndex of tarballpath, to seek to the partition
+        instead of decompressing everything before it
+    :return: (ImageStream, bytesize of the partition)
+    """
+    if index is not None:
+        reader=IndexedGzipReader(tarballpath,index,min(chunksize,pow(2,20)))
+        stream=reader
+    else:
+        stream=ImageStream(imageChunks(tarballpath,chunksize))
+    partitions=readPartitionTable(stream)
+    if len(partitions)==0:
+        raise ValueError(f'No partitions found in {tarballpath}')
+
+    if partnbr is None:
+        source=partitions[0]
+    else:
+        source=next(filter(lambda p:p['partnbr']==partnbr,partitions),None)
+        if source is None:
+            raise ValueError(f'No partition {partnbr} in {tarballpath}')
+
+    if index is not None:
+        return(ImageStream(_closing(reader,reader.chunks(source['start']*SECTOR_SIZE,source['size']*SECTOR_SIZE,chunksize))),source['size']*SECTOR_SIZE)
+    stream.seek(source['start']*SECTOR_SIZE)
+    return(stream,source['size']*SECTOR_SIZE)
+
+
+def _closing(reader, chunks):
+    """Yield chunks, closing reader once they are done with"""
+    with reader:
+        yield from chunks
+
+
+def streamPartition(tarballpath, target, partnbr=None, targetbytesize=None, chunksize=CHUNK_SIZE, index=None, digest=None, offset=0):
+    """Read an image and write one of its partitions to target, in one pass
+
+    Nothing is written to scratch space. Memory use is bounded by chunksize.
+
+    :param tarballpath: Disk image, optionally gzip compressed
+    :param target: Device or file to receive the partition contents
+    :param partnbr: Partition number in the image. First partition on disk when None
+    :param targetbytesize: When given, refuse partitions that do not fit
+    :param index: gzindex.GzipIndex of tarballpath, see _openPartition
+    :param digest: Fed every byte written, as checksum.BlockDigest, for verification after
+    :param offset: Byte offset of the partition in target, for a partition
+        of an image file. See disk.Partition backing & offset
+    :return: Number of bytes written
+    """
+    stream,bytesize=_openPartition(tarballpath,partnbr,chunksize,index)
+    if targetbytesize is not None and bytesize>targetbytesize:
+        raise ValueError(f'Partition of {bytesize}[B] in {tarballpath} does not fit {target} of {targetbytesize}[B]')
+
+    remaining=bytesize
+    with PrivilegedWriter(target,bytesize,offset) as out, progress.bar('stream',bytesize,label=str(target)) as bar:
+        while remaining>0:
+            chunk=stream.readChunk(min(chunksize,remaining))
+            if not chunk:
+                raise EOFError(f'{tarballpath} ended {remaining}[B] short of partition end')
+            out.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            remaining-=len(chunk)
+            bar.add(len(chunk))
+    return(bytesize)
+
+
+def fanoutPartition(tarballpath, targets, partnbr=None, chunksize=CHUNK_SIZE, depth=FANOUT_DEPTH, index=None, digest=None, offsets=None):
+    """Write one partition of an image to many targets, decompressing it once
+
+    :param targets: {target:bytesize}. Targets of a size given, and smaller
+        than the partition, are refused
+    :param partnbr, chunksize, index, digest: See streamPartition. The
+        stream is hashed once, while the targets are written
+    :param depth: Chunks queued per target, see FanOutWriter
+    :param offsets: {target:byte offset} of the partition in targets that are
+        image files, see streamPartition
+    :return: (bytes written to each target, {target:exception} of those that failed)
+    """
+    stream,bytesize=_openPartition(tarballpath,partnbr,chunksize,index)
+    errors={}
+    for target,targetbytesize in targets.items():
+        if targetbytesize is not None and bytesize>targetbytesize:
+            errors[target]=ValueError(f'Partition of {bytesize}[B] in {tarballpath} does not fit {target} of {targetbytesize}[B]')
+    fitting=[t for t in targets if t not in errors]
+    if not fitting:
+        return(bytesize,errors)
+
+    remaining=bytesize
+    with FanOutWriter(fitting,depth,bytesize,offsets) as out, progress.bar('stream',bytesize,label=','.join(map(str,fitting))) as bar:
+        try:
+            while remaining>0:
+                chunk=stream.readChunk(min(chunksize,remaining))
+                if not chunk:
+                    raise EOFError(f'{tarballpath} ended {remaining}[B] short of partition end')
+                out.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                remaining-=len(chunk)
+                bar.add(len(chunk))
+        except OSError:
+            # All targets failed, their own errors say why
+            if len(out.errors)<len(fitting):
+                raise
+    errors.update(out.errors)
+    return(bytesize,errors)
+
+
+def dataExtents(fd, start, end):
+    """Yield (start, end) byte ranges of fd between start & end that hold data
+
+    Holes are found with SEEK_DATA & SEEK_HOLE. Where those are not
+    supported the whole range is data.
+    """
+    offset=start
+    while offset<end:
+        try:
+            data=os.lseek(fd,offset,os.SEEK_DATA)
+        except OSError as e:
+            if e.errno==errno.ENXIO:
+                return      # Only a hole remains
+            if e.errno in (errno.EINVAL,errno.EOPNOTSUPP):
+                yield((offset,end))
+                return
+            raise
+        if data>=end:
+            return
+        hole=min(os.lseek(fd,data,os.SEEK_HOLE),end)
+        yield((data,hole))
+        offset=hole
+
+
+class _CloneTarget:
+    """Partition on a block device or in an image file, written at offsets"""
+
+    def __init__(self, path, chunksize):
+        self.fd=os.open(path,os.O_RDWR)
+        self.blockdevice=stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        self.chunksize=chunksize
+        self.copied=0
+        self.zeroed=0
+        self.copyFileRange=not self.blockdevice
+
+    def close(self):
+        try:
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+    def copy(self, src, offset, length, at):
+        """Copy length bytes at offset of src to at, in kernel where possible"""
+        if self.copyFileRange:
+            try:
+                done=0
+                while done<length:
+                    n=os.copy_file_range(src,self.fd,length-done,offset+done,at+done)
+                    if n==0:
+                        raise EOFError(f'Source ended at {offset+done}')
+                    done+=n
+                self.copied+=length
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV,errno.EINVAL,errno.ENOSYS,errno.EOPNOTSUPP):
+                    raise
+                self.copyFileRange=False
+        self._copyBuffered(src,offset,length,at)
+
+    def _copyBuffered(self, src, offset, length, at):
+        """Copy through one large buffer, zeroing rather than writing zero blocks"""
+        view=memoryview(bytearray(self.chunksize))
+        zero=bytes(CLONE_BLOCK_SIZE)
+        done=0
+        while done<length:
+            n=os.preadv(src,[view[:min(self.chunksize,length-done)]],offset+done)
+            if n==0:
+                raise EOFError(f'Source ended at {offset+done}')
+            runs=[]         # [iszero, start, end] of runs of like blocks
+            for block in range(0,n,CLONE_BLOCK_SIZE):
+                end=min(block+CLONE_BLOCK_SIZE,n)
+                iszero=view[block:end]==zero[:end-block]
+                if runs and runs[-1][0]==iszero:
+                    runs[-1][2]=end
+                else:
+                    runs.append([iszero,block,end])
+            for iszero,start,end in runs:
+                if iszero:
+                    self.zero(at+done+start,end-start)
+                else:
+                    os.pwrite(self.fd,view[start:end],at+done+start)
+                    self.copied+=end-start
+            done+=n
+
+    def zero(self, at, length):
+        """Make length bytes at at read back as zeros, without writing them where possible"""
+        self.zeroed+=length
+        if self.blockdevice:
+            try:
+                fcntl.ioctl(self.fd,BLKZEROOUT,struct.pack('QQ',at,length))
+                return
+            except OSError:
+                pass
+            extents=[(at,at+length)]
+        else:
+            # Holes of an image file already read as zeros
+            extents=list(dataExtents(self.fd,at,at+length))
+        zero=bytes(min(self.chunksize,length))
+        for start,end in extents:
+            for offset in range(start,end,len(zero)):
+                os.pwrite(self.fd,zero[:min(len(zero),end-offset)],offset)
+
+
+def clonePartition(imagepath, target, partnbr=None, targetbytesize=None, chunksize=CHUNK_SIZE, offset=0):
+    """Copy a partition of a decompressed image to target at the block level
+
+    Only extents of the image holding data are read. They are copied with
+    copy_file_range into files, or through a large buffer into block devices.
+    Holes and all zero blocks are zeroed on the target rather than written,
+    with BLKZEROOUT on block devices. Targets the current user cannot open
+    are written through streamPartition instead.
+
+    :param imagepath: Uncompressed disk image, ideally sparse
+    :param target: Device or file to receive the partition contents
+    :param partnbr, targetbytesize, offset: See streamPartition
+    :return: Number of bytes of partition
+    """
+    if not os.access(target,os.W_OK):
+        return(streamPartition(imagepath,target,partnbr,targetbytesize,chunksize,offset=offset))
+
+    with open(imagepath,'rb') as f:
+        partitions=readPartitionTable(ImageStream(iter(lambda:f.read(chunksize),b'')))
+    if len(partitions)==0:
+        raise ValueError(f'No partitions found in {imagepath}')
+    if partnbr is None:
+        source=partitions[0]
+    else:
+        source=next(filter(lambda p:p['partnbr']==partnbr,partitions),None)
+        if source is None:
+            raise ValueError(f'No partition {partnbr} in {imagepath}')
+
+    start=source['start']*SECTOR_SIZE
+    bytesize=source['size']*SECTOR_SIZE
+    if targetbytesize is not None and bytesize>targetbytesize:
+        raise ValueError(f'Partition of {bytesize}[B] in {imagepath} does not fit {target} of {targetbytesize}[B]')
+
+    # Byte offset in target of byte offset in the image
+    at=lambda position:offset+position-start
+    with tracing.span('clone',source=imagepath,target=target,offset=offset) as attrs:
+        src=os.open(imagepath,os.O_RDONLY)
+        out=_CloneTarget(target,chunksize)
+        try:
+            with progress.bar('clone',bytesize,label=str(target)) as bar:
+                position=start
+                for datastart,dataend in dataExtents(src,start,start+bytesize):
+                    if datastart>position:
+                        out.zero(at(position),datastart-position)
+                    out.copy(src,datastart,dataend-datastart,at(datastart))
+                    position=dataend
+                    bar.set(position-start)
+                if position<start+bytesize:
+                    out.zero(at(position),start+bytesize-position)
+                bar.set(bytesize)
+        finally:
+            os.close(src)
+            out.close()
+        attrs['copied']=out.copied
+        attrs['zeroed']=out.zeroed
+    return(bytesize)
+
+
+def replicateImage(goldenpath, target, grow=True, chunksize=CHUNK_SIZE):
+    """Write a golden disk image to a larger disk, copying only its allocated extents
+
+    Extents of the image up to its backup gpt are copied as clonePartition
+    does. Holes inside partitions are zeroed, as they may be filesystem
+    metadata that was all zeros, such as FAT tables or ext inode tables &
+    bitmaps made holes by fallocate --dig-holes. Holes outside partitions
+    are left, so the cost is that of the partitions of the image, whatever
+    the size of target. The gpt is then
+    written afresh for the size of target, its backup header at the end,
+    with the last partition grown to fill the disk. Its filesystem is not
+    grown, see Partition.growFilesystem.
+
+    Disk, partition & filesystem uuids are those of the golden image.
+
+    :param goldenpath: Disk image file with a gpt, ideally sparse
+    :param target: Block device, or file. Files are extended to the size of the image
+    :param grow: Grow the last partition to the end of target
+    :return: {'copied','zeroed','bytes'} & 'grown', the number of the partition grown or None
+    """
+    golden=GptTable.read(goldenpath)
+    goldenbytes=golden.sectorcount*golden.sectorsize
+    # Everything before the backup entries, which are written again at the end of target
+    end=(golden.lastlba+1)*golden.sectorsize
+
+    if isRegularFile(target) and os.stat(target).st_size<goldenbytes:
+        os.truncate(target,goldenbytes)
+    if not os.access(target,os.W_OK):
+        raise PermissionError(f'Cannot write to {target}, replicate as root')
+
+    with tracing.span('replicate',source=str(goldenpath),target=str(target)) as attrs:
+        src=os.open(goldenpath,os.O_RDONLY)
+        out=_CloneTarget(target,chunksize)
+        try:
+            targetbytes=os.lseek(out.fd,0,os.SEEK_END)
+            used=max([e.last+1 for n,e in golden.partitions()],default=golden.firstlba)*golden.sectorsize
+            if targetbytes<used+(golden.entrysectors+1)*golden.sectorsize:
+                raise ValueError(f'{target} of {targetbytes}[B] cannot hold the partitions of {goldenpath}')
+            # Progress is through the image, holes included
+            with progress.bar('replicate',end,label=str(target)) as bar:
+                for datastart,dataend in dataExtents(src,0,end):
+                    out.copy(src,datastart,dataend-datastart,datastart)
+                    bar.set(dataend)
+                for n,entry in golden.partitions():
+                    position=entry.first*golden.sectorsize
+                    partitionend=(entry.last+1)*golden.sectorsize
+                    for datastart,dataend in dataExtents(src,position,partitionend):
+                        if datastart>position:
+                            out.zero(position,datastart-position)
+                        position=dataend
+                    if position<partitionend:
+                        out.zero(position,partitionend-position)
+                bar.set(end)
+        finally:
+            os.close(src)
+            out.close()
+
+        # Boot code copied into the mbr is kept by create()
+        table=GptTable.create(target,golden.sectorsize,golden.diskguid)
+        table.entrycount=golden.entrycount
+        table.entrysize=golden.entrysize
+        table.entries=list(golden.entries)
+        grown=None
+        partitions=table.partitions()
+        if grow and partitions:
+            partnbr,last=partitions[-1]
+            align=pow(2,20)//table.sectorsize
+            lastlba=(table.lastlba+1)//align*align-1
+            if lastlba>last.last:
+                table.setEntry(partnbr,GptEntry(last.typeguid,last.uniqueguid,last.first,lastlba,last.attrs,last.name))
+                grown=partnbr
+        table.write()
+        attrs['copied']=out.copied
+        attrs['zeroed']=out.zeroed
+        attrs['grown']=grown
+    return({'copied':out.copied,'zeroed':out.zeroed,'bytes':targetbytes,'grown':grown})
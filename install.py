@@ -1,92 +1,362 @@
-from grub.grub import GrubDisk
+from grub.grub import GrubDisk,GRUB_THEMES,getThemes
 from config import config
-import json
+import argparse
+import contextlib
+import contextvars
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from util import bash,dlFile
-import tempfile
-import shutil
+from image import fanoutPartition,clonePartition,replicateImage,listPartitions,SECTOR_SIZE
+from disk import Disk
+from gpt import isRegularFile
+from cache import ImageCache
+from treecopy import TreeCopy
+from fsread import openFilesystem,TreeExtract,UnsupportedFilesystem
+from checksum import BlockDigest,verify
+import executor as executors
+import probecache
+import tracing
 import os
 
-dev=Path('/dev/sdb')
+MODE_STREAM='stream'
+MODE_COPY='copy'
+MODE_CLONE='clone'
 
-disk = GrubDisk(dev)
 
-for osid,data in config['os'].items():
-    for ptn,info in data['partition'].items():
-        uuid=disk.partitiontable.addPartition(info['size'], info['partitionlabel'],fslabel=info['fslabel'],fstype=info['fstype'])
-        info['uuid']=uuid
-        
+def partitionDisk(dev, mode=MODE_STREAM, executor=None, keep=False):
+    '''Plan grub & os partitions together, then write the table once
 
-def getFirstPartitionOffset(imageFile):
-    data=json.loads(bash('sfdisk -l {} -J'.format(imageFile)).stdout)
-    sectorsize=data['partitiontable']['sectorsize']
-    firstsector=min([n['start'] for n in data['partitiontable']['partitions']])
-    return(sectorsize*firstsector)
+    :param keep: Keep partitions already on disk with the same label, size &
+        filesystem, so only changed ones are recreated
+    :return: GrubDisk, with the uuid of each os partition set in config
+    '''
+    disk = GrubDisk(dev,commit=False,executor=executor,keep=keep)
 
-def cleanup(workingDirectory, mounts):
-    for m in mounts:
-        bash(f'sudo umount {m}')
-    shutil.rmtree(workingDirectory)
+    for osid,data in config['os'].items():
+        for ptn,info in data['partition'].items():
+            # Streamed & cloned system partitions receive the images filesystem, dont format them
+            fstype='' if mode in (MODE_STREAM,MODE_CLONE) and ptn=='system' else info['fstype']
+            uuid=disk.layout.add(info['size'], info['partitionlabel'],fslabel=info['fslabel'],fstype=fstype,profile=info.get('profile'),keep=keep)
+            info['uuid']=uuid
 
-try:
+    disk.layout.commit()
+    return(disk)
 
-    workingDirectory=Path(tempfile.mkdtemp())
-    mounts=[]
+def layoutSize():
+    '''MiB of disk the grub & os partitions of config take, with room for alignment & the gpt'''
+    sizes=[GrubDisk.GRUB_BOOT_SIZE,GrubDisk.GRUB_DATA_SIZE]
+    sizes.extend(info['size'] for data in config['os'].values() for info in data['partition'].values())
+    return(sum(sizes)+(len(sizes)+2)*Disk.ALIGNMENT_OFFSET)
 
-    oldcwd=os.getcwd()
-    os.chdir(workingDirectory)
+@contextlib.contextmanager
+def goldenImage(path, size=None, executor=executors.DEFAULT):
+    '''Sparse disk image file at path, loop attached for the length of the with block
 
+    Installs to the loop device yielded go through the same commands as
+    to a disk. Blocks of zeros are punched out of the image once detached.
+
+    :param size: MiB. Just enough for the layout of config when None, see replicateGolden
+    :return: Loop device
+    '''
+    with open(path,'wb') as f:
+        f.truncate((size or layoutSize())*pow(2,20))
+    device=executor.run(f'sudo losetup --find --show --partscan {path}').stdout.strip()
+    try:
+        yield(Path(device))
+    finally:
+        executor.run(f'sudo losetup -d {device}')
+    executor.run(f'fallocate --dig-holes {path}')
+
+def replicateGolden(golden, targets, executor=executors.DEFAULT):
+    '''Write a golden image to every target at once, growing its last partition & filesystem to fill each
+
+    :param targets: Devices or files
+    :return: {target:exception} of the targets that failed
+    '''
+    def replicate(target):
+        print(f'Replicating {golden} to {target}')
+        # The whole disk is overwritten, its table with it
+        probecache.DEFAULT.invalidate(target)
+        stats=replicateImage(golden,target)
+        print(f"Copied {stats['copied']/pow(2,20):.1f}[MiB] of {golden} to {target} of {stats['bytes']/pow(2,30):.1f}[GiB]")
+        if not isRegularFile(target):
+            # Kernel keeps its own copy of a block devices table
+            for action in ('-d','-a','-u'):
+                executor.run(f'sudo partx {action} {target}',check=False)
+            executor.run('udevadm settle',check=False)
+        # Read back in process, as written, rather than waiting on udev
+        disk=Disk(target,native=True,executor=executor)
+        if stats['grown'] is not None:
+            with disk:
+                disk.partitiontable.getPartitionBy(stats['grown'],'partnbr').growFilesystem()
+
+    failed={}
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures={t:pool.submit(contextvars.copy_context().run,replicate,t) for t in targets}
+    for target,f in futures.items():
+        if f.exception() is not None:
+            failed[target]=f.exception()
+    return(failed)
+
+def getFirstPartitionOffset(imageFile, index=None):
+    return(SECTOR_SIZE*min([n['start'] for n in listPartitions(imageFile,index)]))
+
+def onDisks(fn, targets):
+    '''Run fn(disk, systemPartition) for every target concurrently
+
+    :param targets: [(disk, systemPartition)]
+    :return: Result of fn, or the exception it raised, for each target
+    '''
+    if len(targets)==1:
+        try:
+            return([fn(*targets[0])])
+        except Exception as e:
+            return([e])
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        # Each runs in a copy of this context, so its trace spans keep their parent
+        futures=[pool.submit(contextvars.copy_context().run,fn,*t) for t in targets]
+    return([f.exception() or f.result() for f in futures])
+
+def verifyPartition(device, blocks, offset=0):
+    '''Read device back from offset, raising OSError naming the blocks that differ from those written'''
+    if not os.access(device,os.R_OK):
+        print(f'Cannot read {device} back, not verified')
+        return
+    bad=verify(device,blocks,offset)
+    if bad:
+        shown=', '.join(f'{n} at {at}[B]' for n,at in bad[:8])
+        raise OSError(f'{len(bad)} of {len(blocks.blocks)} blocks of {blocks.blocksize}[B] read back from {device} '
+                      f'differ from those written: {shown}{", ..." if len(bad)>8 else ""}')
+    print(f'Verified {device}, sha256 {blocks.sha256.hexdigest()}')
+
+def streamInstall(targets, osid, osimage, index=None, verify=False):
+    '''Write the images first partition over the system partition of every target at once,
+    straight from the image or its .gz, decompressing it once
+
+    :param targets: [(disk, systemPartition)]
+    :param index: gzindex.GzipIndex of osimage when it is the .gz
+    :param verify: Read each target back, comparing it block by block with what was written
+    :return: New systemPartition, or the exception writing it raised, of each target
+    '''
+    devices=[str(p.device) for d,p in targets]
+    print(f'Streaming {osid} image to {", ".join(devices)}')
+    # Partitions of image files are written into the image, at their offset
+    backing={str(p.backing):p for d,p in targets}
+    # Hashed once as it is written, the targets are then each read back once
+    blocks=BlockDigest() if verify else None
+    with tracing.span('stream',osid=osid,target=','.join(devices)):
+        _,errors=fanoutPartition(osimage,{b:p.bytesize for b,p in backing.items()},index=index,digest=blocks,
+            offsets={b:p.offset for b,p in backing.items()})
+    if blocks is not None:
+        blocks.finish()
+
+    def reprobe(disk, systemPartition):
+        if str(systemPartition.backing) in errors:
+            raise errors[str(systemPartition.backing)]
+        if blocks is not None:
+            verifyPartition(str(systemPartition.backing),blocks,systemPartition.offset)
+        # Partition now holds the filesystem of the image, reprobe for its uuid & label
+        disk.partitiontable._updatePartitionTableData()
+        return(disk.partitiontable.getPartitionBy(systemPartition.partuuid))
+    return(onDisks(reprobe,targets))
+
+def cloneInstall(disk, osid, osimage, systemPartition):
+    '''Clone the decompressed images first partition onto the system partition, then grow its filesystem to fit'''
+    print(f'Cloning {osid} image to {systemPartition.device}')
+    clonePartition(osimage, systemPartition.backing, targetbytesize=systemPartition.bytesize, offset=systemPartition.offset)
+
+    disk.partitiontable._updatePartitionTableData()
+    systemPartition=disk.partitiontable.getPartitionBy(systemPartition.partuuid)
+    systemPartition.growFilesystem()
+    return(systemPartition)
+
+def copyInstall(disk, osid, imageFile, systemPartition):
+    '''Copy the files of the decompressed images first partition, read in process
+    when its filesystem can be, else loop mounted'''
+    if systemPartition.partuuid in disk.layout.kept:
+        # Files of the image installed before would linger among the new ones
+        info=config['os'][osid]['partition']['system']
+        systemPartition.mkfs(info['fstype'],info['fslabel'],info.get('profile'))
+        disk.partitiontable._updatePartitionTableData()
+        systemPartition=disk.partitiontable.getPartitionBy(systemPartition.partuuid)
+
+    offset=getFirstPartitionOffset(imageFile)
+    target=systemPartition.getMountpoint()
+    if disk.executor.local and os.access(target,os.W_OK):
+        # Read the image filesystem in process, no loop mount or root needed
+        try:
+            fs=openFilesystem(imageFile,offset)
+        except UnsupportedFilesystem as e:
+            print(f'{e}, mounting {osid} image instead')
+        else:
+            print(f'Extracting files in {osid} image to {systemPartition}')
+            with fs:
+                extract=TreeExtract(fs,target)
+                stats=extract.run()
+            print(f"Extracted {stats['files']} files, {stats['bytes']/pow(2,20):.1f}[MiB] in {stats['seconds']:.1f}[s], {extract.throughput():.1f}[MiB/s]")
+            return(systemPartition)
+
+    print(f'Mounting {osid} image')
+    with tracing.span('mount',osid=osid):
+        source=disk.mounts.mount(imageFile,f'loop,ro,offset={offset}')
+
+    print(f'Transferring files in mounted {osid} image to {systemPartition}')
+
+    # Image is unmounted once copied
+    with source:
+        if disk.executor.local and os.access(target,os.W_OK):
+            copier=TreeCopy(source,target)
+            stats=copier.run()
+            print(f"Copied {stats['files']} files, {stats['bytes']/pow(2,20):.1f}[MiB] in {stats['seconds']:.1f}[s], {copier.throughput():.1f}[MiB/s]")
+        else:
+            with tracing.span('copy',osid=osid):
+                disk.executor.run(f'sudo cp -a {source}/. {target}')
+    return(systemPartition)
+
+def addMenuEntries(disk, osdata, systemPartition):
+    '''Add the boot menu entries of an os, booting its system partition'''
+    for menuItem in osdata['bootloader']:
+        for menuName,menuData in menuItem.items():
+            disk.addGrubMenuEntry(
+                menuName,
+                systemPartition,
+                menuData['kpath'],
+                menuData['karg'],
+                menuData['class']
+                )
+
+def installImages(disks, mode, cache, verify=False):
+    '''Fetch each os image once and install it to its system partition on every disk
+
+    Disks are written concurrently. A disk that fails is left out of the
+    images after, the others carry on.
+
+    :param disks: GrubDisks
+    :param verify: Read streamed partitions back, see streamInstall
+    :return: {disk:exception} of the disks that failed
+    '''
+    failed={}
     for osid in config['os'].keys():
 
         osdata=config['os'][osid]
-        ostarball=Path(osdata['tarballpath'])
-
-        zipImageFile=ostarball.parts[-1]
-        imageFile=ostarball.stem
 
         # Install openelec, grub menu entry
-        if not ostarball.exists():
-            print(f'Retrieving {osid} image')
-            dlFile(osdata['tarballurl'],ostarball)
-            
-        shutil.copy(ostarball,workingDirectory)
-
-        print(f'Extracting {osid} image')
-        bash(f'gunzip {zipImageFile}')
-
-        print(f'Mounting {osid} image')
-        offset=getFirstPartitionOffset(imageFile)
-        mountpoint=Path(workingDirectory,imageFile+'.mnt')
-        mounts.append(mountpoint)
-        bash(f'mkdir {mountpoint}')
-        bash(f'sudo mount -o loop,offset={offset} {imageFile} {mountpoint}')
-        
-        systemPartition=disk.partitiontable.getPartitionBy(osdata['partition']['system']['partitionlabel'],'partlabel')
-        print(f'Transferring files in mounted {osid} image to {systemPartition}')
-
-        # Viashell for explansion of glob
-        bash(f'sudo cp -r {mountpoint}/* {systemPartition.getMountpoint()}',viashell=True)
-        
-        # Add bootmenu entry
-        for menuItem in osdata['bootloader']:
-            for menuName,menuData in menuItem.items():
-                disk.addGrubMenuEntry(
-                    menuName,
-                    systemPartition,
-                    menuData['kpath'],
-                    menuData['karg'],
-                    menuData['class']
-                    )
-
-        
-except Exception as e:
-    cleanup(workingDirectory,mounts )
-    raise e
-
-finally:
-    cleanup(workingDirectory,mounts )
-    
-# REgenerate boot menu
-disk.updateGrubMenu()
+        print(f'Retrieving {osid} image')
+        ostarball=cache.getArchive(osdata['tarballurl'],osdata.get('sha256'),seed=osdata['tarballpath'])
+        # Cached objects are named by their sha256
+        imagesha=Path(ostarball).name
+
+        targets=[]
+        for disk in disks:
+            if disk in failed:
+                continue
+            systemPartition=disk.partitiontable.getPartitionBy(osdata['partition']['system']['partitionlabel'],'partlabel')
+            if disk.manifest.osCurrent(osid,imagesha,mode,systemPartition):
+                print(f'{osid} image already installed to {systemPartition.device}')
+                addMenuEntries(disk,osdata,systemPartition)
+                continue
+            disk.manifest.dropOs(osid)
+            disk.writeManifest()
+            targets.append((disk,systemPartition))
+        if not targets:
+            continue
+
+        # Copying & cloning need the image decompressed, streaming only when it is being cached
+        if mode in (MODE_COPY,MODE_CLONE) or config['cache']['images']:
+            print(f'Extracting {osid} image')
+            osimage=cache.getImage(ostarball)
+            index=None
+        else:
+            osimage=ostarball
+            index=cache.getIndex(ostarball)
+
+        if mode==MODE_STREAM:
+            results=streamInstall(targets,osid,osimage,index,verify)
+        elif mode==MODE_CLONE:
+            results=onDisks(lambda disk,systemPartition:cloneInstall(disk,osid,osimage,systemPartition),targets)
+        else:
+            results=onDisks(lambda disk,systemPartition:copyInstall(disk,osid,osimage,systemPartition),targets)
+
+        for (disk,_),systemPartition in zip(targets,results):
+            if isinstance(systemPartition,Exception):
+                print(f'Installing {osid} to {disk.device} failed: {systemPartition}')
+                failed[disk]=systemPartition
+                continue
+            disk.manifest.setOs(osid,imagesha,mode,systemPartition)
+            disk.writeManifest()
+            addMenuEntries(disk,osdata,systemPartition)
+    return(failed)
+
+def main():
+    parser=argparse.ArgumentParser(description='Install media pc operating systems & grub to a disk')
+    parser.add_argument('--device',type=Path,nargs='+',default=[Path('/dev/sdb')],
+        help='Disks, or disk image files, to install to. Several are written at once from one copy of each image')
+    parser.add_argument('--mode',choices=[MODE_STREAM,MODE_CLONE,MODE_COPY],default=MODE_STREAM,
+        help='stream: write the image partition straight from the .gz to the target. '
+             'clone: copy the data extents of the cached, decompressed image partition to the target '
+             'and grow its filesystem. '
+             'copy: copy the files of the cached, decompressed image partition into the target filesystem, read in process or loop mounted')
+    parser.add_argument('--golden',type=Path,
+        help='Install to a sparse disk image file at this path instead of --device, for --replicate')
+    parser.add_argument('--golden-size',type=int,help='MiB of the golden image. Just enough for the layout by default')
+    parser.add_argument('--replicate',type=Path,
+        help='Write this golden image to each --device, copying only its data & growing its last partition to fill')
+    parser.add_argument('--incremental',action='store_true',
+        help='Compare with the manifest left on grub_data by the last install, and only repartition, '
+             'rewrite os partitions or regenerate the boot menu where something changed')
+    parser.add_argument('--theme',choices=sorted(GRUB_THEMES),help='Boot menu theme, fetched unless cached & unchanged')
+    parser.add_argument('--verify',action='store_true',
+        help='Read each streamed partition back, comparing it block by block with what was written')
+    parser.add_argument('--trace',type=Path,help='Write a JSON lines trace of phases & commands to this file')
+    parser.add_argument('--record',type=Path,
+        help='Record every command run & its result to this file, for replay by bench/orchestration.py')
+    args=parser.parse_args()
+
+    if args.trace is not None:
+        tracing.tracer.open(args.trace)
+
+    executor=executors.RecordingExecutor(args.record) if args.record is not None else executors.DEFAULT
+
+    if args.replicate is not None:
+        failed=replicateGolden(args.replicate,args.device,executor)
+        tracing.summary()
+        for target,error in failed.items():
+            print(f'Replicating to {target} failed')
+            traceback.print_exception(error)
+        sys.exit(1 if failed else 0)
+
+    # Partitions mounted along the way are unmounted on leaving, before any golden image is detached
+    with contextlib.ExitStack() as stack:
+        devices=args.device
+        if args.golden is not None:
+            devices=[stack.enter_context(goldenImage(args.golden,args.golden_size,executor))]
+        # Partitioned one after the other, each disk may ask to be confirmed
+        disks=[stack.enter_context(partitionDisk(d,args.mode,executor,keep=args.incremental)) for d in devices]
+        cache=ImageCache(config['cache']['path'],config['cache']['budget'])
+        failed=installImages(disks,args.mode,cache,args.verify)
+
+        print('Image cache: {hits} hits, {misses} misses, {evictions} evictions, {usedbytes}[B] of {budget}[B] used'.format(**cache.stats()))
+
+        themes=getThemes([args.theme]) if args.theme is not None else None
+        for disk in disks:
+            if disk in failed:
+                continue
+            if themes is not None:
+                disk.installTheme(args.theme,themes)
+
+            # REgenerate boot menu, when its entries changed
+            if disk.grubMenuChanged():
+                disk.updateGrubMenu()
+            disk.writeManifest()
+
+    tracing.summary()
+    for disk,error in failed.items():
+        print(f'Install to {disk.device} failed')
+        traceback.print_exception(error)
+    if failed:
+        sys.exit(1)
 
 
+if __name__=='__main__':
+    main()
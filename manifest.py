@@ -0,0 +1,98 @@
+"""
+Record of what an install put on a disk, kept on its grub_data partition.
+
+The manifest holds the partition layout, the image & install mode each os
+partition was written from, and hashes of the grub install & boot menu.
+An incremental install compares what it is about to do with the manifest
+and only repartitions, rewrites or regenerates what has changed.
+
+    {
+        'version':1,
+        'layout':[{'partlabel','partuuid','startsector','sectorcount','fstype'}...],
+        'grub':{'bootuuid','datauuid'},
+        'os':{osid:{'image','mode','partuuid','fsuuid'}},
+        'menu':sha256 of grub.cfg,
+        'written':unix time,
+    }
+
+Records are dropped before whatever they describe is rewritten, so an
+install interrupted part way leaves nothing claiming to be current.
+"""
+
+import hashlib
+import json
+import time
+
+VERSION=1
+FILE='install-manifest.json'
+
+
+def menuHash(menu):
+    """sha256 of a rendered grub.cfg"""
+    return(hashlib.sha256(menu.encode()).hexdigest())
+
+
+class Manifest:
+
+    def __init__(self, data=None):
+        self.data={'version':VERSION,'layout':[],'grub':None,'os':{},'menu':None}
+        if data is not None and data.get('version')==VERSION:
+            self.data.update(data)
+
+    @classmethod
+    def read(cls, partition):
+        """Manifest on partition. Empty when there is none, or it cannot be read
+
+        :param partition: disk.Partition holding the manifest. Unmounted again
+            unless mounted already
+        """
+        if partition is None or partition.fstype is None:
+            return(cls())
+        executor=partition.table.executor
+        held=partition.mountpoint is not None
+        try:
+            result=executor.run(f'sudo cat {partition.getMountpoint()}/{FILE}',check=False)
+        finally:
+            if not held:
+                partition.releaseMountpoint()
+        if result.returncode!=0:
+            return(cls())
+        try:
+            return(cls(json.loads(result.stdout)))
+        except ValueError:
+            return(cls())
+
+    def write(self, partition):
+        """Write the manifest to partition, replacing any previous one whole"""
+        self.data['layout']=[{k:p[k] for k in ('partlabel','partuuid','startsector','sectorcount','fstype')}
+            for p in partition.table._data['partitions']]
+        self.data['written']=time.time()
+        partition.table.executor.writeFile(f'{partition.getMountpoint()}/{FILE}',json.dumps(self.data,indent=1).encode())
+
+    def grubCurrent(self, bootuuid, datauuid):
+        """Whether grub was installed to these partitions"""
+        return(self.data['grub']=={'bootuuid':bootuuid,'datauuid':datauuid})
+
+    def setGrub(self, bootuuid, datauuid):
+        self.data['grub']={'bootuuid':bootuuid,'datauuid':datauuid}
+
+    def osCurrent(self, osid, image, mode, partition):
+        """Whether partition still holds image, as installed by mode
+
+        :param image: sha256 of the os image archive
+        """
+        record=self.data['os'].get(osid)
+        return(record=={'image':image,'mode':mode,'partuuid':partition.partuuid,'fsuuid':partition.fsuuid})
+
+    def setOs(self, osid, image, mode, partition):
+        self.data['os'][osid]={'image':image,'mode':mode,'partuuid':partition.partuuid,'fsuuid':partition.fsuuid}
+
+    def dropOs(self, osid):
+        self.data['os'].pop(osid,None)
+
+    def menuCurrent(self, menu):
+        """Whether grub.cfg text menu is the one last written"""
+        return(self.data['menu']==menuHash(menu))
+
+    def setMenu(self, menu):
+        self.data['menu']=menuHash(menu)
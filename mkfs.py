@@ -0,0 +1,87 @@
+"""
+Concurrent formatting of new partitions, with per partition format profiles.
+
+A profile names mke2fs options in config['mkfs']['profiles']:
+
+    'media':{
+        'extended':['lazy_itable_init=1','lazy_journal_init=1','nodiscard'],
+        'inoderatio':4*pow(2,20),   # bytes per inode, -i
+        'reserved':0,               # % of blocks reserved for root, -m
+    }
+
+Extended options skip zeroing inode tables & the journal, and discarding
+the partition, up front. The inode ratio cuts the inode tables of
+partitions holding few, large files. Only ext2/3/4 filesystems take them.
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from config import config
+import progress
+
+EXT_FSTYPES=('ext2','ext3','ext4')
+
+
+def profileOptions(fstype, profile=None, extended=()):
+    """mkfs options of the named profile, as a list of arguments
+
+    :param extended: Further -E options, merged with those of the profile
+    :raises ValueError: For profiles missing from config
+    """
+    extended=list(extended)
+    settings={}
+    if profile is not None and fstype in EXT_FSTYPES:
+        profiles=config['mkfs']['profiles']
+        if profile not in profiles:
+            raise ValueError(f"No mkfs profile {profile}, known profiles are {', '.join(profiles)}")
+        settings=profiles[profile]
+    options=[]
+    if settings.get('inoderatio'):
+        options.extend(['-i',str(settings['inoderatio'])])
+    if settings.get('reserved') is not None:
+        options.extend(['-m',str(settings['reserved'])])
+    extended.extend(settings.get('extended',[]))
+    if extended:
+        options.extend(['-E',','.join(extended)])
+    return(options)
+
+
+class MkfsScheduler:
+    """Formats partitions concurrently
+
+    Partitions of a committed table are independent of each other, so all
+    of them may be formatted at once, up to workers at a time.
+
+    :param workers: Concurrent mkfs runs. Defaults to config['mkfs']['workers']
+    """
+
+    def __init__(self, workers=None):
+        self.workers=workers or config['mkfs']['workers']
+        self.jobs=[]
+
+    def add(self, partition, fstype, label, profile=None):
+        """Queue partition for formatting. See Partition.mkfs"""
+        self.jobs.append((partition,fstype,label,profile))
+
+    def run(self):
+        """Format every queued partition, waiting for all of them
+
+        :raises: The first error of any failed mkfs, once all have finished
+        """
+        jobs,self.jobs=self.jobs,[]
+        if not jobs:
+            return
+        with progress.bar('mkfs',len(jobs),unit='filesystems') as bar:
+            def mkfs(partition, fstype, label, profile):
+                partition.mkfs(fstype,label,profile)
+                bar.add(1)
+            if len(jobs)<=1 or self.workers<=1:
+                for job in jobs:
+                    mkfs(*job)
+                return
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # Each job runs in a copy of this context, so its trace spans keep their parent
+                futures=[pool.submit(contextvars.copy_context().run,mkfs,*job) for job in jobs]
+            errors=[f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                raise errors[0]
@@ -0,0 +1,212 @@
+"""
+Mounts made & reused through one manager.
+
+The mount table is parsed from /proc/self/mountinfo in process and indexed
+by device and by mountpoint. The kernel flags the open mountinfo file when
+the table changes, so it is only read again after a poll says so. Mounts
+are reference counted: asking again for a device already mounted returns
+the same mount. Mounts the manager made are unmounted, and their temporary
+directories removed, when their last reference is released or the manager
+is closed. Mounts it found already in place are never unmounted.
+
+    with MountManager() as mounts:
+        with mounts.mount('/dev/sdb2') as mountpoint:
+            ...
+"""
+
+import os
+import re
+import select
+import tempfile
+import threading
+from pathlib import Path
+import executor as executors
+
+MOUNTINFO='/proc/self/mountinfo'
+
+
+def _unescape(value):
+    """Decode the octal escapes mountinfo uses for space, tab, newline & backslash"""
+    return(re.sub(r'\\([0-7]{3})',lambda m:chr(int(m.group(1),8)),value))
+
+def parseMountinfo(text):
+    """Entries of a mountinfo file, as dicts of device, devnum, mountpoint, fstype & options"""
+    entries=[]
+    for line in text.splitlines():
+        fields=line.split()
+        if len(fields)<10:
+            continue
+        separator=fields.index('-',6)
+        entries.append({
+            'devnum':fields[2],
+            'root':_unescape(fields[3]),
+            'mountpoint':_unescape(fields[4]),
+            'options':fields[5],
+            'fstype':fields[separator+1],
+            'device':_unescape(fields[separator+2]),
+        })
+    return(entries)
+
+
+class MountInfo:
+    """Index of the mount table of this process, read again only when it changes"""
+
+    def __init__(self, path=MOUNTINFO):
+        self._file=open(path,'rb')
+        self._poll=select.poll()
+        # Changes to the mount table are flagged as exceptional conditions
+        self._poll.register(self._file,select.POLLPRI|select.POLLERR)
+        self._lock=threading.Lock()
+        self.reads=0
+        self._read()
+
+    def close(self):
+        self._file.close()
+
+    def _read(self):
+        self._file.seek(0)
+        entries=parseMountinfo(self._file.read().decode(errors='replace'))
+        self.reads+=1
+        self.bydevice={}
+        self.bydevnum={}
+        self.bymountpoint={}
+        for e in entries:
+            # Later entries are mounted over earlier ones
+            self.bydevice.setdefault(e['device'],[]).append(e)
+            self.bydevnum.setdefault(e['devnum'],[]).append(e)
+            self.bymountpoint[e['mountpoint']]=e
+
+    def refresh(self):
+        """Read the table again if it has changed since it was last read"""
+        with self._lock:
+            if self._poll.poll(0):
+                self._read()
+
+    def device(self, device):
+        """Mounts of device, found by its device number or name. First mounted first"""
+        self.refresh()
+        try:
+            rdev=os.stat(device).st_rdev
+        except OSError:
+            rdev=0
+        if rdev:
+            found=self.bydevnum.get(f'{os.major(rdev)}:{os.minor(rdev)}')
+            if found:
+                return(found)
+        return(self.bydevice.get(str(device),[]))
+
+    def mountpoint(self, path):
+        """Mount at path, None if nothing is mounted there"""
+        self.refresh()
+        return(self.bymountpoint.get(str(path)))
+
+
+class Mount:
+    """One mount held through a MountManager. Use as a context manager, or release()"""
+
+    def __init__(self, manager, key, device, mountpoint, owned, tempdir):
+        self.manager=manager
+        self.key=key
+        self.device=device
+        self.mountpoint=Path(mountpoint)
+        self.owned=owned
+        self.tempdir=tempdir
+        self.references=0
+
+    def __str__(self):
+        return(str(self.mountpoint))
+
+    def __fspath__(self):
+        return(str(self.mountpoint))
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        self.manager.release(self)
+
+
+class MountManager:
+    """Makes, shares & tears down mounts
+
+    :param executor: Runs mount & umount. When it is not local the host mount
+        table is not consulted, only mounts made by this manager are known
+    """
+
+    def __init__(self, executor=None):
+        self.executor=executor or executors.DEFAULT
+        self.info=MountInfo() if self.executor.local else None
+        self._mounts={}         # key: Mount
+        self._lock=threading.RLock()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def mount(self, device, options=None, mountpoint=None):
+        """Mount device, or take another reference to its existing mount
+
+        Devices mounted elsewhere already are reused as they are, unless
+        options are given: loop mounts of image files are always made.
+
+        :param options: mount -o options, eg loop,ro,offset=N
+        :param mountpoint: Directory to mount on. A temporary one when None
+        :return: Mount
+        """
+        key=(str(device),options)
+        with self._lock:
+            found=self._mounts.get(key)
+            if found is None and options is None and self.info is not None:
+                existing=self.info.device(device)
+                if existing:
+                    found=Mount(self,key,device,existing[0]['mountpoint'],owned=False,tempdir=False)
+            if found is None:
+                found=self._mount(key,device,options,mountpoint)
+            self._mounts[key]=found
+            found.references+=1
+            return(found)
+
+    def _mount(self, key, device, options, mountpoint):
+        tempdir=mountpoint is None
+        if tempdir:
+            # Commands not run on this host only need a mountpoint name
+            mountpoint=tempfile.mkdtemp(prefix='mount.') if self.executor.local else tempfile.mktemp(prefix='mount.')
+        optionarg=f'-o {options} ' if options else ''
+        try:
+            self.executor.run(f'sudo mount {optionarg}{device} {mountpoint}')
+        except Exception:
+            if tempdir and self.executor.local:
+                os.rmdir(mountpoint)
+            raise
+        return(Mount(self,key,device,mountpoint,owned=True,tempdir=tempdir))
+
+    def release(self, mount:Mount):
+        """Drop a reference, unmounting once none remain"""
+        with self._lock:
+            mount.references-=1
+            if mount.references<=0:
+                self._unmount(mount)
+
+    def _unmount(self, mount):
+        if self._mounts.get(mount.key) is mount:
+            del self._mounts[mount.key]
+        if not mount.owned:
+            return
+        self.executor.run(f'sudo umount {mount.mountpoint}')
+        if mount.tempdir and self.executor.local:
+            os.rmdir(mount.mountpoint)
+
+    def close(self):
+        """Unmount everything this manager mounted, last mounted first"""
+        with self._lock:
+            for mount in reversed(list(self._mounts.values())):
+                mount.references=0
+                self._unmount(mount)
+            if self.info is not None:
+                self.info.close()
+                self.info=None
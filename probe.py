@@ -0,0 +1,301 @@
+"""
+Single pass disk probes.
+
+Each backend gathers the partition table and every partition's position,
+filesystem and gpt entry in one go, and returns them as
+
+{
+    'table':{'uuid','type','sectorsize','sectorcount','firstlba','lastlba'},
+    'partitions':[partitiondata, ...],
+}
+
+where partitiondata has the fields PartitionTable has always kept per
+partition (startsector, endsector, fstype, fslabel, fsuuid, partlabel,
+partuuid, partflag, partnbr...). Sectors are logical sectors of the disk.
+"""
+
+import json
+import os
+import re
+import struct
+import uuid
+from pathlib import Path
+from executor import DEFAULT
+from gpt import GptTable,attrsToString,isRegularFile,deviceSectorSize
+
+SYS_BLOCK='/sys/class/block'
+UDEV_DATA='/run/udev/data'
+SYSFS_SECTOR_SIZE=512   # sysfs start & size are always in 512 byte units
+
+GPT_ENTRY_ARRAY_SIZE=128*128
+GPT_TYPE_BIOSBOOT='21686148-6449-6E6F-744E-656564454649'
+GPT_TYPE_ESP='C12A7328-F81F-11D2-BA4B-00A0C93EC93B'
+
+
+def _unescape(value):
+    """Decode udev/blkid \\xNN escapes"""
+    if value is None:
+        return(None)
+    return(re.sub(r'\\x([0-9a-fA-F]{2})',lambda m:chr(int(m.group(1),16)),value))
+
+def _upper(value):
+    return(value.upper() if value else value)
+
+def sfdiskAttrs(flags):
+    """gpt attribute bits, as a hex string or int, in sfdisk attrs form"""
+    if not flags:
+        return(None)
+    return(attrsToString(int(flags,16) if isinstance(flags,str) else int(flags)))
+
+def partedFlags(parttype, flags):
+    """Partition flags as parted -m would print them"""
+    out=[]
+    parttype=_upper(parttype)
+    if parttype==GPT_TYPE_BIOSBOOT:
+        out.append('bios_grub')
+    if parttype==GPT_TYPE_ESP:
+        out.extend(['boot','esp'])
+    attrs=sfdiskAttrs(flags) or ''
+    if 'LegacyBIOSBootable' in attrs:
+        out.append('legacy_boot')
+    return(', '.join(out))
+
+def _tableLimits(tabletype, sectorcount, sectorsize):
+    """First & last usable lba, as sfdisk reports them for a table of tabletype
+
+    Disks without a table get the limits of the gpt they will be given
+    """
+    if tabletype not in ('gpt',None):
+        return(1, sectorcount-1)
+    entrysectors=GPT_ENTRY_ARRAY_SIZE//sectorsize + bool(GPT_ENTRY_ARRAY_SIZE%sectorsize)
+    return(2+entrysectors, sectorcount-2-entrysectors)
+
+def _partitionData(device, partnbr, start, sectorcount, fields):
+    return({
+        'device':Path(device),
+        'startsector':start,
+        'endsector':start+sectorcount-1,
+        'sectorcount':sectorcount,
+        'fstype':fields.get('fstype') or '',
+        'fslabel':fields.get('fslabel'),
+        'fsuuid':fields.get('fsuuid'),
+        'partlabel':fields.get('partlabel') or '',
+        'partuuid':_upper(fields.get('partuuid')),
+        'partflag':partedFlags(fields.get('parttype'),fields.get('partattrs')),
+        'partnbr':partnbr,
+        'parttype':_upper(fields.get('parttype')),
+        'partattrs':sfdiskAttrs(fields.get('partattrs')),
+    })
+
+def _table(uuid, tabletype, sectorcount, sectorsize):
+    firstlba,lastlba=_tableLimits(tabletype,sectorcount,sectorsize)
+    return({
+        'uuid':_upper(uuid),
+        'type':tabletype,
+        'sectorsize':sectorsize,
+        'sectorcount':sectorcount,
+        'firstlba':firstlba,
+        'lastlba':lastlba,
+    })
+
+
+def _readUdev(sysdir):
+    """Properties udev recorded for a block device, from its database entry"""
+    dev=Path(sysdir,'dev').read_text().strip()
+    properties={}
+    with open(Path(UDEV_DATA,f'b{dev}')) as db:
+        for line in db:
+            if line.startswith('E:'):
+                k,_,v=line[2:].rstrip('\n').partition('=')
+                properties[k]=v
+    return(properties)
+
+def sysfsAvailable(device):
+    """True when device has sysfs & udev database entries to probe"""
+    sysdir=Path(SYS_BLOCK,Path(device).resolve().name)
+    try:
+        dev=Path(sysdir,'dev').read_text().strip()
+    except OSError:
+        return(False)
+    return(Path(UDEV_DATA,f'b{dev}').exists())
+
+def sysfsProbe(device):
+    """Probe by reading sysfs & the udev database. No subprocesses, no root"""
+    sysdir=Path(SYS_BLOCK,Path(device).resolve().name)
+    udev=_readUdev(sysdir)
+    sectorsize=int(Path(sysdir,'queue','logical_block_size').read_text())
+    scale=sectorsize//SYSFS_SECTOR_SIZE
+    sectorcount=int(Path(sysdir,'size').read_text())//scale
+
+    partitions=[]
+    for entry in sorted(sysdir.iterdir()):
+        if not Path(entry,'partition').exists():
+            continue
+        p=_readUdev(entry)
+        fields={
+            'fstype':p.get('ID_FS_TYPE'),
+            'fslabel':_unescape(p.get('ID_FS_LABEL_ENC',p.get('ID_FS_LABEL'))),
+            'fsuuid':p.get('ID_FS_UUID'),
+            'partlabel':_unescape(p.get('ID_PART_ENTRY_NAME')),
+            'partuuid':p.get('ID_PART_ENTRY_UUID'),
+            'parttype':p.get('ID_PART_ENTRY_TYPE'),
+            'partattrs':p.get('ID_PART_ENTRY_FLAGS'),
+        }
+        partitions.append(_partitionData(
+            Path('/dev',entry.name),
+            int(Path(entry,'partition').read_text()),
+            int(Path(entry,'start').read_text())//scale,
+            int(Path(entry,'size').read_text())//scale,
+            fields))
+
+    return({
+        'table':_table(udev.get('ID_PART_TABLE_UUID'),udev.get('ID_PART_TABLE_TYPE'),sectorcount,sectorsize),
+        'partitions':sorted(partitions,key=lambda p:p['startsector']),
+    })
+
+
+LSBLK_COLUMNS='PATH,TYPE,START,SIZE,LOG-SEC,FSTYPE,LABEL,UUID,PARTLABEL,PARTUUID,PARTTYPE,PARTFLAGS,PTUUID,PTTYPE'
+
+def lsblkProbe(device, executor=DEFAULT):
+    """Probe with a single lsblk call"""
+    data=json.loads(executor.run(f'sudo lsblk -J -b -p -o {LSBLK_COLUMNS} {device}').stdout)
+    disk=data['blockdevices'][0]
+    sectorsize=int(disk['log-sec'])
+    scale=sectorsize//SYSFS_SECTOR_SIZE
+
+    partitions=[]
+    for p in disk.get('children',[]):
+        if p['type']!='part':
+            continue
+        fields={
+            'fstype':p['fstype'],
+            'fslabel':p['label'],
+            'fsuuid':p['uuid'],
+            'partlabel':p['partlabel'],
+            'partuuid':p['partuuid'],
+            'parttype':p['parttype'],
+            'partattrs':p['partflags'],
+        }
+        partitions.append(_partitionData(
+            p['path'],
+            int(re.search(r'([0-9]+)$',p['path']).group(1)),
+            int(p['start'])//scale,
+            int(p['size'])//sectorsize,
+            fields))
+
+    return({
+        'table':_table(disk['ptuuid'],disk['pttype'],int(disk['size'])//sectorsize,sectorsize),
+        'partitions':sorted(partitions,key=lambda p:p['startsector']),
+    })
+
+
+def partitionNode(device, partnbr):
+    """Device node of partition partnbr of device, eg /dev/sdb2 or /dev/nvme0n1p2
+
+    For an image file this is a name only, no such file exists. See
+    disk.Partition backing & offset for where its bytes are
+    """
+    device=str(device)
+    separator='p' if device[-1].isdigit() else ''
+    return(Path(f'{device}{separator}{partnbr}'))
+
+EXT_SUPERBLOCK_OFFSET=1024
+EXT_MAGIC=0xef53
+EXT_FEATURE_COMPAT_HAS_JOURNAL=0x4
+EXT_FEATURE_INCOMPAT_EXT4=0x40|0x80|0x200   # extents, 64bit, flex_bg
+
+def sniffFilesystem(fd, offset):
+    """Type, label & uuid of an ext2/3/4 or fat filesystem starting at offset
+
+    :return: {'fstype','fslabel','fsuuid'}, all None when not recognised
+    """
+    found={'fstype':None,'fslabel':None,'fsuuid':None}
+
+    superblock=os.pread(fd,1024,offset+EXT_SUPERBLOCK_OFFSET)
+    if len(superblock)==1024 and struct.unpack_from('<H',superblock,56)[0]==EXT_MAGIC:
+        compat,incompat=struct.unpack_from('<II',superblock,92)
+        if incompat & EXT_FEATURE_INCOMPAT_EXT4:
+            found['fstype']='ext4'
+        elif compat & EXT_FEATURE_COMPAT_HAS_JOURNAL:
+            found['fstype']='ext3'
+        else:
+            found['fstype']='ext2'
+        found['fsuuid']=str(uuid.UUID(bytes=superblock[104:120]))
+        found['fslabel']=superblock[120:136].split(b'\x00',1)[0].decode(errors='replace') or None
+        return(found)
+
+    boot=os.pread(fd,512,offset)
+    if len(boot)==512 and boot[510:512]==b'\x55\xaa':
+        if boot[82:87]==b'FAT32':
+            serial,label=boot[67:71],boot[71:82]
+        elif boot[54:57]==b'FAT':
+            serial,label=boot[39:43],boot[43:54]
+        else:
+            return(found)
+        found['fstype']='vfat'
+        serial=struct.unpack('<I',serial)[0]
+        found['fsuuid']=f'{serial>>16:04X}-{serial&0xffff:04X}'
+        label=label.decode(errors='replace').rstrip()
+        found['fslabel']=label if label and label!='NO NAME' else None
+    return(found)
+
+def nativeProbe(device):
+    """Probe by reading the gpt & filesystem superblocks in process
+
+    Works on image files as well as devices the caller can read. The
+    device of partitions of an image file is a name, see partitionNode
+    """
+    try:
+        table=GptTable.read(device)
+    except ValueError:
+        table=None
+
+    if table is None:
+        sectorsize=deviceSectorSize(device)
+        with open(device,'rb') as f:
+            sectorcount=f.seek(0,os.SEEK_END)//sectorsize
+        return({'table':_table(None,None,sectorcount,sectorsize),'partitions':[]})
+
+    partitions=[]
+    fd=os.open(device,os.O_RDONLY)
+    try:
+        for partnbr,e in table.partitions():
+            fields=sniffFilesystem(fd,e.first*table.sectorsize)
+            fields.update({
+                'partlabel':e.name,
+                'partuuid':e.uniqueguid,
+                'parttype':e.typeguid,
+                'partattrs':e.attrs,
+            })
+            partitions.append(_partitionData(
+                partitionNode(device,partnbr),partnbr,e.first,e.last-e.first+1,fields))
+    finally:
+        os.close(fd)
+
+    data={
+        'table':_table(table.diskguid,'gpt',table.sectorcount,table.sectorsize),
+        'partitions':partitions,
+    }
+    data['table']['firstlba']=table.firstlba
+    data['table']['lastlba']=table.lastlba
+    return(data)
+
+
+def probeDisk(device, native=False, executor=DEFAULT):
+    """Partition table & partition data of device, read in a single pass
+
+    Reads the gpt natively when asked to, or device is an image file. Reads
+    sysfs & udev directly where the device and its partitions are known to
+    udev, otherwise asks lsblk once. Executors that are not local are always asked through lsblk.
+    """
+    if not executor.local:
+        return(lsblkProbe(device,executor))
+    if native or isRegularFile(device):
+        return(nativeProbe(device))
+    if sysfsAvailable(device):
+        try:
+            return(sysfsProbe(device))
+        except FileNotFoundError:
+            # A partition udev has yet to record
+            pass
+    return(lsblkProbe(device))
@@ -0,0 +1,181 @@
+"""
+Disk probe results kept between runs.
+
+Probing a disk costs a sudo blockdev call or two, and an lsblk or gpt read,
+every time a Disk is made, though the disk rarely changes between runs.
+Results are kept in a JSON file, one entry per device, alongside the
+identity the device had when it was probed:
+
+- the disks PTUUID & a sha256 of its gpt header & entry array, where the
+  device can be read
+- its size, and diskseq, from sysfs
+- the mtime & contents of the udev database entries of the disk and its
+  partitions. udev rewrites these on every change event, as when the kernel
+  rereads the table or a filesystem is made, so they act as change counters
+- for image files, their inode, size & mtime
+
+A result is only used while the identity is unchanged. Writes through
+PartitionTable and Partition.mkfs drop the entry of the disk outright, as
+udev may not have caught up when the disk is next probed. Disks of
+executors that are not local are never cached, their probe must go through
+the executor.
+
+    identity=probes.identity(device,executor)
+    data=probes.get(identity,'probe')
+    if data is None:
+        data=probeDisk(device)
+        probes.put(identity,'probe',data)
+"""
+
+import hashlib
+import json
+import os
+import stat
+import struct
+import threading
+import uuid
+from pathlib import Path
+from config import config
+from gpt import SIGNATURE,HEADER_SIZE,HEADER_FORMAT,deviceSectorSize,isRegularFile
+from probe import SYS_BLOCK,UDEV_DATA
+
+VERSION=1
+
+
+def _gptIdentity(device):
+    """(PTUUID, sha256 hex of the gpt header & entry array) of readable device
+
+    Devices without a gpt get a hash of their first two sectors instead
+    """
+    sectorsize=deviceSectorSize(device)
+    fd=os.open(device,os.O_RDONLY)
+    try:
+        header=os.pread(fd,sectorsize,sectorsize)
+        digest=hashlib.sha256(header)
+        if len(header)<HEADER_SIZE or header[:8]!=SIGNATURE:
+            digest.update(os.pread(fd,sectorsize,0))
+            return(None,digest.hexdigest())
+        fields=struct.unpack(HEADER_FORMAT,header[:HEADER_SIZE])
+        diskguid,entrylba,entrycount,entrysize=fields[9:13]
+        digest.update(os.pread(fd,min(entrycount*entrysize,64*pow(2,20)),entrylba*sectorsize))
+        return(str(uuid.UUID(bytes_le=diskguid)).upper(),digest.hexdigest())
+    finally:
+        os.close(fd)
+
+
+def _udevIdentity(sysdir):
+    """[[name, mtime, sha256 hex]] of the udev database entries of a disk & its
+    partitions, None for those without"""
+    found=[]
+    for entry in [sysdir]+sorted(p for p in sysdir.iterdir() if Path(p,'partition').exists()):
+        db=Path(UDEV_DATA,f"b{Path(entry,'dev').read_text().strip()}")
+        try:
+            found.append([entry.name,db.stat().st_mtime_ns,hashlib.sha256(db.read_bytes()).hexdigest()])
+        except FileNotFoundError:
+            found.append([entry.name,None,None])
+    return(found)
+
+
+def deviceIdentity(device):
+    """Everything probe results of device depend on, as a JSON serialisable
+    dict. None when it cannot be told whether device changed"""
+    path=Path(device).resolve()
+    info=os.stat(path)
+    identity={'device':str(path)}
+    if isRegularFile(path):
+        identity.update(inode=info.st_ino,size=info.st_size,mtime=info.st_mtime_ns)
+    elif stat.S_ISBLK(info.st_mode):
+        sysdir=Path(SYS_BLOCK,path.name)
+        identity['rdev']=info.st_rdev
+        identity['size']=int(Path(sysdir,'size').read_text())
+        if Path(sysdir,'diskseq').exists():
+            identity['diskseq']=int(Path(sysdir,'diskseq').read_text())
+        identity['udev']=_udevIdentity(sysdir)
+        if not any(mtime for _,mtime,_ in identity['udev']) and not os.access(path,os.R_OK):
+            # Nothing would show a change of the table
+            return(None)
+    else:
+        return(None)
+    if os.access(path,os.R_OK):
+        identity['ptuuid'],identity['gpt']=_gptIdentity(path)
+    return(identity)
+
+
+class ProbeCache:
+    """Named probe results of devices, valid while the device is unchanged
+
+    :param path: JSON file kept in. None caches nothing
+    """
+
+    def __init__(self, path):
+        self.path=Path(path) if path is not None else None
+        self._devices=None
+        self._lock=threading.Lock()
+
+    def _load(self):
+        if self._devices is not None:
+            return
+        self._devices={}
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data=json.loads(self.path.read_text())
+        except ValueError:
+            return
+        if data.get('version')==VERSION:
+            self._devices=data['devices']
+
+    def _save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True,exist_ok=True)
+        temp=Path(f'{self.path}.{os.getpid()}.tmp')
+        temp.write_text(json.dumps({'version':VERSION,'devices':self._devices},default=str))
+        os.replace(temp,self.path)
+
+    def identity(self, device, executor):
+        """Current identity of device, see deviceIdentity. None when not cached"""
+        if self.path is None or not executor.local:
+            return(None)
+        try:
+            return(deviceIdentity(device))
+        except OSError:
+            return(None)
+
+    def get(self, identity, name):
+        """Result name stored for the device of identity, None unless it was
+        stored under this same identity"""
+        if identity is None:
+            return(None)
+        with self._lock:
+            self._load()
+            entry=self._devices.get(identity['device'])
+            if entry is None or entry['identity']!=identity or name not in entry['results']:
+                return(None)
+            # A copy, callers may change it
+            return(json.loads(json.dumps(entry['results'][name])))
+
+    def put(self, identity, name, result):
+        """Store result name of the device of identity. Results stored under
+        another identity are dropped"""
+        if identity is None:
+            return
+        with self._lock:
+            self._load()
+            entry=self._devices.get(identity['device'])
+            if entry is None or entry['identity']!=identity:
+                entry=self._devices[identity['device']]={'identity':identity,'results':{}}
+            entry['results'][name]=json.loads(json.dumps(result,default=str))
+            self._save()
+
+    def invalidate(self, device):
+        """Drop everything stored for device, as it is about to be written"""
+        if self.path is None:
+            return
+        with self._lock:
+            self._load()
+            if self._devices.pop(str(Path(device).resolve()),None) is not None:
+                self._save()
+
+
+DEFAULT=ProbeCache(config['cache'].get('probes'))
@@ -0,0 +1,231 @@
+"""
+Progress & throughput of long running phases.
+
+Any stage moving bytes, or working through a count of things, feeds a Bar.
+Feeding costs a lock, an addition and a clock read; bars are only drawn
+once every INTERVAL seconds, by whichever feeding thread finds a draw due.
+All live bars are drawn together, so stages running at once each keep a
+line of their own.
+
+On a terminal the bars are redrawn in place. Otherwise, as when run by the
+fleet tooling, every bar is written out as a JSON line each interval, and
+once more when it finishes:
+
+    {"kind":"progress","name":"download","label":"Lakka.img.gz","unit":"B",
+     "done":1048576,"total":4194304,"rate":524288.0,"eta":6.0,
+     "elapsed":2.0,"state":"running","time":1700000000.0}
+
+MEDIAPC_PROGRESS=tty|json|off overrides the choice.
+
+    with progress.bar('download',size,label=name) as bar:
+        bar.add(len(block))
+"""
+
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+INTERVAL=0.5
+RATE_SMOOTHING=0.3          # Weight of the latest interval in the rate shown
+
+MODE_TTY='tty'
+MODE_JSON='json'
+MODE_OFF='off'
+
+RUNNING='running'
+DONE='done'
+FAILED='failed'
+
+UNIT_BYTES='B'
+
+
+class Bar:
+    """Progress of one phase. Thread safe
+
+    :param total: Expected units, None when not known ahead
+    :param unit: UNIT_BYTES, or the name of what is counted
+    :param done: Units done already, as by an earlier, resumed attempt
+    """
+
+    def __init__(self, reporter, name, total=None, label=None, unit=UNIT_BYTES, done=0):
+        self.reporter=reporter
+        self.name=name
+        self.total=total
+        self.label=label or name
+        self.unit=unit
+        self.done=done
+        self.state=RUNNING
+        self.rate=None
+        self.started=time.monotonic()
+        self._initial=done
+        self._sample=(self.started,done)
+        self._lock=threading.Lock()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exctype, *exc):
+        self.finish(FAILED if exctype is not None else DONE)
+
+    def add(self, count):
+        with self._lock:
+            self.done+=count
+        if self.reporter is not None and time.monotonic()>=self.reporter.due:
+            self.reporter.draw()
+
+    def set(self, done):
+        """Set units done, for stages that know their position rather than increments"""
+        with self._lock:
+            self.done=done
+        if self.reporter is not None and time.monotonic()>=self.reporter.due:
+            self.reporter.draw()
+
+    def track(self, chunks):
+        """Yield chunks, adding the length of each"""
+        for chunk in chunks:
+            self.add(len(chunk))
+            yield(chunk)
+
+    def finish(self, state=DONE):
+        if self.state!=RUNNING:
+            return
+        self.state=state
+        if self.reporter is not None:
+            self.reporter.finish(self)
+
+    @property
+    def elapsed(self):
+        return(time.monotonic()-self.started)
+
+    @property
+    def eta(self):
+        """Seconds left at the current rate, None when unknown"""
+        if not self.total or not self.rate:
+            return(None)
+        return(max(self.total-self.done,0)/self.rate)
+
+    def _sampleRate(self, now):
+        last,lastdone=self._sample
+        if self.state!=RUNNING:
+            # Overall rate, once finished
+            self.rate=(self.done-self._initial)/(now-self.started) if now>self.started else None
+            return
+        if now-last<self.reporter.interval/2:
+            # Too short a time for a meaningful rate
+            return
+        rate=(self.done-lastdone)/(now-last)
+        self.rate=rate if self.rate is None else self.rate+RATE_SMOOTHING*(rate-self.rate)
+        self._sample=(now,self.done)
+
+    def record(self):
+        """State of the bar as a JSON serialisable dict"""
+        eta=self.eta
+        return({
+            'kind':'progress',
+            'name':self.name,
+            'label':self.label,
+            'unit':self.unit,
+            'done':self.done,
+            'total':self.total,
+            'rate':round(self.rate,1) if self.rate is not None else None,
+            'eta':round(eta,1) if eta is not None and self.state==RUNNING else None,
+            'elapsed':round(self.elapsed,3),
+            'state':self.state,
+            'time':round(time.time(),3),
+        })
+
+    def line(self, width):
+        """State of the bar as one line of at most width characters"""
+        if self.unit==UNIT_BYTES:
+            scale,unit=pow(2,20),'MiB'
+            amount=lambda n:f'{n/scale:.1f}'
+        else:
+            scale,unit=1,self.unit
+            amount=lambda n:f'{n}'
+        text=f'{amount(self.done)}/{amount(self.total)}' if self.total else amount(self.done)
+        text+=f'[{unit}]'
+        if self.rate is not None:
+            text+=f' {self.rate/scale:.1f}[{unit}/s]'
+        if self.state==RUNNING:
+            eta=self.eta
+            if eta is not None:
+                text+=f' ETA {int(eta)//60}:{int(eta)%60:02d}'
+        else:
+            text+=f' {self.state} in {self.elapsed:.1f}[s]'
+        label=f'{self.label[-20:]: <20}'
+        if not self.total:
+            return(f'{label} {text}'[:width])
+        pct=min(self.done/self.total,1.0)
+        barwidth=max(width-len(label)-len(text)-12,10)
+        return(f"{label} {pct: >6.1%} |{'#'*int(barwidth*pct): <{barwidth}}| {text}"[:width])
+
+
+class Reporter:
+    """Draws the bars of every running phase
+
+    :param out: Stream drawn to, stdout by default
+    :param mode: MODE_TTY, MODE_JSON or MODE_OFF. From MEDIAPC_PROGRESS when
+        set, else MODE_TTY when out is a terminal and MODE_JSON otherwise
+    """
+
+    def __init__(self, out=None, mode=None, interval=INTERVAL):
+        self.out=out or sys.stdout
+        if mode is None:
+            mode=os.environ.get('MEDIAPC_PROGRESS')
+        if mode is None:
+            mode=MODE_TTY if self.out.isatty() else MODE_JSON
+        self.mode=mode
+        self.interval=interval
+        self.due=0              # Monotonic time the next draw is due
+        self._bars=[]
+        self._drawn=0           # Lines of bars on the terminal, above the cursor
+        self._lock=threading.Lock()
+
+    def bar(self, name, total=None, label=None, unit=UNIT_BYTES, done=0, show=True):
+        """Start a Bar, drawn unless show is False. See Bar"""
+        shown=show and self.mode!=MODE_OFF
+        bar=Bar(self if shown else None,name,total,label,unit,done)
+        if shown:
+            with self._lock:
+                self._bars.append(bar)
+        return(bar)
+
+    def draw(self):
+        """Draw every live bar, unless another thread is drawing them already"""
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._draw([])
+        finally:
+            self._lock.release()
+
+    def finish(self, bar):
+        """Draw bar a last time and drop it from those drawn"""
+        with self._lock:
+            if bar in self._bars:
+                self._bars.remove(bar)
+                self._draw([bar])
+
+    def _draw(self, finished):
+        now=time.monotonic()
+        self.due=now+self.interval
+        for bar in finished+self._bars:
+            bar._sampleRate(now)
+        if self.mode==MODE_TTY:
+            width=shutil.get_terminal_size().columns-1
+            # Back over the live bars drawn last time. Finished bars are left above them
+            parts=[f'\x1b[{self._drawn}F'] if self._drawn else []
+            parts.extend(f'{bar.line(width)}\x1b[K\n' for bar in finished+self._bars)
+            parts.append('\x1b[J')
+            self._drawn=len(self._bars)
+        else:
+            parts=[json.dumps(bar.record())+'\n' for bar in finished+self._bars]
+        self.out.write(''.join(parts))
+        self.out.flush()
+
+
+reporter=Reporter()
+bar=reporter.bar
@@ -0,0 +1,106 @@
+import hashlib
+import http.server
+import os
+import sys
+import threading
+import uuid
+from pathlib import Path
+import pytest
+
+# Modules live flat at the repository root
+sys.path.insert(0,str(Path(__file__).parent.parent))
+# Keep progress lines out of test output
+os.environ.setdefault('MEDIAPC_PROGRESS','off')
+
+from gpt import GptTable,GptEntry
+
+
+LINUX_TYPE='0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+
+
+def makeImage(path, mib, partitions):
+    """Sparse gpt disk image file of mib MiB
+
+    :param partitions: [(name, start MiB, size MiB)]
+    """
+    with open(path,'wb') as f:
+        f.truncate(mib*pow(2,20))
+    table=GptTable.create(path)
+    for n,(name,start,size) in enumerate(partitions,1):
+        first=start*pow(2,20)//table.sectorsize
+        table.setEntry(n,GptEntry(LINUX_TYPE,str(uuid.uuid4()),first,first+size*pow(2,20)//table.sectorsize-1,name=name))
+    table.write()
+    return(path)
+
+
+@pytest.fixture
+def diskImage(tmp_path):
+    """Image file of 64MiB with partitions 'one' of 8MiB at 1MiB & 'two' of 16MiB at 9MiB"""
+    return(makeImage(tmp_path/'disk.img',64,[('one',1,8),('two',9,16)]))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves server.files, honouring Range & If-None-Match"""
+
+    def do_GET(self):
+        server=self.server
+        rangeheader=self.headers.get('Range') if server.ranges else None
+        with server.lock:
+            server.requests.append((self.path,rangeheader))
+        data=server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag=f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match')==etag:
+            self.send_response(304)
+            self.send_header('ETag',etag)
+            self.end_headers()
+            return
+        start,end=0,len(data)-1
+        if rangeheader is not None:
+            first,last=rangeheader.split('=',1)[1].split('-')
+            start,end=int(first),min(int(last),len(data)-1)
+            self.send_response(206)
+            self.send_header('Content-Range',f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length',str(end+1-start))
+        self.send_header('ETag',etag)
+        self.end_headers()
+        body=data[start:end+1]
+        with server.lock:
+            cut=(self.path,start) in server.cut
+            server.cut.discard((self.path,start))
+        if cut:
+            # Connection lost part way through the body
+            self.wfile.write(body[:len(body)//2])
+            self.close_connection=True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def httpServer():
+    """Local http server standing in for download & theme hosts
+
+    Set files {path:bytes} to serve, ranges False to ignore Range headers,
+    and add (path, range start) to cut for that response to be cut short once.
+    requests lists the (path, Range header) of every request.
+    """
+    server=http.server.ThreadingHTTPServer(('127.0.0.1',0),_Handler)
+    server.daemon_threads=True
+    server.files={}
+    server.ranges=True
+    server.cut=set()
+    server.requests=[]
+    server.lock=threading.Lock()
+    server.url=lambda path:f'http://127.0.0.1:{server.server_address[1]}{path}'
+    thread=threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    yield(server)
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,85 @@
+import functools
+import gzip
+import hashlib
+import os
+import pytest
+import cache
+from cache import ImageCache,INCOMING_PREFIX
+from download import Download
+
+CHUNK=64*pow(2,10)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache,'Download',functools.partial(Download,chunksize=CHUNK,showProgress=False))
+    return(ImageCache(tmp_path/'cache',pow(2,30)))
+
+
+@pytest.fixture
+def archive(httpServer):
+    data=os.urandom(16*CHUNK+1000)
+    httpServer.files['/os.img.gz']=data
+    return(data)
+
+
+def _incoming(store):
+    return(sorted(p.name for p in store.root.glob(f'{INCOMING_PREFIX}*')))
+
+
+def test_interrupted_archive_download_resumes(store, archive, httpServer):
+    url=httpServer.url('/os.img.gz')
+    httpServer.cut.add(('/os.img.gz',5*CHUNK))
+    with pytest.raises(Exception):
+        store.getArchive(url)
+    assert len(_incoming(store))==2
+
+    httpServer.requests.clear()
+    path=store.getArchive(url)
+    # Only the chunk lost is fetched again
+    assert [r for p,r in httpServer.requests]==['bytes=0-0',f'bytes={5*CHUNK}-{6*CHUNK-1}']
+    assert path.read_bytes()==archive
+    assert path.name==hashlib.sha256(archive).hexdigest()
+    assert _incoming(store)==[]
+
+
+def test_archive_hit_and_mismatch(store, archive, httpServer):
+    url=httpServer.url('/os.img.gz')
+    sha=hashlib.sha256(archive).hexdigest()
+    assert store.getArchive(url,sha)==store.objectPath(sha)
+    httpServer.requests.clear()
+    assert store.getArchive(url)==store.objectPath(sha)
+    assert httpServer.requests==[]
+    assert store.stats()['hits']==1
+
+    httpServer.files['/other.img.gz']=archive
+    with pytest.raises(ValueError,match='expected'):
+        store.getArchive(httpServer.url('/other.img.gz'),'0'*64)
+    assert _incoming(store)==[]
+
+
+def test_partial_downloads_are_evicted_first(store, archive, httpServer):
+    httpServer.files['/old.img.gz']=os.urandom(len(archive))
+    httpServer.cut.add(('/old.img.gz',5*CHUNK))
+    with pytest.raises(Exception):
+        store.getArchive(httpServer.url('/old.img.gz'))
+    assert len(_incoming(store))==2
+
+    # Room for the archive, not for the partial download as well
+    store.budget=len(archive)*3//2
+    path=store.getArchive(httpServer.url('/os.img.gz'))
+    assert _incoming(store)==[]
+    assert path.exists()
+    assert store.stats()['evictions']==0
+
+
+def test_image_is_kept_sparse(store, tmp_path):
+    data=os.urandom(CHUNK)+bytes(16*CHUNK)+os.urandom(CHUNK)
+    seed=tmp_path/'os.img.gz'
+    seed.write_bytes(gzip.compress(data))
+    archivepath=store.getArchive('http://127.0.0.1:9/os.img.gz',seed=seed)
+    image=store.getImage(archivepath)
+    assert image.read_bytes()==data
+    assert image.name==hashlib.sha256(data).hexdigest()
+    assert image.stat().st_blocks*512<len(data)
+    assert store.getImage(archivepath)==image
@@ -0,0 +1,32 @@
+from disk import Disk
+from executor import SimulatedExecutor,SimulatedDisk
+from probecache import ProbeCache
+
+
+def test_image_partitions_locate_their_bytes_in_the_image(diskImage):
+    disk=Disk(diskImage,probes=ProbeCache(None))
+    two=disk.partitiontable.getPartitionBy('two','partlabel')
+    # Named like a block device partition, with no node of its own
+    assert not two.device.exists()
+    assert two.backing==diskImage
+    assert two.offset==9*pow(2,20)
+    assert two.bytesize==16*pow(2,20)
+
+
+def test_probes_after_writes_wait_for_udev():
+    executor=SimulatedExecutor(SimulatedDisk('/dev/sdb',pow(2,30)))
+    disk=Disk('/dev/sdb',executor=executor,probes=ProbeCache(None))
+    disk.confirmedAsExpectedDisk=True
+    layout=disk.partitiontable.newLayout()
+    layout.add(64,'data',fstype='ext4',fslabel='DATA')
+    layout.commit()
+    commands=[c.split()[1] if c.startswith('sudo ') else c.split()[0] for c in executor.commands]
+    assert 'mkfs' in commands
+    written=False
+    for n,command in enumerate(commands):
+        if command in ('sfdisk','mkfs'):
+            written=True
+        elif command=='lsblk' and written:
+            assert executor.commands[n-1]=='udevadm settle'
+            written=False
+    assert disk.partitiontable.getPartitionBy('data','partlabel').fslabel=='DATA'
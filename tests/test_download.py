@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import pytest
+from download import Download,STATE_SUFFIX
+
+CHUNK=64*pow(2,10)
+
+
+@pytest.fixture
+def payload(httpServer):
+    data=os.urandom(16*CHUNK+1000)
+    httpServer.files['/image.img.gz']=data
+    return(data)
+
+
+def test_ranged_download(httpServer, payload, tmp_path):
+    target=tmp_path/'image.img.gz'
+    fetch=Download(httpServer.url('/image.img.gz'),target,chunksize=CHUNK,showProgress=False)
+    assert fetch.run()==target
+    assert target.read_bytes()==payload
+    assert fetch.sha256==hashlib.sha256(payload).hexdigest()
+    ranges=sorted(r for p,r in httpServer.requests if r!='bytes=0-0')
+    assert len(ranges)==17
+    assert not os.path.exists(f'{target}{STATE_SUFFIX}')
+
+
+def test_interrupted_download_resumes(httpServer, payload, tmp_path):
+    target=tmp_path/'image.img.gz'
+    url=httpServer.url('/image.img.gz')
+    httpServer.cut.add(('/image.img.gz',5*CHUNK))
+    with pytest.raises(Exception):
+        Download(url,target,chunksize=CHUNK,showProgress=False).run()
+    assert not target.exists()
+    state=json.loads(open(f'{target}{STATE_SUFFIX}').read())
+    assert sorted(state['done'])==[n for n in range(17) if n!=5]
+
+    httpServer.requests.clear()
+    fetch=Download(url,target,chunksize=CHUNK,showProgress=False)
+    fetch.run()
+    # Only the chunk lost is fetched again
+    assert [r for p,r in httpServer.requests]==['bytes=0-0',f'bytes={5*CHUNK}-{6*CHUNK-1}']
+    assert target.read_bytes()==payload
+    assert fetch.sha256==hashlib.sha256(payload).hexdigest()
+
+
+def test_stream_download_without_ranges(httpServer, payload, tmp_path):
+    httpServer.ranges=False
+    target=tmp_path/'image.img.gz'
+    fetch=Download(httpServer.url('/image.img.gz'),target,chunksize=CHUNK,showProgress=False)
+    fetch.run()
+    assert target.read_bytes()==payload
+    assert fetch.sha256==hashlib.sha256(payload).hexdigest()
+    assert len(httpServer.requests)==2
+
+
+def test_changed_file_is_not_resumed(httpServer, payload, tmp_path):
+    target=tmp_path/'image.img.gz'
+    url=httpServer.url('/image.img.gz')
+    httpServer.cut.add(('/image.img.gz',CHUNK))
+    with pytest.raises(Exception):
+        Download(url,target,chunksize=CHUNK,showProgress=False).run()
+    # New contents, new ETag: the parts of the old file are not kept
+    changed=os.urandom(len(payload))
+    httpServer.files['/image.img.gz']=changed
+    Download(url,target,chunksize=CHUNK,showProgress=False).run()
+    assert target.read_bytes()==changed
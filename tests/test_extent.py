@@ -0,0 +1,51 @@
+import random
+import pytest
+from extent import FreeExtents,FIT_FIRST,FIT_BEST
+
+
+def _expected(extents, count, fit, before):
+    """find by scanning every free extent"""
+    fits=[]
+    for start,end in extents:
+        aligned=extents.align(start)
+        if end-aligned+1>=count and (before is None or aligned+count-1<=before):
+            fits.append((end-aligned+1 if fit==FIT_BEST else 0,start,aligned))
+    if not fits:
+        return((None,None))
+    _,_,aligned=min(fits)
+    return((aligned,aligned+count-1))
+
+
+@pytest.mark.parametrize('seed',range(5))
+def test_find_matches_scan(seed):
+    rng=random.Random(seed)
+    extents=FreeExtents(34,100000,alignment=8)
+    used=[]
+    for _ in range(2000):
+        if used and rng.random()<0.4:
+            extents.release(*used.pop(rng.randrange(len(used))))
+        else:
+            start,end=extents.find(rng.randint(1,400),rng.choice([FIT_FIRST,FIT_BEST]))
+            if start is not None:
+                extents.allocate(start,end)
+                used.append((start,end))
+        count=rng.randint(1,600)
+        before=rng.choice([None,rng.randint(0,100000)])
+        assert extents.find(count,FIT_BEST,before)==_expected(extents,count,FIT_BEST,before)
+        if before is None:
+            assert extents.find(count,FIT_FIRST)==_expected(extents,count,FIT_FIRST,None)
+    assert len(extents)==len(list(extents))
+
+
+def test_best_fit_before_skips_late_extents():
+    extents=FreeExtents(0,999,alignment=1)
+    # Free: 10 sectors at 0, then 5 sectors high up
+    extents.allocate(10,899)
+    extents.allocate(905,999)
+    assert extents.find(5,FIT_BEST)==(900,904)
+    assert extents.find(5,FIT_BEST,before=100)==(0,4)
+    assert extents.find(11,FIT_BEST,before=100)==(None,None)
+    copied=extents.copy()
+    copied.allocate(0,9)
+    assert copied.find(5,FIT_BEST,before=100)==(None,None)
+    assert extents.find(5,FIT_BEST,before=100)==(0,4)
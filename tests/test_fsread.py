@@ -0,0 +1,56 @@
+import os
+import shutil
+import struct
+import subprocess
+import pytest
+from fsread import openFilesystem,TreeExtract,UnsupportedFilesystem,EXT_INCOMPAT_RECOVER
+
+pytestmark=pytest.mark.skipif(shutil.which('mkfs.ext4') is None,reason='needs mkfs.ext4')
+
+# Superblock s_feature_incompat, from the start of the filesystem
+INCOMPAT_OFFSET=1024+96
+
+
+@pytest.fixture
+def extImage(tmp_path):
+    """8MiB ext4 image holding /hello, linked again as /dir/again, & symlink /dir/link"""
+    tree=tmp_path/'tree'
+    tree.mkdir()
+    (tree/'hello').write_bytes(b'hello\n')
+    (tree/'dir').mkdir()
+    os.link(tree/'hello',tree/'dir'/'again')
+    os.symlink('../hello',tree/'dir'/'link')
+    image=tmp_path/'ext4.img'
+    subprocess.run(['mkfs.ext4','-q','-F','-d',tree,image,'8M'],check=True)
+    return(image)
+
+
+def _setIncompat(image, flag):
+    with open(image,'r+b') as f:
+        f.seek(INCOMPAT_OFFSET)
+        incompat=struct.unpack('<I',f.read(4))[0]
+        f.seek(INCOMPAT_OFFSET)
+        f.write(struct.pack('<I',incompat|flag))
+
+
+def test_ext_read(extImage):
+    with openFilesystem(extImage) as fs:
+        assert fs.read('/hello')==b'hello\n'
+
+
+def test_extract_tree(extImage, tmp_path):
+    target=tmp_path/'target'
+    target.mkdir()
+    with openFilesystem(extImage) as fs:
+        stats=TreeExtract(fs,target).run()
+    assert stats['files']==1
+    assert stats['links']==2
+    assert (target/'hello').read_bytes()==b'hello\n'
+    assert os.stat(target/'hello').st_ino==os.stat(target/'dir'/'again').st_ino
+    assert os.readlink(target/'dir'/'link')=='../hello'
+
+
+def test_ext_needing_recovery_is_refused(extImage):
+    _setIncompat(extImage,EXT_INCOMPAT_RECOVER)
+    with pytest.raises(UnsupportedFilesystem,match='journal recovery'):
+        openFilesystem(extImage)
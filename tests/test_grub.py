@@ -0,0 +1,24 @@
+from pathlib import Path
+import pytest
+from grub.grub import renderGrubCfg,grubQuote
+
+DATA=Path(__file__).parent/'data'
+
+ENTRIES=[
+    {'name':'OpenELEC','fsuuid':'1b6f3b9e-0d4a-4c39-9a5e-2f1d2a7c9e10','kernelpath':'/KERNEL',
+     'kernelarg':'boot=UUID=1b6f3b9e ssh quiet','class':'kodi'},
+    {'name':"Lakka's menu",'fsuuid':'7c2a0c55-3e8e-4d7e-b1a4-6f0f5e3b2d21','kernelpath':'/KERNEL',
+     'kernelarg':'','class':None},
+]
+
+
+@pytest.mark.parametrize('golden,kwargs',[
+    ('grub-savedefault.cfg',{}),
+    ('grub-theme.cfg',{'opts':{'GRUB_DEFAULT=2','GRUB_TIMEOUT=5'},'theme':{'name':'Zenburn','fonts':['a.pf2']}}),
+])
+def test_render_grub_cfg(golden, kwargs):
+    assert renderGrubCfg(ENTRIES,**kwargs)==(DATA/golden).read_text()
+
+
+def test_grub_quote():
+    assert grubQuote("it's")=="'it'\\''s'"
@@ -0,0 +1,86 @@
+import os
+import threading
+from conftest import makeImage
+import image
+from image import FanOutWriter,clonePartition,replicateImage
+
+
+class _FailingClose:
+    """PrivilegedWriter stand in taking every chunk, failing only on close"""
+
+    written={}
+
+    def __init__(self, path, bytesize=None, offset=0):
+        self.path=path
+        _FailingClose.written[path]=b''
+
+    def write(self, data):
+        _FailingClose.written[self.path]+=data
+
+    def close(self):
+        raise OSError(5,'Input/output error')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def test_fanout_close_error_does_not_hang(monkeypatch):
+    monkeypatch.setattr(image,'PrivilegedWriter',_FailingClose)
+    out=FanOutWriter(['a','b'],depth=2)
+    for n in range(8):
+        out.write(bytes([n])*16)
+    result={}
+    closer=threading.Thread(target=lambda:result.update(errors=out.close()),daemon=True)
+    closer.start()
+    closer.join(10)
+    assert not closer.is_alive(), 'FanOutWriter.close hung on a target failing to close'
+    assert set(result['errors'])=={'a','b'}
+    assert all(isinstance(e,OSError) for e in result['errors'].values())
+    assert _FailingClose.written['a']==b''.join(bytes([n])*16 for n in range(8))
+
+
+def test_clone_into_image_file_partition(tmp_path):
+    source=makeImage(tmp_path/'os.img',8,[('system',1,4)])
+    data=os.urandom(pow(2,20))
+    with open(source,'r+b') as f:
+        # Rest of the partition is a hole
+        f.seek(pow(2,20))
+        f.write(data)
+    target=makeImage(tmp_path/'disk.img',64,[('one',1,8),('two',9,16)])
+    with open(target,'r+b') as f:
+        # Stale data, to be zeroed where the image has none
+        f.seek(9*pow(2,20))
+        f.write(b'\xff'*16*pow(2,20))
+
+    clonePartition(source,target,targetbytesize=16*pow(2,20),offset=9*pow(2,20))
+
+    with open(target,'rb') as f:
+        assert f.read(9*pow(2,20))[pow(2,20):]==bytes(8*pow(2,20))
+        assert f.read(pow(2,20))==data
+        assert f.read(3*pow(2,20))==bytes(3*pow(2,20))
+        # Past the image partition, the target partition is left as it was
+        assert f.read(pow(2,20))==b'\xff'*pow(2,20)
+
+
+def test_replicate_zeroes_holes_in_partitions(tmp_path):
+    golden=makeImage(tmp_path/'golden.img',16,[('boot',1,4),('system',5,8)])
+    data=os.urandom(pow(2,20))
+    with open(golden,'r+b') as f:
+        # Rest of both partitions is holes, as metadata of zeros dug out
+        f.seek(6*pow(2,20))
+        f.write(data)
+    target=tmp_path/'disk.img'
+    target.write_bytes(b'\xff'*32*pow(2,20))
+
+    stats=replicateImage(golden,target)
+
+    assert stats['grown']==2
+    assert stats['zeroed']==11*pow(2,20)
+    with open(target,'rb') as f:
+        f.seek(pow(2,20))
+        assert f.read(5*pow(2,20))==bytes(5*pow(2,20))
+        assert f.read(pow(2,20))==data
+        assert f.read(6*pow(2,20))==bytes(6*pow(2,20))
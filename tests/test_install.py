@@ -0,0 +1,44 @@
+import gzip
+import os
+import pytest
+from conftest import makeImage
+from disk import Disk
+from probecache import ProbeCache
+import install
+
+
+@pytest.fixture
+def osImage(tmp_path):
+    """gzip compressed image with a 4MiB partition of random data at 1MiB
+
+    :return: (path of the .gz, partition contents)
+    """
+    path=makeImage(tmp_path/'os.img',8,[('system',1,4)])
+    data=os.urandom(4*pow(2,20))
+    with open(path,'r+b') as f:
+        f.seek(pow(2,20))
+        f.write(data)
+    with open(path,'rb') as f, gzip.open(f'{path}.gz','wb') as out:
+        out.write(f.read())
+    return(f'{path}.gz',data)
+
+
+def test_stream_install_to_image_files(tmp_path, osImage):
+    gz,data=osImage
+    targets=[]
+    for n in range(2):
+        image=makeImage(tmp_path/f'disk{n}.img',64,[('one',1,8),('two',9,16)])
+        disk=Disk(image,probes=ProbeCache(None))
+        targets.append((disk,disk.partitiontable.getPartitionBy('two','partlabel')))
+
+    results=install.streamInstall(targets,'os',gz,verify=True)
+
+    for (disk,before),after in zip(targets,results):
+        assert not isinstance(after,Exception), after
+        assert after.partuuid==before.partuuid
+        with open(disk.device,'rb') as f:
+            f.seek(before.offset)
+            assert f.read(len(data))==data
+            # Nothing written outside the partition
+            f.seek(pow(2,20))
+            assert f.read(8*pow(2,20))==bytes(8*pow(2,20))
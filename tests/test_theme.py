@@ -0,0 +1,63 @@
+import io
+import tarfile
+import pytest
+from grub.theme import ThemeCache,FETCHED,UNCHANGED,FAILED
+
+
+def themeArchive(files):
+    """tar.gz of {name:text}"""
+    out=io.BytesIO()
+    with tarfile.open(fileobj=out,mode='w:gz') as tar:
+        for name,text in files.items():
+            data=text.encode()
+            info=tarfile.TarInfo(name)
+            info.size=len(data)
+            tar.addfile(info,io.BytesIO(data))
+    return(out.getvalue())
+
+
+@pytest.fixture
+def themes(httpServer):
+    httpServer.files['/zen.tar.gz']=themeArchive({'zen-HEAD/theme.txt':'title-text: "zen"','zen-HEAD/font.pf2':'font'})
+    httpServer.files['/poly.tar.gz']=themeArchive({'poly-HEAD/theme.txt':'title-text: "poly"'})
+    return({
+        'Zen':{'archive':httpServer.url('/zen.tar.gz')},
+        'Poly':{'archive':httpServer.url('/poly.tar.gz')},
+    })
+
+
+def test_fetch_then_unchanged(httpServer, themes, tmp_path):
+    cache=ThemeCache(tmp_path)
+    assert cache.fetchAll(themes)=={'Zen':FETCHED,'Poly':FETCHED}
+    assert (cache.themeDir('Zen')/'theme.txt').read_text()=='title-text: "zen"'
+    assert cache.themeDir('Zen').name=='zen-HEAD'
+
+    # Conditional requests, answered 304 as the ETags match
+    assert cache.fetchAll(themes)=={'Zen':UNCHANGED,'Poly':UNCHANGED}
+
+    httpServer.files['/zen.tar.gz']=themeArchive({'zen-HEAD/theme.txt':'title-text: "zen 2"'})
+    assert cache.fetchAll(themes)=={'Zen':FETCHED,'Poly':UNCHANGED}
+    assert (cache.themeDir('Zen')/'theme.txt').read_text()=='title-text: "zen 2"'
+    assert not (cache.themeDir('Zen')/'font.pf2').exists()
+
+
+def test_failed_fetch_keeps_cached_copy(httpServer, themes, tmp_path):
+    cache=ThemeCache(tmp_path)
+    cache.fetchAll(themes)
+    del httpServer.files['/poly.tar.gz']
+    themes['Missing']={'archive':httpServer.url('/missing.tar.gz')}
+    httpServer.files['/zen.tar.gz']=themeArchive({'zen-HEAD/theme.txt':'changed'})
+    results=cache.fetchAll(themes)
+    # Failures do not stop the others
+    assert results=={'Zen':FETCHED,'Poly':FAILED,'Missing':FAILED}
+    assert set(cache.errors)=={'Poly','Missing'}
+    assert cache.themeDir('Missing') is None
+    assert (cache.themeDir('Poly')/'theme.txt').read_text()=='title-text: "poly"'
+
+
+def test_members_outside_the_theme_are_not_unpacked(httpServer, tmp_path):
+    httpServer.files['/evil.tar.gz']=themeArchive({'evil/theme.txt':'x','../../escaped':'x'})
+    cache=ThemeCache(tmp_path/'themes')
+    assert cache.fetch('Evil',httpServer.url('/evil.tar.gz'))==FETCHED
+    assert not (tmp_path/'escaped').exists()
+    assert not list(tmp_path.rglob('escaped'))
@@ -0,0 +1,39 @@
+import os
+import stat
+from treecopy import TreeCopy
+
+
+def test_copy_tree(tmp_path):
+    source=tmp_path/'source'
+    (source/'dir'/'deep').mkdir(parents=True)
+    (source/'dir'/'deep'/'file').write_bytes(b'deep\n')
+    data=os.urandom(300000)
+    (source/'big').write_bytes(data)
+    os.link(source/'big',source/'dir'/'alias')
+    os.symlink('../big',source/'dir'/'link')
+    for n in range(300):
+        (source/f'small{n}').write_bytes(b'%d'%n)
+    os.mkfifo(source/'fifo')
+    os.utime(source/'dir',ns=(pow(10,18),pow(10,18)))
+    os.chmod(source/'dir',0o555)
+    target=tmp_path/'target'
+    target.mkdir()
+
+    copier=TreeCopy(source,target,workers=4)
+    stats=copier.run()
+
+    assert stats['files']==302
+    assert stats['dirs']==2
+    assert stats['links']==2
+    assert stats['special']==1
+    assert stats['bytes']==len(data)+5+sum(len(b'%d'%n) for n in range(300))
+    assert (target/'big').read_bytes()==data
+    assert os.stat(target/'big').st_ino==os.stat(target/'dir'/'alias').st_ino
+    assert os.readlink(target/'dir'/'link')=='../big'
+    assert (target/'small299').read_bytes()==b'299'
+    assert stat.S_ISFIFO(os.lstat(target/'fifo').st_mode)
+    assert (target/'dir'/'deep'/'file').read_bytes()==b'deep\n'
+    assert stat.S_IMODE(os.stat(target/'dir').st_mode)==0o555
+    assert os.stat(target/'dir').st_mtime_ns==pow(10,18)
+    os.chmod(source/'dir',0o755)
+    os.chmod(target/'dir',0o755)
@@ -0,0 +1,30 @@
+import pytest
+import tracing
+from util import splitPipeline,bash,bashParallel
+
+
+@pytest.mark.parametrize('cmd,expected',[
+    ('ls -l',[['ls','-l']]),
+    ('lsblk -J | jq .blockdevices',[['lsblk','-J'],['jq','.blockdevices']]),
+    ('echo "|"',[['echo','|']]),
+    ("echo '|' | cat",[['echo','|'],['cat']]),
+    ('echo \\| | cat',[['echo','|'],['cat']]),
+    ('grep "a | b" file|wc -l',[['grep','a | b','file'],['wc','-l']]),
+    ('echo "say \\"|\\"" | cat',[['echo','say "|"'],['cat']]),
+])
+def test_split_pipeline(cmd, expected):
+    assert splitPipeline(cmd)==expected
+
+
+def test_bash_quoted_pipe_is_an_argument():
+    assert bash('echo "|"').stdout=='|\n'
+    assert bash("echo 'a|b' | tr '|' -").stdout=='a-b\n'
+
+
+def test_parallel_commands_are_traced_not_printed(capsys):
+    before=tracing.tracer.totals[tracing.KIND_COMMAND].get('echo',{}).get('count',0)
+    results=bashParallel(['echo one','echo two | cat'])
+    assert [r.stdout for r in results]==['one\n','two\n']
+    assert capsys.readouterr().out==''
+    assert tracing.tracer.totals[tracing.KIND_COMMAND]['echo']['count']==before+1
+    assert 'echo |...' in tracing.tracer.totals[tracing.KIND_COMMAND]
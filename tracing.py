@@ -0,0 +1,161 @@
+"""
+Lightweight tracing of install phases & external commands.
+
+Phases (download, extract, mkfs, grub-install...) and every command run
+through util.bash are recorded as spans. Totals per phase & command are
+always kept, for the end of run summary. Spans are also written as JSON
+lines when a trace file is opened. Recording a span costs a couple of
+clock reads and a dict, so tracing is left on.
+
+    with tracing.span('extract', osid='lakka'):
+        ...
+    tracing.summary()
+"""
+
+import contextvars
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+KIND_PHASE='phase'
+KIND_COMMAND='command'
+
+FLUSH_INTERVAL=1.0
+
+_current=contextvars.ContextVar('span',default=None)
+
+
+class Tracer:
+
+    def __init__(self):
+        self.started=time.monotonic()
+        self._epoch=time.time()-self.started
+        self._ids=itertools.count(1)
+        self._lock=threading.Lock()
+        self._file=None
+        self._lastflush=0
+        self.totals={KIND_PHASE:{},KIND_COMMAND:{}}
+
+    def open(self, path):
+        """Write spans to path as JSON lines, from now on"""
+        self.close()
+        self._file=open(path,'a',buffering=pow(2,16))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file=None
+
+    def _record(self, kind, name, start, end, attrs):
+        duration=end-start
+        with self._lock:
+            total=self.totals[kind].setdefault(name,{'count':0,'seconds':0.0,'max':0.0,'failed':0})
+            total['count']+=1
+            total['seconds']+=duration
+            total['max']=max(total['max'],duration)
+            total['failed']+=attrs.get('status')=='error' or bool(attrs.get('exitcode'))
+
+            if self._file is not None:
+                self._file.write(json.dumps({
+                    'kind':kind,
+                    'name':name,
+                    'start':round(self._epoch+start,6),
+                    'duration':round(duration,6),
+                    **attrs,
+                },default=str)+'\n')
+                # Flush periodically so a crashed run leaves a usable trace
+                if end-self._lastflush>=FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._lastflush=end
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the enclosed block as phase name. attrs are recorded with it
+
+        The yielded dict may be updated with further attributes
+        """
+        spanid=next(self._ids)
+        attrs['id']=spanid
+        attrs['parent']=_current.get()
+        token=_current.set(spanid)
+        start=time.monotonic()
+        try:
+            yield(attrs)
+            attrs.setdefault('status','ok')
+        except BaseException as e:
+            attrs['status']='error'
+            attrs['error']=repr(e)
+            raise
+        finally:
+            _current.reset(token)
+            self._record(KIND_PHASE,name,start,time.monotonic(),attrs)
+
+    @contextmanager
+    def command(self, argv):
+        """Time an external command. Set 'exitcode' & 'stdoutbytes' on the yielded dict
+
+        :param argv: list of argv, one per stage of a pipeline, or a shell string
+        """
+        attrs={'argv':argv,'parent':_current.get()}
+        start=time.monotonic()
+        try:
+            yield(attrs)
+        except BaseException as e:
+            attrs.setdefault('exitcode',None)
+            attrs['error']=repr(e)
+            raise
+        finally:
+            self._record(KIND_COMMAND,commandName(argv),start,time.monotonic(),attrs)
+
+    def summary(self, out=sys.stdout):
+        """Print where time went: phases, then commands, by total time"""
+        wall=time.monotonic()-self.started
+        with self._lock:
+            totals={k:dict(v) for k,v in self.totals.items()}
+        print(f'Run time {wall:.1f}[s]',file=out)
+        for kind,heading in ((KIND_PHASE,'Phase'),(KIND_COMMAND,'Command')):
+            if not totals[kind]:
+                continue
+            print(f"{heading: <24} {'count': >6} {'total[s]': >10} {'mean[s]': >9} {'max[s]': >9} {'%run': >6} {'failed': >6}",file=out)
+            for name,t in sorted(totals[kind].items(),key=lambda x:-x[1]['seconds']):
+                print(f"{name[:24]: <24} {t['count']: >6} {t['seconds']: >10.2f} {t['seconds']/t['count']: >9.3f}"
+                      f" {t['max']: >9.3f} {t['seconds']/wall if wall else 0: >6.1%} {t['failed']: >6}",file=out)
+        if self._file is not None:
+            self._file.flush()
+
+
+def commandName(argv):
+    """Name a command is summarised under: its program, past any sudo"""
+    if isinstance(argv,str):
+        argv=[argv]
+    stages=[stage.split() if isinstance(stage,str) else stage for stage in argv]
+    words=list(stages[0]) if stages else []
+    while words and words[0] in ('sudo','env'):
+        words=words[1:]
+    name=os.path.basename(words[0]) if words else '?'
+    return(name if len(argv)==1 else f'{name} |...')
+
+
+def traced(name):
+    """Decorator, recording each call of the function as phase name"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            with tracer.span(name):
+                return(fn(*args,**kwargs))
+        return(call)
+    return(decorate)
+
+
+tracer=Tracer()
+span=tracer.span
+command=tracer.command
+summary=tracer.summary
+
+if os.environ.get('MEDIAPC_TRACE'):
+    tracer.open(os.environ['MEDIAPC_TRACE'])
@@ -0,0 +1,266 @@
+"""
+Parallel copy of a directory tree, as from a mounted image to a partition.
+
+The tree is walked with os.scandir on the calling thread, which creates
+directories as it goes, while regular files are copied on a thread pool.
+File data moves in kernel with copy_file_range, or sendfile between
+filesystems that do not support it. Modes, ownership, timestamps, extended
+attributes, symlinks, hard links, device nodes and fifos are preserved, as
+cp -a would. Directory metadata is applied last, deepest first, so
+read only directories and mtimes survive their contents being written.
+
+The walk itself is in TreeWriter, shared with fsread.TreeExtract, which
+reads its tree from an image rather than a mounted directory.
+"""
+
+import errno
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import progress
+import tracing
+
+WORKERS=8
+BLOCK_SIZE=8*pow(2,20)
+BATCH_BYTES=4*pow(2,20)     # Files are handed to workers in batches of up to this many bytes
+BATCH_FILES=256             # or files
+
+# Data copy methods, tried in order until one works for a pair of filesystems
+FALLBACK_ERRORS=(errno.EXDEV,errno.EINVAL,errno.ENOSYS,errno.EOPNOTSUPP)
+_UNSUPPORTED_XATTR_ERRORS=(errno.ENOTSUP,errno.EOPNOTSUPP,errno.EPERM)
+
+
+def _copyFileRange(src, dst, size):
+    done=0
+    while done<size:
+        n=os.copy_file_range(src,dst,min(BLOCK_SIZE,size-done))
+        if n==0:
+            break
+        done+=n
+    return(done)
+
+def _sendfile(src, dst, size):
+    done=0
+    while done<size:
+        n=os.sendfile(dst,src,None,min(BLOCK_SIZE,size-done))
+        if n==0:
+            break
+        done+=n
+    return(done)
+
+def _readWrite(src, dst, size):
+    done=0
+    while True:
+        block=os.read(src,BLOCK_SIZE)
+        if not block:
+            break
+        os.write(dst,block)
+        done+=len(block)
+    return(done)
+
+def copyXattrs(source, target):
+    """Copy extended attributes, skipping those the target filesystem or user cannot hold
+
+    :param source, target: Paths, not followed when symlinks, or open fds
+    """
+    # Functions given fds must not be told not to follow symlinks
+    follow={} if isinstance(source,int) else {'follow_symlinks':False}
+    try:
+        names=os.listxattr(source,**follow)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_XATTR_ERRORS:
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(target,name,os.getxattr(source,name,**follow),**({} if isinstance(target,int) else follow))
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_XATTR_ERRORS:
+                raise
+
+
+class TreeWriter:
+    """Copy of a tree into existing directory target, the source left to subclasses
+
+    The tree is walked on the calling thread, which creates directories as
+    it goes, while regular files are written on a thread pool. Small files
+    are handed to the pool in batches, so per file overhead stays that of
+    the copy itself. Hard links are made once the files they link are
+    written, and directory metadata is applied last, deepest first.
+    Subclasses provide:
+
+    - _root(): item of the top directory
+    - _list(directory): (name, item, st_mode, size, linkkey) of the entries
+      of directory item. linkkey identifies files with several links, None
+      for the others
+    - _writeFile(item, fd): write the contents & metadata of a regular file
+      to fd, returning the number of bytes written
+    - _makeEntry(item, target): make a symlink, device node, fifo or socket
+    - _applyMetadata(item, target): owner, mode & times of item on path target
+
+    :param workers: Files written concurrently
+    :param preserveOwner: Set uid & gid of copies. Defaults to True when running as root
+    """
+
+    PHASE='copy'    # Of the trace span & progress bar
+
+    def __init__(self, target, workers=WORKERS, preserveOwner=None):
+        self.target=str(target)
+        self.workers=workers
+        self.preserveOwner=os.geteuid()==0 if preserveOwner is None else preserveOwner
+        self._lock=threading.Lock()
+        self._links={}      # linkkey: target path, of files with several links
+        self._deferred=[]   # (existing, new) hard links, made once the files they link are written
+        self.stats={'files':0,'dirs':0,'links':0,'special':0,'bytes':0,'seconds':0.0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key]+=n
+
+    def _writeFiles(self, batch):
+        """Write a batch of (item, target) regular files"""
+        written=0
+        for item,target in batch:
+            fd=os.open(target,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600)
+            try:
+                written+=self._writeFile(item,fd)
+            finally:
+                os.close(fd)
+        self._count('files',len(batch))
+        self._count('bytes',written)
+        self._bar.add(written)
+
+    def run(self):
+        """Copy the tree
+
+        :return: stats, counts of files, dirs, links & special files, bytes written & seconds taken
+        """
+        with tracing.span(self.PHASE):
+            start=time.monotonic()
+            root=self._root()
+            directories=[(root,self.target)]
+            futures=[]
+            batch=[]
+            batchbytes=0
+            with progress.bar(self.PHASE,label=self.target) as self._bar, ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending=[(root,self.target)]
+                while pending:
+                    directory,target=pending.pop()
+                    for name,item,mode,size,linkkey in self._list(directory):
+                        entrytarget=os.path.join(target,name)
+                        if stat.S_ISDIR(mode):
+                            # Merged into where the target has it already, as lost+found
+                            os.makedirs(entrytarget,0o700,exist_ok=True)
+                            directories.append((item,entrytarget))
+                            pending.append((item,entrytarget))
+                            self._count('dirs')
+                            continue
+                        if linkkey is not None:
+                            if linkkey in self._links:
+                                self._deferred.append((self._links[linkkey],entrytarget))
+                                continue
+                            self._links[linkkey]=entrytarget
+                        if not stat.S_ISREG(mode):
+                            self._makeEntry(item,entrytarget)
+                            self._applyMetadata(item,entrytarget)
+                            self._count('links' if stat.S_ISLNK(mode) else 'special')
+                            continue
+                        batch.append((item,entrytarget))
+                        batchbytes+=size
+                        if batchbytes>=BATCH_BYTES or len(batch)>=BATCH_FILES:
+                            futures.append(pool.submit(self._writeFiles,batch))
+                            batch,batchbytes=[],0
+                if batch:
+                    futures.append(pool.submit(self._writeFiles,batch))
+                # Result raises any exception from the worker
+                [f.result() for f in futures]
+
+            for existing,target in self._deferred:
+                os.link(existing,target)
+                self._count('links')
+
+            for item,target in reversed(directories):
+                self._applyMetadata(item,target)
+            self.stats['seconds']=time.monotonic()-start
+        return(self.stats)
+
+    def throughput(self):
+        """MiB per second written"""
+        return(self.stats['bytes']/pow(2,20)/self.stats['seconds'] if self.stats['seconds'] else 0.0)
+
+
+class TreeCopy(TreeWriter):
+    """Copy of the contents of directory source into existing directory target
+
+    Items are (path, stat) of the source. See TreeWriter for the parameters
+    """
+
+    def __init__(self, source, target, workers=WORKERS, preserveOwner=None):
+        super().__init__(target,workers,preserveOwner)
+        self.source=Path(source)
+        self._methods=[_copyFileRange,_sendfile,_readWrite]
+
+    def _metadata(self, source, target, st):
+        """Apply owner, mode, xattrs & times of source to target. Paths or open fds"""
+        follow={} if isinstance(target,int) else {'follow_symlinks':False}
+        if self.preserveOwner:
+            os.chown(target,st.st_uid,st.st_gid,**follow)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(target,stat.S_IMODE(st.st_mode))
+        copyXattrs(source,target)
+        os.utime(target,ns=(st.st_atime_ns,st.st_mtime_ns),**follow)
+
+    def _applyMetadata(self, item, target):
+        self._metadata(item[0],target,item[1])
+
+    def _copyData(self, src, dst, size):
+        while True:
+            method=self._methods[0]
+            try:
+                return(method(src,dst,size))
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRORS or method is _readWrite:
+                    raise
+                # Drop the method for all files, the filesystems are the same for all
+                with self._lock:
+                    if self._methods[0] is method:
+                        self._methods.pop(0)
+                os.lseek(src,0,os.SEEK_SET)
+                os.lseek(dst,0,os.SEEK_SET)
+                os.ftruncate(dst,0)
+
+    def _root(self):
+        return((str(self.source),os.stat(self.source)))
+
+    def _list(self, directory):
+        with os.scandir(directory[0]) as entries:
+            for entry in entries:
+                st=entry.stat(follow_symlinks=False)
+                linkkey=(st.st_dev,st.st_ino) if st.st_nlink>1 else None
+                yield((entry.name,(entry.path,st),st.st_mode,st.st_size,linkkey))
+
+    def _writeFile(self, item, fd):
+        source,st=item
+        src=os.open(source,os.O_RDONLY|os.O_NOFOLLOW)
+        try:
+            copied=self._copyData(src,fd,st.st_size)
+            self._metadata(src,fd,st)
+        finally:
+            os.close(src)
+        return(copied)
+
+    def _makeEntry(self, item, target):
+        source,st=item
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source),target)
+        else:
+            # Device nodes, fifos & sockets
+            os.mknod(target,st.st_mode,st.st_rdev)
+
+
+def copyTree(source, target, workers=WORKERS, preserveOwner=None):
+    """Copy contents of source into target. See TreeCopy"""
+    return(TreeCopy(source,target,workers,preserveOwner).run())
@@ -1,48 +1,208 @@
+import asyncio
+import os
+import shlex
+import signal
 import subprocess
+import threading
 import re
 from collections import defaultdict as dd
-import urllib.request
+import urllib.parse
 import pathlib
-import shutil
+from download import download
+import tracing
 
 PIPE='|'
-def bash(cmd:str, viashell=False, check:bool=True):
+
+def splitPipeline(cmd:str):
+    """Split a command line into the argv of each stage of its pipeline
+
+    Quoting is honoured, so quoted or escaped arguments may hold spaces or a |
+    """
+    # Stages split at each | outside quotes, each then split as shlex would
+    stages=[]
+    start=0
+    quote=None
+    escaped=False
+    for n,c in enumerate(cmd):
+        if escaped:
+            escaped=False
+        elif c=='\\' and quote!="'":
+            escaped=True
+        elif quote is not None:
+            if c==quote:
+                quote=None
+        elif c in '"\'':
+            quote=c
+        elif c==PIPE:
+            stages.append(cmd[start:n])
+            start=n+1
+    stages.append(cmd[start:])
+    return([shlex.split(s) for s in stages])
+
+def _pipelineResult(args, returncodes, stdout, stderrs, check, traced):
+    """Result of a finished pipeline, like subprocess.run would give
+
+    The first stage to fail is reported, as with pipefail. Stages killed by
+    SIGPIPE after a later stage stopped reading are not failures.
+    """
+    failed=None
+    for n,code in enumerate(returncodes):
+        sigpipe=code==-signal.SIGPIPE and n<len(returncodes)-1
+        if code!=0 and not sigpipe:
+            failed=n
+            break
+    n=len(args)-1 if failed is None else failed
+    result=subprocess.CompletedProcess(args[n],returncodes[n],
+        stdout if n==len(args)-1 else '',stderrs[n])
+    traced['exitcode']=result.returncode
+    traced['stdoutbytes']=len(stdout)
+    if check and failed is not None:
+        raise subprocess.CalledProcessError(result.returncode,result.args,result.stdout,result.stderr)
+    return(result)
+
+def _commands(cmd, viashell):
+    if viashell:
+        return([cmd])
+    return(splitPipeline(cmd))
+
+def bash(cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
     """Run a command and check its return status
-    
+
+    Stages of a pipeline are connected with os pipes and run concurrently,
+    so no intermediate output is held in memory.
+
     :cmd 
+    :param viashell: Run cmd with the shell, for globs and the like
     :param bool check: When true, throw and exception for failed command
+    :param input: Bytes fed to the stdin of the first command
+    :param online: Called with each line of stdout of the last command, as it arrives
+    :return: subprocess.CompletedProcess of the last command, or of the first
+        that failed. stdout is decoded
     """
     
     if __debug__:
         print(f'bash {cmd}')
 
-    commands=[[]]
-    for e in cmd.split():
-        if e==PIPE:
-            commands.append([])
-            continue
-        commands[-1].append(e)
-
-    results=[]
-    stdin=None
-
-    for c in commands:
-        if viashell:
-            c=' '.join(c)
-        result=subprocess.run(
-            c,
-            input=stdin,
-            shell=viashell,
-            capture_output=True,
-            check=check,
-        )
-        results.append(result)
-        if(result.returncode!=0):
-            break
-        stdin=result.stdout
-    
-    results[-1].stdout=results[-1].stdout.decode()
-    return(results[-1])
+    commands=_commands(cmd,viashell)
+    with tracing.command(commands) as traced:
+        return(_runPipeline(commands,viashell,check,input,online,traced))
+
+def _runPipeline(commands, viashell, check, input, online, traced):
+    procs=[]
+    try:
+        for n,c in enumerate(commands):
+            if n==0:
+                stdin=subprocess.PIPE if input is not None else None
+            else:
+                stdin=procs[-1].stdout
+            proc=subprocess.Popen(c,shell=viashell,stdin=stdin,
+                stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            if n>0:
+                # Only the next stage reads this stages output
+                procs[-1].stdout.close()
+            procs.append(proc)
+
+        stderrs=[b'']*len(procs)
+        def _drain(proc,n):
+            stderrs[n]=proc.stderr.read()
+        readers=[threading.Thread(target=_drain,args=(p,n),daemon=True) for n,p in enumerate(procs)]
+        if input is not None:
+            def _feed(stream):
+                try:
+                    stream.write(input)
+                    stream.close()
+                except BrokenPipeError:
+                    pass
+            readers.append(threading.Thread(target=_feed,args=(procs[0].stdin,),daemon=True))
+        [t.start() for t in readers]
+
+        lines=[]
+        for line in procs[-1].stdout:
+            line=line.decode()
+            lines.append(line)
+            if online is not None:
+                online(line)
+        procs[-1].stdout.close()
+        returncodes=[p.wait() for p in procs]
+        [t.join() for t in readers]
+    except BaseException:
+        for p in procs:
+            p.kill()
+        raise
+
+    return(_pipelineResult(commands,returncodes,''.join(lines),stderrs,check,traced))
+
+async def abash(cmd:str, viashell=False, check:bool=True, input:bytes=None, online=None):
+    """asyncio variant of bash, so independent commands can run in parallel
+
+    :seealso: bash, bashParallel, tracing.command which records it
+    """
+    commands=_commands(cmd,viashell)
+    with tracing.command(commands) as traced:
+        return(await _arunPipeline(commands,viashell,check,input,online,traced))
+
+async def _arunPipeline(commands, viashell, check, input, online, traced):
+    procs=[]
+    try:
+        stdin=asyncio.subprocess.PIPE if input is not None else None
+        for n,c in enumerate(commands):
+            last=n==len(commands)-1
+            if last:
+                stdout=asyncio.subprocess.PIPE
+            else:
+                readfd,stdout=os.pipe()
+            if viashell:
+                proc=await asyncio.create_subprocess_shell(c,stdin=stdin,stdout=stdout,stderr=asyncio.subprocess.PIPE)
+            else:
+                proc=await asyncio.create_subprocess_exec(*c,stdin=stdin,stdout=stdout,stderr=asyncio.subprocess.PIPE)
+            # Pipe ends now belong to the children
+            if n>0:
+                os.close(stdin)
+            if not last:
+                os.close(stdout)
+                stdin=readfd
+            procs.append(proc)
+
+        async def _feed():
+            if input is None:
+                return
+            try:
+                procs[0].stdin.write(input)
+                await procs[0].stdin.drain()
+                procs[0].stdin.close()
+            except (BrokenPipeError,ConnectionResetError):
+                pass
+
+        async def _read():
+            lines=[]
+            while True:
+                line=await procs[-1].stdout.readline()
+                if not line:
+                    break
+                line=line.decode()
+                lines.append(line)
+                if online is not None:
+                    online(line)
+            return(''.join(lines))
+
+        results=await asyncio.gather(_feed(),_read(),*[p.stderr.read() for p in procs])
+        returncodes=[await p.wait() for p in procs]
+    except BaseException:
+        for p in procs:
+            if p.returncode is None:
+                p.kill()
+        raise
+
+    return(_pipelineResult(commands,returncodes,results[1],results[2:],check,traced))
+
+def bashParallel(cmds, **kwargs):
+    """Run independent commands concurrently, returning their results in order
+
+    :param kwargs: As for bash, applied to every command
+    """
+    async def _all():
+        return(await asyncio.gather(*[abash(c,**kwargs) for c in cmds]))
+    return(asyncio.run(_all()))
     
 def getDictionaryFromKeyValueString(string):
     d=dd(lambda :None)
@@ -56,18 +216,13 @@ def userConfirm(prompt):
         continue
     
 def dlFile(url, target:pathlib.Path, showProgress=True):
-    resp=urllib.request.urlopen(url)
-    h=resp.getheaders()
-    #bytesize=int(resp.getheader('content-length'))
-    col, _= shutil.get_terminal_size()
-    with open(pathlib.Path(target,'fn'),'wb') as imageFile:
-        while not resp.closed:
-            imageFile.write(resp.read())
-            if showProgress:
-                done=imageFile.tell()
-                pct=done
-                bar='#'*int(col*pct)
-                print('{: <4.1%} ||{}|| {}[Mibi]'.format(pct,bar,(done/pow(2,20))),end='\r')
-        imageFile.write(resp.read())
-        
-    return(resp.closed)
+    """Download url to target. Resumable & parallel where the server allows
+
+    :param target: File to write, or directory to write the urls file name into
+    :return: Path of downloaded file
+    :seealso: download.Download
+    """
+    target=pathlib.Path(target)
+    if target.is_dir():
+        target=pathlib.Path(target,pathlib.PurePosixPath(urllib.parse.urlparse(url).path).name or 'index')
+    return(download(url,target,showProgress=showProgress))